@@ -1,11 +1,12 @@
 # Standard library imports
-import time
+import os
 import logging
 import json
+import threading
 from urllib.parse import urlparse
 
 # Flask framework and extensions
-from flask import Flask, render_template, request, session, Response, send_from_directory
+from flask import Flask, render_template, request, Response, send_from_directory, jsonify, abort
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileRequired, FileAllowed
 
@@ -17,31 +18,28 @@ from wtforms import StringField, SubmitField
 from wtforms.validators import ValidationError
 
 # Local application imports
-from scripts.processing import *
+from scripts.config import config
+from scripts.log import setup_logging
+from scripts.processing import process_video, get_youtube_video, get_video_title, save_uploaded_file
+from scripts.jobs import JobManager, JobQueueFull, JOB_DONE, JOB_FAILED
+from scripts.store import open_store
+from scripts.cache import ArtifactCache, ARTIFACTS
+from scripts.metrics import registry, render_metrics
+from scripts.completion_cache import completion_cache_stats
+from scripts.uploads import UploadManager, UploadError, OffsetMismatch
 
 app = Flask(__name__)
 app.secret_key = 'secret'
-app.config['UPLOAD_FOLDER'] = os.path.abspath('./uploads')
-app.config['steps'] = {
-    "Init Form": 0,
-    "Downloaded": 12.5,
-    "ConvertedAudio": 25,
-    "Transcribed": 37.5,
-    "Summarized": 50,
-    "Outlined": 62.5,
-    "Content": 75,
-    "HeaderImage": 87.5,
-    "Completed": 100
-}
-
-logging.basicConfig()
-fh = logging.FileHandler(f'logs/blogarize.log', mode='w')
-fh.setLevel(logging.DEBUG)  # Set the handler's level to DEBUG
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(lineno)d - %(funcName)s - %(message)s')
-fh.setFormatter(formatter)
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)  # Set the logger's level to DEBUG
-logger.addHandler(fh)
+app.config.update(config)
+
+setup_logging(
+    config['LOG_FILE'],
+    level=config['LOG_LEVEL'],
+    console_level=config['LOG_CONSOLE_LEVEL'],
+    max_bytes=config['LOG_MAX_BYTES'],
+    backups=config['LOG_BACKUPS'],
+    max_chars=config['LOG_MAX_CHARS']
+)
 logging.debug("app.py: And away we go!")
 
 class VideoForm(FlaskForm):
@@ -49,7 +47,6 @@ class VideoForm(FlaskForm):
 
     youtube_link = StringField('Youtube Link', default="https://www.youtube.com/watch?v=cAgZFEhJrKk")
     mp4_upload = FileField('Upload MP4')
-    mp4_size = StringField('MP4 Size', default="0")
     submit = SubmitField('Submit')
 
     def validate_youtube_link(form, field):
@@ -72,86 +69,228 @@ class VideoForm(FlaskForm):
                 if not file.filename.lower().endswith('.mp4'):
                     raise ValidationError('Invalid file format. Please, upload a .mp4 file')
 
+def move_legacy_store(filepath :str) -> None:
+    # The store used to sit in the uploads folder, where /download would hand it to anyone who asked
+    legacy_filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'blogarize.db')
+    if not os.path.exists(legacy_filepath) or os.path.exists(filepath):
+        return
+    logging.warning(f"Moving the job store from {legacy_filepath} to {filepath}")
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(legacy_filepath + suffix):
+            os.replace(legacy_filepath + suffix, filepath + suffix)
+
+if '://' not in app.config['JOB_STORE']:
+    move_legacy_store(app.config['JOB_STORE'])
+store = open_store(app.config['JOB_STORE'])
+cache = ArtifactCache(app.config['CACHE_FOLDER'], max_bytes=app.config['CACHE_MAX_BYTES'], store=store, pin_seconds=app.config['JOB_LEASE_SECONDS'])
+uploads = UploadManager(store, cache, chunk_size=app.config['UPLOAD_CHUNK_BYTES'])
+jobs = JobManager(
+    store,
+    max_workers=app.config['JOB_WORKERS'],
+    max_pending=app.config['JOB_QUEUE_SIZE'],
+    profile_folder=app.config['PROFILE_FOLDER'],
+    lease_seconds=app.config['JOB_LEASE_SECONDS'],
+    max_attempts=app.config['JOB_MAX_ATTEMPTS']
+)
+jobs.register('process_video', lambda **params: process_video(cache, **params))
+jobs.start()
+
+def youtube_key(link :str) -> str:
+    # The same video gets the same job while it's in flight, however the link is written
+    try:
+        return get_youtube_video(link)[1]
+    except Exception as e:
+        logging.error(f"Could not work out the video ID of {link}: {e}")
+        return None
+
+def wants_profile() -> bool:
+    return app.config['PROFILE_JOBS'] or request.args.get('profile') == '1'
+
 @app.route('/', methods=['GET', 'POST'])
 def upload_file():
     form = VideoForm()
-    global download_progress
-    download_progress = 0
-    
+
     if form.validate_on_submit():
         if form.youtube_link.data and form.mp4_upload.data:
             return "Please provide only one input: either a YouTube link or an MP4 file.", 400
 
-        session['progress'] = 0
-        session['current_step'] = 'Downloading video.'
-
-        file_name = ""
-        if form.youtube_link.data:
-            logging.info(f"Processing YouTube Link: {form.youtube_link.data}")
-            video = get_youtube_video(form.youtube_link.data)
-            title = video[0].title
-            file_name = download_youtube_video(video[0], video[1], app.config['UPLOAD_FOLDER'])
-            session['progress'] = app.config.get('steps')['Downloaded']
-            session['current_step'] = 'YouTube Video Downloaded. Converting to audio...'
-        elif form.mp4_upload.data:
-            logging.info(f"Saving uploaded file: {form.mp4_upload.data}")
-            mp4_size = int(form.mp4_size.data)
-            file = save_uploaded_file(form.mp4_upload.data, app.config['UPLOAD_FOLDER'], mp4_size)
-            file_name = file[1]
-            title = file[0]
-            session['progress'] = app.config.get('steps')['Downloaded']
-            session['current_step'] = 'MP4 File Uploaded. Converting to audio...'
-      
-        if file_name.endswith('.mp4'):
-            logging.info(f"Video File: {file_name}")
-            video_filepath = os.path.join(app.config['UPLOAD_FOLDER'], file_name)
-            audio_filepath = os.path.join(app.config['UPLOAD_FOLDER'], file_name.replace('.mp4', '.wav'))
-            convert_video_to_audio(video_filepath, audio_filepath)
-            if audio_filepath.endswith('.wav'):
-                logging.info(f"Audio file: {audio_filepath}")
-                # Transcribe the audio to text
-                transcript = transcribe_audio(audio_filepath)
-                # Check if transcription was a success
-                if not transcript.startswith('Could not transcribe'):
-                    summary_filepath = audio_filepath.replace('.wav', '.md')
-                    # Summarize the transcription
-                    summary = call_openai(f"Give me an outline and summary of this text: {transcript}", summary_filepath)
-                    # Check if summary was a success
-                    if not summary.startswith('Could not summarize'):
-                        session['progress'] = app.config.get('steps')['Summarized']
-                        session['current_step'] = 'Summarized. Creating a blog post from the summary.'
-                        blog_filepath = audio_filepath.replace('.wav', '-blog.html')
-                        blog = create_blog(title, transcript, summary, blog_filepath)
-                        dalle_filepath = audio_filepath.replace('.wav', '-dalle.png')
-                        call_dalle(prompt=f"Generate an image based on the blog post you created. Do not, under any circumstances, put words in this image. {summary}.", filename=dalle_filepath, model="dall-e-3", size="1792x1024", n=1, quality="hd")
-
-                        return render_template('output.html', summary=summary, transcript=transcript, title=title, blog=blog, header_img=os.path.basename(dalle_filepath))
-                    else:
-                        logging.error(f"Error in summarizing: {summary}")
-                        return render_template('error.html', message=summary)
-                else:
-                    logging.error(f"Error in transcription: {transcript}")
-                    return render_template('error.html', message=transcript)
+        try:
+            if form.youtube_link.data:
+                logging.info(f"Queueing YouTube Link: {form.youtube_link.data}")
+                job = jobs.submit('process_video', youtube_link=form.youtube_link.data, label=form.youtube_link.data, profile=wants_profile(), dedup_key=youtube_key(form.youtube_link.data))
+            elif form.mp4_upload.data:
+                # The upload stream only lives as long as the request, so it's saved before queueing
+                logging.info(f"Saving uploaded file: {form.mp4_upload.data}")
+                file = save_uploaded_file(form.mp4_upload.data, cache)
+                if isinstance(file, str):
+                    logging.error(f"Error saving the upload: {file}")
+                    return render_template('error.html', message=file)
+                job = jobs.submit('process_video', title=file[0], key=file[1], label=file[0], profile=wants_profile(), dedup_key=file[1])
             else:
-                logging.error(f"Error in converting to audio: {audio_filepath}")
-                return render_template('error.html', message=audio_filepath)
-        # Add an error page or message if an error occurs during processing
-        return render_template('error.html', message='An error occurred during processing. Please try again.')
+                return render_template('error.html', message='Please provide a YouTube link or an MP4 file.')
+        except JobQueueFull as e:
+            logging.error(f"Job queue is full: {e}")
+            return render_template('error.html', message=str(e)), 503
+
+        return render_template('job.html', job=job), 202
     return render_template('form.html', form=form)
 
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': f"Unknown job: {job_id}"}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/watch')
+def job_watch(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return render_template('error.html', message=f"Unknown job: {job_id}"), 404
+    return render_template('job.html', job=job)
+
+@app.route('/jobs/<job_id>/output')
+def job_output(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return render_template('error.html', message=f"Unknown job: {job_id}"), 404
+    if job.status == JOB_FAILED:
+        return render_template('error.html', message=job.error)
+    if job.status != JOB_DONE:
+        return jsonify(job.to_dict()), 202
+    return render_template('output.html', warnings=job.warnings, **job.result)
+
+@app.route('/jobs/<job_id>/profile')
+def job_profile(job_id):
+    job = jobs.get(job_id)
+    if job is None or job.profile_filepath is None:
+        return jsonify({'error': f"No profile for job {job_id}"}), 404
+    return send_from_directory(os.path.dirname(job.profile_filepath), os.path.basename(job.profile_filepath), mimetype='text/plain')
+
+def queue_cached_video(key :str, filename :str):
+    title = cache.meta(key).get('title')
+    if not title:
+        title = get_video_title(cache.path(key, 'video'), filename)
+        cache.set_meta(key, title=title)
+    return jobs.submit('process_video', title=title, key=key, label=title, profile=wants_profile(), dedup_key=key)
+
+@app.route('/uploads', methods=['POST'])
+def start_upload():
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename', '')
+    if not filename.lower().endswith('.mp4'):
+        return jsonify({'error': 'Invalid file format. Please, upload a .mp4 file'}), 400
+    try:
+        upload = uploads.start(filename, int(data.get('size', 0)), data.get('sha256'))
+        if upload['status'] == 'exists':
+            # We already have this video, so the client can skip sending it
+            job = queue_cached_video(upload['key'], filename)
+            return jsonify(dict(upload, job_id=job.id))
+    except (ValueError, UploadError) as e:
+        return jsonify({'error': str(e)}), 400
+    except JobQueueFull as e:
+        return jsonify({'error': str(e)}), 503
+    return jsonify(upload), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    upload = uploads.get(upload_id)
+    if upload is None:
+        return jsonify({'error': f"Unknown upload: {upload_id}"}), 404
+    return jsonify(upload.to_dict())
+
+@app.route('/uploads/<upload_id>', methods=['PATCH'])
+def upload_chunk(upload_id):
+    # The body is streamed straight into the part file at the offset the client says it's sending
+    if uploads.get(upload_id) is None:
+        return jsonify({'error': f"Unknown upload: {upload_id}"}), 404
+    try:
+        offset = uploads.write_chunk(upload_id, int(request.headers.get('Upload-Offset', -1)), request.stream)
+    except OffsetMismatch as e:
+        return jsonify({'error': str(e), 'offset': e.offset}), 409
+    except (ValueError, UploadError) as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'upload_id': upload_id, 'offset': offset})
+
+@app.route('/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    upload = uploads.get(upload_id)
+    if upload is None:
+        return jsonify({'error': f"Unknown upload: {upload_id}"}), 404
+    try:
+        key = uploads.complete(upload_id)
+        job = queue_cached_video(key, upload.filename)
+    except OffsetMismatch as e:
+        return jsonify({'error': str(e), 'offset': e.offset}), 409
+    except UploadError as e:
+        return jsonify({'error': str(e)}), 400
+    except JobQueueFull as e:
+        return jsonify({'error': str(e)}), 503
+    return jsonify({'status': 'complete', 'key': key, 'job_id': job.id})
+
+@app.route('/transcriber')
+def transcriber_status():
+    from scripts.whisper_service import whisper_stats
+    return jsonify(whisper_stats())
+
+@app.route('/openai')
+def openai_status():
+    from scripts.openai_client import openai_stats
+    return jsonify(openai_stats())
+
+@app.route('/metrics')
+def metrics():
+    # Prometheus scrapes this; the job and cache numbers are read as it asks
+    registry.set('blogarize_jobs_pending', 'Jobs queued or running', jobs.pending())
+    registry.set('blogarize_cache_bytes', 'Bytes in the artifact cache', cache.total_bytes())
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/completions')
+def completions_status():
+    return jsonify(completion_cache_stats())
+
+@app.route('/cache')
+def cache_status():
+    return jsonify(cache.stats())
+
+# Only what a finished job shows on its page. Everything else under the uploads folder (videos, transcripts,
+# uploads still coming in) stays private.
+DOWNLOADABLE = (ARTIFACTS['blog'], ARTIFACTS['image'])
+
 @app.route('/download/<path:filename>')
 def download(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    # Paths are relative to the uploads folder, as cache/<key>/<artifact>
+    cache_prefix = os.path.relpath(app.config['CACHE_FOLDER'], app.config['UPLOAD_FOLDER'])
+    parts = filename.split('/')
+    if len(parts) != 3 or parts[0] != cache_prefix or parts[2] not in DOWNLOADABLE:
+        abort(404)
+    return send_from_directory(app.config['CACHE_FOLDER'], f"{parts[1]}/{parts[2]}")
+
+# Each stream ties up a server thread until its job ends, so past PROGRESS_STREAMS watchers are sent to poll
+progress_streams = threading.BoundedSemaphore(app.config['PROGRESS_STREAMS'])
 
-@app.route('/progress')
-def progress():
+@app.route('/progress/<job_id>')
+def progress(job_id):
+    if jobs.get(job_id) is None:
+        return jsonify({'error': f"Unknown job: {job_id}"}), 404
+    if not progress_streams.acquire(blocking=False):
+        logging.info(f"Too many progress streams open, job {job_id} will be polled instead")
+        return jsonify({'error': 'Too many progress streams are open. Poll the job instead.', 'poll': f"/jobs/{job_id}"}), 503, {'Retry-After': '5'}
     def generate():
-        while True:
-            progress :int = session.get('progress', 0)
-            current_step :str= session.get('current_step', 'Press submit to get started.')
-            yield f"data: {json.dumps({'progress': progress, 'current_step': current_step})}\n\n"
-            time.sleep(1)
-    return Response(generate(), mimetype="text/event-stream")
+        # Straight from the job's event queue when this worker runs it, from the store when another one does
+        for event in jobs.watch(job_id):
+            if event is None:
+                yield ": keep-alive\n\n"
+            elif event.get('type') == 'token':
+                yield f"event: token\ndata: {json.dumps(event)}\n\n"
+            else:
+                yield f"data: {json.dumps(event)}\n\n"
+        yield "event: end\ndata: {}\n\n"
+    response = Response(generate(), mimetype="text/event-stream", headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # The server closes the response however the stream ends, even when the client went away before it started
+    response.call_on_close(progress_streams.release)
+    return response
 
 if __name__ == '__main__':
     app.run(host="127.0.0.1", port=5000, debug = True)
\ No newline at end of file
@@ -0,0 +1,68 @@
+# Standard library imports
+import os
+import shutil
+import logging
+import subprocess
+from typing import Iterator, List
+
+# Third-party imports for audio processing
+import numpy as np
+
+# Whisper resamples everything to 16 kHz mono, so we hand it exactly that
+SAMPLE_RATE = 16000
+CHANNELS = 1
+SAMPLE_WIDTH = 2
+
+def ffmpeg_executable() -> str:
+    # An explicit setting wins, then the system ffmpeg, then the one bundled with imageio-ffmpeg
+    executable = os.getenv('FFMPEG_BINARY') or shutil.which('ffmpeg')
+    if executable:
+        return executable
+    import imageio_ffmpeg
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+def _ffmpeg_command(video_filepath :str, output :List[str]) -> List[str]:
+    # Take the first audio track only; -vn means the video stream is never decoded
+    return [
+        ffmpeg_executable(), '-nostdin', '-hide_banner', '-loglevel', 'error',
+        '-i', video_filepath,
+        '-map', '0:a:0', '-vn',
+        '-ac', str(CHANNELS), '-ar', str(SAMPLE_RATE), '-acodec', 'pcm_s16le'
+    ] + output
+
+def extract_audio(video_filepath :str, audio_filepath :str) -> str:
+    # Written next to the target first so a failed run never leaves a half-written WAV behind
+    temp_filepath = audio_filepath + '.part'
+    logging.info(f"Extracting 16 kHz mono audio from {video_filepath}")
+    result = subprocess.run(_ffmpeg_command(video_filepath, ['-f', 'wav', '-y', temp_filepath]), capture_output=True)
+    if result.returncode != 0:
+        if os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
+        raise RuntimeError(f"ffmpeg could not extract audio from {video_filepath}: {result.stderr.decode(errors='replace').strip()}")
+    os.replace(temp_filepath, audio_filepath)
+    return audio_filepath
+
+def stream_audio(video_filepath :str, chunk_seconds :float = 30) -> Iterator[bytes]:
+    # Raw 16-bit PCM straight from ffmpeg's stdout, chunk_seconds at a time
+    chunk_bytes = int(chunk_seconds * SAMPLE_RATE) * SAMPLE_WIDTH * CHANNELS
+    process = subprocess.Popen(_ffmpeg_command(video_filepath, ['-f', 's16le', '-']), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        while True:
+            chunk = process.stdout.read(chunk_bytes)
+            if not chunk:
+                break
+            yield chunk
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg could not decode {video_filepath}: {process.stderr.read().decode(errors='replace').strip()}")
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        process.stderr.close()
+
+def load_audio(video_filepath :str) -> np.ndarray:
+    # The whole track as float32 samples Whisper can take directly, no WAV on disk
+    chunks = [np.frombuffer(chunk, dtype='<i2') for chunk in stream_audio(video_filepath)]
+    if not chunks:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(chunks).astype(np.float32) / 32768
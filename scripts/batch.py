@@ -0,0 +1,176 @@
+# Runs a whole backlog of videos through the pipeline from the command line, no browser needed.
+#
+#   python -m scripts.batch https://youtu.be/... https://youtu.be/...
+#   python -m scripts.batch --playlist https://www.youtube.com/playlist?list=... --processes 4
+#   python -m scripts.batch --dir ~/Videos --limit transcribe=1 --limit download=2
+#
+# Finished items are written to the manifest as they complete, so running the same command again
+# after a crash (or Ctrl-C) only picks up what's left.
+
+# Standard library imports
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
+
+# Local imports
+from scripts.util import atomic_write
+from scripts.log import child_logging, setup_logging
+
+# Stages that are heavy on the machine itself get a limit across the whole batch by default.
+# Everything else mostly waits on the network and only answers to the OpenAI rate limits.
+DEFAULT_LIMITS = {'download': 2, 'transcribe': 1}
+
+# Set in each worker process by _init_worker
+_worker_cache = None
+_worker_limits = None
+
+class Manifest:
+    # One entry per input (link or file path): its status, title, stage timings and how long it took
+    def __init__(self, filepath :str):
+        self.filepath = filepath
+        self._lock = threading.Lock()
+        self.items: Dict[str, dict] = {}
+        if os.path.exists(filepath):
+            with open(filepath, 'r') as f:
+                self.items = json.load(f).get('items', {})
+
+    def done(self, item :str) -> bool:
+        return self.items.get(item, {}).get('status') == 'done'
+
+    def update(self, item :str, **fields) -> None:
+        with self._lock:
+            self.items.setdefault(item, {}).update(fields)
+            with atomic_write(self.filepath) as f:
+                json.dump({'items': self.items}, f, indent=2)
+
+def expand_inputs(links :List[str], playlists :List[str], directories :List[str]) -> List[str]:
+    items = list(links)
+    for playlist in playlists:
+        from pytube import Playlist
+        urls = list(Playlist(playlist).video_urls)
+        logging.info(f"Playlist {playlist} has {len(urls)} videos")
+        items.extend(urls)
+    for directory in directories:
+        for name in sorted(os.listdir(directory)):
+            if name.lower().endswith('.mp4'):
+                items.append(os.path.abspath(os.path.join(directory, name)))
+    # The same video can turn up twice, e.g. in a playlist and on its own
+    return list(dict.fromkeys(items))
+
+def _init_worker(limits :dict, log_queue) -> None:
+    global _worker_cache, _worker_limits
+    from scripts.config import config
+    from scripts.log import log_to_queue
+    from scripts.cache import ArtifactCache
+    from scripts.store import open_store
+    # Logged through the parent, so there's one writer for the log file
+    log_to_queue(log_queue, max_chars=config['LOG_MAX_CHARS'])
+    # The index is kept in the shared store, so the workers see each other's artifacts instead of overwriting one index file
+    _worker_cache = ArtifactCache(config['CACHE_FOLDER'], max_bytes=config['CACHE_MAX_BYTES'], store=open_store(config['JOB_STORE']), pin_seconds=config['JOB_LEASE_SECONDS'])
+    _worker_limits = limits
+
+def _run_item(item :str) -> dict:
+    # Runs in a worker process. Anything that goes wrong comes back as the item's error rather than killing the batch.
+    from scripts.processing import process_video, save_local_file
+    started = time.perf_counter()
+    try:
+        if os.path.isfile(item):
+            title, key = save_local_file(item, _worker_cache)
+            result = process_video(_worker_cache, title=title, key=key, stage_limits=_worker_limits)
+        else:
+            result = process_video(_worker_cache, youtube_link=item, stage_limits=_worker_limits)
+    except Exception as e:
+        logging.error(f"Batch item {item} failed: {e}")
+        return {'status': 'failed', 'error': str(e), 'seconds': round(time.perf_counter() - started, 3)}
+    return {
+        'status': 'done',
+        'title': result['title'],
+        'header_img': result['header_img'],
+        'timings': result['timings'],
+        'seconds': round(time.perf_counter() - started, 3)
+    }
+
+def run_batch(items :List[str], manifest :Manifest, processes :int = 2, limits :Optional[dict] = None) -> dict:
+    todo = [item for item in items if not manifest.done(item)]
+    skipped = len(items) - len(todo)
+    if skipped:
+        logging.info(f"Skipping {skipped} items the manifest says are already done")
+    # Spawn so the workers start clean; the semaphores are handed over as the workers start
+    context = multiprocessing.get_context('spawn')
+    semaphores = {stage: context.BoundedSemaphore(n) for stage, n in (limits or {}).items()}
+    started = time.perf_counter()
+    results = {}
+    with child_logging(context) as log_queue, ProcessPoolExecutor(max_workers=max(1, processes), mp_context=context, initializer=_init_worker, initargs=(semaphores, log_queue)) as executor:
+        futures = {executor.submit(_run_item, item): item for item in todo}
+        for item in todo:
+            manifest.update(item, status='queued', error=None)
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # The worker process itself went away
+                result = {'status': 'failed', 'error': str(e)}
+            manifest.update(item, finished=time.time(), **result)
+            results[item] = result
+            print(f"[{len(results)}/{len(todo)}] {result['status']}: {item} ({result.get('seconds', 0):.1f}s)", flush=True)
+    return summarize(results, skipped, time.perf_counter() - started)
+
+def summarize(results :Dict[str, dict], skipped :int, seconds :float) -> dict:
+    done = [r for r in results.values() if r['status'] == 'done']
+    stages: Dict[str, List[float]] = {}
+    for result in done:
+        for name, timing in result['timings']['stages'].items():
+            stages.setdefault(name, []).append(timing.get('seconds', 0))
+    return {
+        'items': len(results) + skipped,
+        'done': len(done),
+        'failed': len(results) - len(done),
+        'skipped': skipped,
+        'wall_seconds': round(seconds, 3),
+        'items_per_hour': round(len(done) * 3600 / seconds, 2) if seconds and done else 0,
+        'avg_item_seconds': round(sum(r['seconds'] for r in done) / len(done), 3) if done else None,
+        'stages': {name: {'avg_seconds': round(sum(s) / len(s), 3), 'max_seconds': round(max(s), 3), 'total_seconds': round(sum(s), 3)} for name, s in stages.items()}
+    }
+
+def parse_limit(value :str) -> Tuple[str, int]:
+    stage, _, n = value.partition('=')
+    if not stage or not n.isdigit():
+        raise argparse.ArgumentTypeError(f"Limits look like stage=N, got '{value}'")
+    return stage, int(n)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Turn a batch of videos into blog posts.')
+    parser.add_argument('links', nargs='*', help='YouTube links')
+    parser.add_argument('--playlist', action='append', default=[], help='a YouTube playlist (can be given more than once)')
+    parser.add_argument('--dir', action='append', default=[], dest='directories', help='a directory of MP4s (can be given more than once)')
+    parser.add_argument('--processes', type=int, default=2, help='videos processed at the same time')
+    parser.add_argument('--limit', action='append', default=[], type=parse_limit, help='stage=N, at most N of that stage at once across the batch (0 for no limit)')
+    parser.add_argument('--manifest', default='batch-manifest.json', help='where finished items are recorded')
+    args = parser.parse_args()
+    from scripts.config import config
+    setup_logging(
+        config['LOG_FILE'],
+        level=config['LOG_LEVEL'],
+        console_level=config['LOG_CONSOLE_LEVEL'],
+        max_bytes=config['LOG_MAX_BYTES'],
+        backups=config['LOG_BACKUPS'],
+        max_chars=config['LOG_MAX_CHARS']
+    )
+
+    items = expand_inputs(args.links, args.playlist, args.directories)
+    if not items:
+        parser.error('Nothing to do. Give some links, a --playlist or a --dir.')
+    limits = dict(DEFAULT_LIMITS, **dict(args.limit))
+    # 0 means no limit for that stage
+    limits = {stage: n for stage, n in limits.items() if n > 0}
+    stats = run_batch(items, Manifest(args.manifest), processes=args.processes, limits=limits)
+    print(json.dumps(stats, indent=2))
+    sys.exit(1 if stats['failed'] else 0)
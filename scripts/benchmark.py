@@ -0,0 +1,183 @@
+# Times the whole pipeline on synthetic videos against the fake OpenAI server, so it runs the same way
+# on any machine without a network or an API key. Every run starts from an empty cache.
+#
+#   python -m scripts.benchmark --lengths 30,120,600 --repeat 3 --latency 0.5 --output bench.json
+#   python -m scripts.benchmark --compare bench.json     # after a change, to see what moved
+#
+# Transcription uses the real Whisper model (tiny unless --whisper-model says otherwise), which has to be
+# downloaded once beforehand.
+
+# Standard library imports
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from typing import Dict, List
+
+STAGES = ['download', 'transcribe', 'notes', 'summary', 'blog', 'image']
+
+def make_fixture(filepath :str, seconds :int) -> str:
+    # A tone that drops out for a second every ten seconds, so there are silences to split on, over a grey picture
+    from scripts.audio import ffmpeg_executable
+    if os.path.exists(filepath):
+        return filepath
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    temp_filepath = filepath + '.part.mp4'
+    subprocess.run([
+        ffmpeg_executable(), '-nostdin', '-hide_banner', '-loglevel', 'error', '-y',
+        '-f', 'lavfi', '-i', f"aevalsrc=0.3*sin(2*PI*220*t)*gt(mod(t\\,10)\\,1):s=44100:d={seconds}",
+        '-f', 'lavfi', '-i', f"color=c=gray:s=320x240:r=5:d={seconds}",
+        '-shortest', temp_filepath
+    ], check=True)
+    os.replace(temp_filepath, filepath)
+    return filepath
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def run_once(video_filepath :str, workdir :str) -> dict:
+    # The real pipeline, from an empty cache, so every stage does its work
+    from scripts.cache import ArtifactCache
+    from scripts.processing import process_video, save_local_file
+    cache_folder = os.path.join(workdir, 'cache')
+    shutil.rmtree(cache_folder, ignore_errors=True)
+    cache = ArtifactCache(cache_folder)
+    started = time.perf_counter()
+    title, key = save_local_file(video_filepath, cache)
+    result = process_video(cache, title=title, key=key)
+    return {'seconds': time.perf_counter() - started, 'stages': result['timings']['stages'], 'critical_path': result['timings']['critical_path']}
+
+def summarize(runs :List[dict], media_seconds :float) -> dict:
+    def spread(values :List[float]) -> dict:
+        return {'median': round(statistics.median(values), 3), 'min': round(min(values), 3), 'max': round(max(values), 3)}
+    total = [run['seconds'] for run in runs]
+    stages = {}
+    for stage in STAGES:
+        seconds = [run['stages'][stage]['seconds'] for run in runs if 'seconds' in run['stages'].get(stage, {})]
+        if not seconds:
+            continue
+        tokens = [run['stages'][stage].get('prompt_tokens', 0) + run['stages'][stage].get('completion_tokens', 0) for run in runs]
+        stages[stage] = dict(spread(seconds), tokens=round(statistics.median(tokens)))
+        if stage == 'transcribe':
+            # Seconds of video per second of work; above 1 is faster than real time
+            stages[stage]['realtime_factor'] = round(media_seconds / statistics.median(seconds), 2)
+    return {
+        'media_seconds': media_seconds,
+        'runs': len(runs),
+        'end_to_end': dict(spread(total), realtime_factor=round(media_seconds / statistics.median(total), 2)),
+        'stages': stages,
+        'critical_path': runs[-1]['critical_path']
+    }
+
+def compare(current :dict, previous :dict) -> List[str]:
+    lines = [f"Compared with {previous.get('commit') or 'the previous run'}:"]
+    for length, result in current['results'].items():
+        before = previous['results'].get(length)
+        if before is None:
+            continue
+        pairs = [('end_to_end', result['end_to_end'], before['end_to_end'])]
+        pairs += [(stage, result['stages'][stage], before['stages'][stage]) for stage in result['stages'] if stage in before['stages']]
+        for name, now, then in pairs:
+            change = (now['median'] - then['median']) / then['median'] * 100 if then['median'] else 0
+            lines.append(f"  {length:>6}s {name:<12} {then['median']:>9.3f}s -> {now['median']:>9.3f}s ({change:+.1f}%)")
+    return lines
+
+def print_table(results :Dict[str, dict]) -> None:
+    print(f"{'length':>8} {'stage':<12} {'median':>9} {'min':>9} {'max':>9}  extra")
+    for length, result in results.items():
+        rows = [('end_to_end', result['end_to_end'])] + list(result['stages'].items())
+        for name, row in rows:
+            extra = ', '.join(f"{k}={v}" for k, v in row.items() if k not in ('median', 'min', 'max'))
+            print(f"{length + 's':>8} {name:<12} {row['median']:>9.3f} {row['min']:>9.3f} {row['max']:>9.3f}  {extra}")
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline offline on synthetic videos.')
+    parser.add_argument('--lengths', default='30,120,600', help='video lengths in seconds, comma separated')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per length')
+    parser.add_argument('--warmup', type=int, default=1, help='untimed runs first, so model loading and pool start-up are not counted')
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds the fake API takes per call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many extra random seconds per call')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of API calls answered with a 500')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='share of API calls answered with a 429')
+    parser.add_argument('--retry-after', type=float, default=0.5, help='retry-after sent with each 429')
+    parser.add_argument('--words', type=int, default=300, help='words in each generated section')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the fake API, so errors land in the same places every time')
+    parser.add_argument('--whisper-model', default='tiny')
+    parser.add_argument('--transcribe-mode', choices=['single', 'segmented'], default=None)
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'blogarize-bench'), help='fixtures and scratch space')
+    parser.add_argument('--output', help='write the results here as JSON')
+    parser.add_argument('--compare', help='results from an earlier run to compare against')
+    args = parser.parse_args()
+
+    from scripts.fake_openai import FakeOpenAIServer
+    server = FakeOpenAIServer(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after, words=args.words, seed=args.seed).start()
+    # Set before the client is first made so every call goes to the fake server
+    os.environ['OPENAI_BASE_URL'] = server.base_url
+    os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+
+    from scripts.config import config
+    from scripts.log import setup_logging
+    from scripts.openai_client import openai_stats
+    # The log file still gets everything, but the console only shows what went wrong
+    setup_logging(
+        config['LOG_FILE'],
+        level=config['LOG_LEVEL'],
+        console_level='WARNING',
+        max_bytes=config['LOG_MAX_BYTES'],
+        backups=config['LOG_BACKUPS'],
+        max_chars=config['LOG_MAX_CHARS']
+    )
+    config['UPLOAD_FOLDER'] = args.workdir
+    config['WHISPER_MODEL'] = args.whisper_model
+    # Every run has to pay for its completions, or the repeats would only measure the cache
+    config['COMPLETION_CACHE'] = False
+    config['STREAM_TOKENS'] = False
+    if args.transcribe_mode:
+        config['TRANSCRIBE_MODE'] = args.transcribe_mode
+
+    lengths = [int(length) for length in args.lengths.split(',')]
+    fixtures = {length: make_fixture(os.path.join(args.workdir, 'fixtures', f"tone-{length}s.mp4"), length) for length in lengths}
+    for _ in range(args.warmup):
+        run_once(fixtures[min(lengths)], args.workdir)
+
+    results = {}
+    try:
+        for length in lengths:
+            runs = []
+            for i in range(args.repeat):
+                run = run_once(fixtures[length], args.workdir)
+                runs.append(run)
+                print(f"{length}s video, run {i + 1} of {args.repeat}: {run['seconds']:.2f}s", file=sys.stderr, flush=True)
+            results[str(length)] = summarize(runs, length)
+    finally:
+        server.stop()
+
+    report = {
+        'commit': git_commit(),
+        'created': time.time(),
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'settings': {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'workdir')},
+        'config': {k: config.get(k) for k in ('TRANSCRIBE_MODE', 'STAGE_WORKERS', 'SECTION_CONCURRENCY', 'AUDIO_PIPE', 'SUMMARY_CHUNK_TOKENS')},
+        'results': results,
+        'openai': openai_stats()
+    }
+    print_table(results)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            print('\n'.join(compare(report, json.load(f))))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
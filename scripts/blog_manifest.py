@@ -0,0 +1,115 @@
+# Standard library imports
+import os
+import re
+import json
+import hashlib
+import logging
+import threading
+from typing import List, Optional
+
+# Local imports
+from scripts.util import atomic_write
+
+# Section statuses
+SECTION_PENDING = 'pending'
+SECTION_DONE = 'done'
+SECTION_FAILED = 'failed'
+
+_TAG = re.compile(r'<[^>]+>')
+
+def count_html_words(html :str) -> int:
+    # Good enough for a word count without parsing the whole document
+    return len(_TAG.sub(' ', html).split())
+
+class BlogManifest:
+    # Keeps track of a blog post while it's being written: the outline, and for every section its status,
+    # word count and content hash. Each finished section is saved to its own file straight away, so a
+    # crash or a failed call only costs the sections that weren't done yet.
+    def __init__(self, blog_filepath :str):
+        base = os.path.splitext(blog_filepath)[0]
+        self.filepath = base + '-manifest.json'
+        self.sections_dir = base + '-sections'
+        self._lock = threading.Lock()
+        self.outline: List[str] = []
+        self.sections: List[dict] = []
+        if os.path.exists(self.filepath):
+            try:
+                with open(self.filepath, 'r') as f:
+                    data = json.load(f)
+                self.outline = data.get('outline', [])
+                self.sections = data.get('sections', [])
+            except Exception as e:
+                logging.error(f"Could not read the blog manifest {self.filepath}, starting over: {e}")
+
+    def _save(self) -> None:
+        with atomic_write(self.filepath) as f:
+            json.dump({'outline': self.outline, 'sections': self.sections}, f, indent=2)
+
+    def set_outline(self, outline :List[str]) -> None:
+        # A new outline means none of the old sections fit any more
+        with self._lock:
+            self.outline = list(outline)
+            self.sections = [{'title': title, 'status': SECTION_PENDING, 'words': 0, 'sha256': None, 'error': None} for title in outline]
+            os.makedirs(self.sections_dir, exist_ok=True)
+            for name in os.listdir(self.sections_dir):
+                os.remove(os.path.join(self.sections_dir, name))
+            self._save()
+
+    def section_filepath(self, index :int) -> str:
+        return os.path.join(self.sections_dir, f"{index:03d}.html")
+
+    def _read_section(self, index :int) -> Optional[str]:
+        # Only trust a section file if it's exactly what we recorded
+        section = self.sections[index]
+        filepath = self.section_filepath(index)
+        if section['status'] != SECTION_DONE or not os.path.exists(filepath):
+            return None
+        with open(filepath, 'r') as f:
+            content = f.read()
+        if hashlib.sha256(content.encode()).hexdigest() != section['sha256']:
+            logging.warning(f"Blog section {index + 1} ({section['title']}) doesn't match its checksum, it'll be written again")
+            return None
+        return content
+
+    def todo(self) -> List[int]:
+        # Sections that are missing, failed or damaged on disk
+        with self._lock:
+            return [i for i in range(len(self.sections)) if self._read_section(i) is None]
+
+    def section_done(self, index :int, content :str) -> None:
+        with self._lock:
+            os.makedirs(self.sections_dir, exist_ok=True)
+            with open(self.section_filepath(index), 'w') as f:
+                f.write(content)
+            self.sections[index].update(
+                status=SECTION_DONE,
+                words=count_html_words(content),
+                sha256=hashlib.sha256(content.encode()).hexdigest(),
+                error=None
+            )
+            self._save()
+
+    def section_failed(self, index :int, error :str) -> None:
+        with self._lock:
+            self.sections[index].update(status=SECTION_FAILED, error=error)
+            self._save()
+
+    def failed(self) -> List[dict]:
+        with self._lock:
+            return [dict(section, index=i) for i, section in enumerate(self.sections) if section['status'] == SECTION_FAILED]
+
+    def complete(self) -> bool:
+        return bool(self.sections) and not self.todo()
+
+    def words(self) -> int:
+        with self._lock:
+            return sum(section['words'] for section in self.sections if section['status'] == SECTION_DONE)
+
+    def assemble(self, title :str) -> str:
+        # Straight from the section files, in outline order. Anything that failed is left as a comment.
+        with self._lock:
+            parts = [f"<h1>{title}</h1>"]
+            for i, section in enumerate(self.sections):
+                content = self._read_section(i)
+                parts.append(content if content is not None else f"<!-- {section.get('error') or 'Section ' + section['title'] + ' is missing'} -->")
+            return ''.join(parts)
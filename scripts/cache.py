@@ -0,0 +1,247 @@
+# Standard library imports
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from typing import Dict, Optional
+
+# Local imports
+from scripts.store import Store
+from scripts.util import atomic_write, owner_id
+
+# Every stage writes one file into the entry's folder. The names follow the old uploads naming scheme
+# so the functions in processing.py can keep deriving one path from another.
+ARTIFACTS = {
+    'video': 'video.mp4',
+    'audio': 'video.wav',
+    'transcript': 'video.txt',
+    'notes': 'video-notes.md',
+    'summary': 'video.md',
+    'blog': 'video-blog.html',
+    'image': 'video-dalle.png'
+}
+
+def hash_file(filepath :str, chunk_size :int = 1024 * 1024) -> str:
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+class ArtifactCache:
+    # With a store the index lives there, shared by every worker; without one it's index.json in the root
+    def __init__(self, root :str, max_bytes :int = 10 * 1024 ** 3, store :Store = None, pin_seconds :float = 60):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.store = store
+        self.pin_seconds = pin_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # How many times this process has pinned each key; with a store, each key pinned here has one row there
+        self._pinned: Dict[str, int] = {}
+        self._owner = owner_id()
+        self._renewer = None
+        self._lock = threading.RLock()
+        self._index_filepath = os.path.join(root, 'index.json')
+        os.makedirs(root, exist_ok=True)
+        self._index = self._load_index()
+        if store is not None and self._index and not store.artifacts():
+            # First run with a store: bring over what the old index knew about
+            logging.info(f"Moving {len(self._index)} cache entries from {self._index_filepath} into the store")
+            for key, entry in self._index.items():
+                store.put_artifact(key, entry)
+
+    def _load_index(self) -> dict:
+        if not os.path.exists(self._index_filepath):
+            return {}
+        try:
+            with open(self._index_filepath, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            logging.error(f"Could not read the cache index {self._index_filepath}, starting over: {e}")
+            return {}
+
+    def _save_index(self) -> None:
+        with atomic_write(self._index_filepath) as f:
+            json.dump(self._index, f)
+
+    def _get(self, key :str) -> Optional[dict]:
+        if self.store is not None:
+            return self.store.get_artifact(key)
+        return self._index.get(key)
+
+    def _put(self, key :str, entry :dict) -> None:
+        if self.store is not None:
+            self.store.put_artifact(key, entry)
+        else:
+            self._index[key] = entry
+            self._save_index()
+
+    def _delete(self, key :str) -> None:
+        if self.store is not None:
+            self.store.delete_artifact(key)
+        else:
+            self._index.pop(key, None)
+            self._save_index()
+
+    def _entries(self) -> Dict[str, dict]:
+        if self.store is not None:
+            return self.store.artifacts()
+        return dict(self._index)
+
+    @staticmethod
+    def key_for_file(filepath :str) -> str:
+        return f"sha256-{hash_file(filepath)}"
+
+    @staticmethod
+    def key_for_youtube(video_id :str) -> str:
+        return f"yt-{video_id}"
+
+    def entry_dir(self, key :str) -> str:
+        path = os.path.join(self.root, key)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def path(self, key :str, stage :str) -> str:
+        return os.path.join(self.entry_dir(key), ARTIFACTS[stage])
+
+    def meta(self, key :str) -> dict:
+        with self._lock:
+            entry = self._get(key)
+            return dict(entry['meta']) if entry is not None else {}
+
+    def set_meta(self, key :str, **meta) -> None:
+        with self._lock:
+            entry = self._get(key) or self._new_entry()
+            entry['meta'].update(meta)
+            self._put(key, entry)
+
+    @staticmethod
+    def _new_entry() -> dict:
+        return {'stages': [], 'meta': {}, 'size': 0, 'created': time.time(), 'last_used': time.time()}
+
+    def lookup(self, key :str, stage :str) -> Optional[str]:
+        # A stage only counts as done once it has been recorded. Anything else on disk is left over
+        # from a run that didn't finish, so it's removed before the stage runs again.
+        with self._lock:
+            entry = self._get(key)
+            path = self.path(key, stage)
+            if entry is not None and stage in entry['stages'] and os.path.exists(path):
+                self.hits += 1
+                entry['last_used'] = time.time()
+                self._put(key, entry)
+                logging.info(f"Cache hit for {stage} of {key}")
+                return path
+            self.misses += 1
+            if os.path.exists(path):
+                os.remove(path)
+            logging.info(f"Cache miss for {stage} of {key}")
+            return None
+
+    def has(self, key :str, stage :str) -> bool:
+        # Like lookup, but only looks: no hit or miss is counted, nothing is removed and no folder is made
+        # for a key we've never seen (anyone can ask, e.g. with a hash before an upload)
+        with self._lock:
+            entry = self._get(key)
+            return entry is not None and stage in entry['stages'] and os.path.exists(os.path.join(self.root, key, ARTIFACTS[stage]))
+
+    def record(self, key :str, stage :str) -> str:
+        with self._lock:
+            entry = self._get(key) or self._new_entry()
+            if stage not in entry['stages']:
+                entry['stages'].append(stage)
+            entry['size'] = self._entry_size(key)
+            entry['last_used'] = time.time()
+            self._put(key, entry)
+            self.evict()
+            return self.path(key, stage)
+
+    def _entry_size(self, key :str) -> int:
+        size = 0
+        for dirpath, _, filenames in os.walk(os.path.join(self.root, key)):
+            for filename in filenames:
+                size += os.path.getsize(os.path.join(dirpath, filename))
+        return size
+
+    def pin(self, key :str) -> None:
+        # Entries a job is still working on are never evicted, by this process or (through the store) any other
+        with self._lock:
+            self._pinned[key] = self._pinned.get(key, 0) + 1
+            if self.store is not None and self._pinned[key] == 1:
+                self.store.pin_artifact(key, self._owner, self.pin_seconds)
+                if self._renewer is None:
+                    self._renewer = threading.Thread(target=self._renew_pins, name='cache-pins', daemon=True)
+                    self._renewer.start()
+
+    def unpin(self, key :str) -> None:
+        with self._lock:
+            count = self._pinned.get(key, 0) - 1
+            if count > 0:
+                self._pinned[key] = count
+                return
+            self._pinned.pop(key, None)
+            if self.store is not None:
+                self.store.unpin_artifact(key, self._owner)
+
+    def _renew_pins(self) -> None:
+        # Keeps our pins alive while we hold any; if this process dies they run out and the entries can go
+        while True:
+            time.sleep(self.pin_seconds / 3)
+            with self._lock:
+                if not self._pinned:
+                    self._renewer = None
+                    return
+            try:
+                self.store.renew_pins(self._owner, self.pin_seconds)
+            except Exception as e:
+                logging.error(f"Could not renew cache pins: {e}")
+
+    def _pinned_keys(self) -> set:
+        if self.store is not None:
+            return self.store.pinned_artifacts() | set(self._pinned)
+        return set(self._pinned)
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            return sum(entry['size'] for entry in self._entries().values())
+
+    def evict(self) -> None:
+        # Least recently used first, until we're back under the budget
+        with self._lock:
+            entries = self._entries()
+            pinned = self._pinned_keys()
+            total = sum(entry['size'] for entry in entries.values())
+            for key in sorted(entries, key=lambda k: entries[k]['last_used']):
+                if total <= self.max_bytes:
+                    break
+                if key in pinned:
+                    continue
+                if self.store is not None:
+                    # Someone may have pinned it since we looked, so the store has the last word
+                    if not self.store.evict_artifact(key):
+                        continue
+                else:
+                    self._delete(key)
+                total -= entries[key]['size']
+                logging.info(f"Evicting {key} from the cache ({entries[key]['size']} bytes)")
+                shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._entries()
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(entries),
+                'bytes': sum(entry['size'] for entry in entries.values()),
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'evictions': self.evictions,
+                'pinned': len(self._pinned_keys())
+            }
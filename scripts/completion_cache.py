@@ -0,0 +1,149 @@
+# Standard library imports
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from typing import Dict, Optional
+
+# Local imports
+from scripts.util import atomic_write
+
+class CompletionCache:
+    # Chat completions on disk, one small JSON file each, named after a hash of everything that went into the request.
+    # Asking the same thing twice (reprocessing a video, trying a different blog prompt on the same summary)
+    # is answered from here instead of the API. Entries expire after ttl seconds and the least recently
+    # used ones go first when the folder grows past max_bytes.
+    # Every worker process writes to the same folder, so what we've counted ourselves is only a guess at its size.
+    # The folder is measured again whenever a write would take us over max_bytes, and after every tenth of
+    # max_bytes we write, so all the workers together can't run far past the budget.
+    def __init__(self, root :str, max_bytes :int = 256 * 1024 ** 2, ttl :float = 30 * 24 * 3600):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.writes = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+        os.makedirs(root, exist_ok=True)
+        self._bytes = 0
+        self._unmeasured = 0
+        self._measure()
+
+    @staticmethod
+    def key(type :str, system :str, prompt :str, model :str, temperature :float, max_tokens :int, top_p :float) -> str:
+        request = json.dumps([type, system, prompt, model, temperature, max_tokens, top_p])
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    def _path(self, key :str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.json")
+
+    def _files(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith('.json'):
+                    yield os.path.join(dirpath, filename)
+
+    def _measure(self) -> None:
+        total = 0
+        for path in self._files():
+            try:
+                total += os.path.getsize(path)
+            except FileNotFoundError:
+                # Another worker evicted it while we were looking
+                pass
+        self._bytes = total
+        self._unmeasured = 0
+
+    def _remove(self, path :str) -> None:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            self._bytes -= size
+        except FileNotFoundError:
+            pass
+
+    def get(self, key :str) -> Optional[str]:
+        path = self._path(key)
+        with self._lock:
+            try:
+                with open(path, 'r') as f:
+                    entry = json.load(f)
+            except (FileNotFoundError, ValueError):
+                self.misses += 1
+                return None
+            if self.ttl and time.time() - entry['created'] > self.ttl:
+                self._remove(path)
+                self.expired += 1
+                self.misses += 1
+                return None
+            # The file's modification time doubles as its last use, for eviction
+            os.utime(path)
+            self.hits += 1
+            return entry['response']
+
+    def put(self, key :str, response :str, **meta) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._lock:
+            self._remove(path)
+            with atomic_write(path) as f:
+                json.dump(dict(meta, created=time.time(), response=response), f)
+            size = os.path.getsize(path)
+            self._bytes += size
+            self._unmeasured += size
+            self.writes += 1
+            if self._bytes > self.max_bytes or self._unmeasured > self.max_bytes // 10:
+                self._measure()
+                if self._bytes > self.max_bytes:
+                    self.evict()
+
+    def evict(self) -> None:
+        # Least recently used first, until we're back under the budget
+        with self._lock:
+            files = []
+            for path in self._files():
+                try:
+                    files.append((os.path.getmtime(path), path))
+                except FileNotFoundError:
+                    pass
+            for _, path in sorted(files):
+                if self._bytes <= self.max_bytes:
+                    break
+                self._remove(path)
+                self.evictions += 1
+            logging.info(f"Completion cache is down to {self._bytes} bytes")
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'expired': self.expired,
+                'writes': self.writes,
+                'evictions': self.evictions
+            }
+
+_caches: Dict[str, CompletionCache] = {}
+_caches_lock = threading.Lock()
+
+def get_completion_cache(root :str, max_bytes :int = 256 * 1024 ** 2, ttl :float = 30 * 24 * 3600) -> CompletionCache:
+    # One cache per folder per process, opened the first time someone asks for it
+    with _caches_lock:
+        cache = _caches.get(root)
+        if cache is None:
+            cache = CompletionCache(root, max_bytes=max_bytes, ttl=ttl)
+            _caches[root] = cache
+        return cache
+
+def completion_cache_stats() -> Dict[str, dict]:
+    with _caches_lock:
+        return {root: cache.stats() for root, cache in _caches.items()}
@@ -0,0 +1,93 @@
+# Settings shared by the web app, the job workers and the command-line tools. Everything here can be set
+# from the environment (or a .env file); app.py copies it all into Flask's config when it starts.
+# Importing this is cheap, so anything can read the settings without pulling in the app.
+
+# Standard library imports
+import os
+
+# Third-party imports for environment variables
+from dotenv import load_dotenv
+
+load_dotenv()
+
+config = {}
+config['UPLOAD_FOLDER'] = os.path.abspath('./uploads')
+# State that must never be handed out by /download (which serves from UPLOAD_FOLDER) lives here instead
+config['DATA_FOLDER'] = os.path.abspath(os.getenv('BLOGARIZE_DATA_FOLDER', './instance'))
+config['steps'] = {
+    "Init Form": 0,
+    "Downloaded": 12.5,
+    "ConvertedAudio": 25,
+    "Transcribed": 37.5,
+    "Summarized": 50,
+    "Outlined": 62.5,
+    "Content": 75,
+    "HeaderImage": 87.5,
+    "Completed": 100
+}
+# How many videos we work on at once, and how many may wait in line behind them
+config['JOB_WORKERS'] = int(os.getenv('BLOGARIZE_JOB_WORKERS', 2))
+config['JOB_QUEUE_SIZE'] = int(os.getenv('BLOGARIZE_JOB_QUEUE_SIZE', 16))
+# How many pipeline stages of one job may run side by side (e.g. the header image while the blog is written)
+config['STAGE_WORKERS'] = int(os.getenv('BLOGARIZE_STAGE_WORKERS', 2))
+# How many blog sections we ask OpenAI for at the same time
+config['SECTION_CONCURRENCY'] = int(os.getenv('BLOGARIZE_SECTION_CONCURRENCY', 4))
+# 'single' sends the whole file to Whisper at once, 'segmented' splits it at silences and uses a process pool
+config['TRANSCRIBE_MODE'] = os.getenv('BLOGARIZE_TRANSCRIBE_MODE', 'single')
+config['TRANSCRIBE_PROCESSES'] = int(os.getenv('BLOGARIZE_TRANSCRIBE_PROCESSES', os.cpu_count() or 1))
+config['TRANSCRIBE_SEGMENT_SECONDS'] = float(os.getenv('BLOGARIZE_TRANSCRIBE_SEGMENT_SECONDS', 30))
+config['WHISPER_MODEL'] = os.getenv('BLOGARIZE_WHISPER_MODEL', 'base')
+# Pipe the audio track from ffmpeg straight into Whisper instead of writing a WAV first (single mode only)
+config['AUDIO_PIPE'] = os.getenv('BLOGARIZE_AUDIO_PIPE', 'false').lower() == 'true'
+# Stream the summary and blog sections to the job page token by token as they're written
+config['STREAM_TOKENS'] = os.getenv('BLOGARIZE_STREAM_TOKENS', 'true').lower() == 'true'
+# Every open /progress stream holds one of the server's threads for as long as the job runs, so only this many
+# are kept open per process; keep it well under gunicorn's --threads. Past it, job pages poll /jobs/<id> instead.
+config['PROGRESS_STREAMS'] = int(os.getenv('BLOGARIZE_PROGRESS_STREAMS', 16))
+# Cut long silences (intros, pauses, dead air) out of the audio before Whisper sees it. A stretch counts as speech
+# when it's VAD_MARGIN_DB above the recording's noise floor, but never below VAD_MIN_THRESHOLD_DB or above
+# VAD_MAX_THRESHOLD_DB (dBFS); pauses longer than VAD_MIN_SILENCE_SECONDS shrink to twice VAD_PADDING_SECONDS.
+# Transcript timestamps are mapped back onto the original recording.
+config['VAD'] = os.getenv('BLOGARIZE_VAD', 'true').lower() == 'true'
+config['VAD_MARGIN_DB'] = float(os.getenv('BLOGARIZE_VAD_MARGIN_DB', 12))
+config['VAD_MIN_THRESHOLD_DB'] = float(os.getenv('BLOGARIZE_VAD_MIN_THRESHOLD_DB', -55))
+config['VAD_MAX_THRESHOLD_DB'] = float(os.getenv('BLOGARIZE_VAD_MAX_THRESHOLD_DB', -35))
+config['VAD_MIN_SILENCE_SECONDS'] = float(os.getenv('BLOGARIZE_VAD_MIN_SILENCE_SECONDS', 1.0))
+config['VAD_PADDING_SECONDS'] = float(os.getenv('BLOGARIZE_VAD_PADDING_SECONDS', 0.25))
+# Transcripts longer than this many tokens are summarized in chunks, this many chunks at a time
+config['SUMMARY_CHUNK_TOKENS'] = int(os.getenv('BLOGARIZE_SUMMARY_CHUNK_TOKENS', 6000))
+config['SUMMARY_CONCURRENCY'] = int(os.getenv('BLOGARIZE_SUMMARY_CONCURRENCY', 4))
+# Our own limits for OpenAI, shared by every job in a process: requests and tokens per minute, seconds to
+# wait for one call, and how many times a call that hit a rate limit or a server error is tried again.
+# The API key and OPENAI_BASE_URL (e.g. for scripts/fake_openai.py) are read by the openai client as usual.
+config['OPENAI_RPM'] = int(os.getenv('BLOGARIZE_OPENAI_RPM', 500))
+config['OPENAI_TPM'] = int(os.getenv('BLOGARIZE_OPENAI_TPM', 300000))
+config['OPENAI_TIMEOUT'] = float(os.getenv('BLOGARIZE_OPENAI_TIMEOUT', 120))
+config['OPENAI_RETRIES'] = int(os.getenv('BLOGARIZE_OPENAI_RETRIES', 5))
+# Everything we make for a video lives under its content hash (or YouTube ID), within this disk budget
+config['CACHE_FOLDER'] = os.path.join(config['UPLOAD_FOLDER'], 'cache')
+config['CACHE_MAX_BYTES'] = int(os.getenv('BLOGARIZE_CACHE_MAX_BYTES', 10 * 1024 ** 3))
+# Identical OpenAI requests are answered from disk for this long, within this disk budget
+config['COMPLETION_CACHE'] = os.getenv('BLOGARIZE_COMPLETION_CACHE', 'true').lower() == 'true'
+config['COMPLETION_CACHE_FOLDER'] = os.path.join(config['DATA_FOLDER'], 'completions')
+config['COMPLETION_CACHE_MAX_BYTES'] = int(os.getenv('BLOGARIZE_COMPLETION_CACHE_MAX_BYTES', 256 * 1024 ** 2))
+config['COMPLETION_CACHE_TTL'] = float(os.getenv('BLOGARIZE_COMPLETION_CACHE_TTL', 30 * 24 * 3600))
+# Jobs and the cache index live here so every worker (and every instance sharing it) sees the same state.
+# A job whose worker stops renewing its lease is handed to another worker, up to JOB_MAX_ATTEMPTS times.
+config['JOB_STORE'] = os.getenv('BLOGARIZE_JOB_STORE', os.path.join(config['DATA_FOLDER'], 'blogarize.db'))
+config['JOB_LEASE_SECONDS'] = float(os.getenv('BLOGARIZE_JOB_LEASE_SECONDS', 60))
+config['JOB_MAX_ATTEMPTS'] = int(os.getenv('BLOGARIZE_JOB_MAX_ATTEMPTS', 3))
+# Profile every job with cProfile (or just the ones asked for with ?profile=1) and keep the results here
+config['PROFILE_JOBS'] = os.getenv('BLOGARIZE_PROFILE_JOBS', 'false').lower() == 'true'
+config['PROFILE_FOLDER'] = os.path.abspath(os.getenv('BLOGARIZE_PROFILE_FOLDER', './logs/profiles'))
+# Size of each part the browser sends for chunked uploads
+config['UPLOAD_CHUNK_BYTES'] = int(os.getenv('BLOGARIZE_UPLOAD_CHUNK_BYTES', 8 * 1024 * 1024))
+# Everything is logged through a queue so a slow disk never holds up a request or a stage.
+# The file is rotated at LOG_MAX_BYTES, and messages longer than LOG_MAX_CHARS (transcripts, prompts) are cut short.
+# Leave BLOGARIZE_LOG_FILE empty to only log to the console, e.g. when several processes would share one file.
+config['LOG_FILE'] = os.getenv('BLOGARIZE_LOG_FILE', os.path.abspath('./logs/blogarize.log'))
+config['LOG_LEVEL'] = os.getenv('BLOGARIZE_LOG_LEVEL', 'DEBUG').upper()
+config['LOG_CONSOLE_LEVEL'] = os.getenv('BLOGARIZE_LOG_CONSOLE_LEVEL', 'INFO').upper()
+config['LOG_MAX_BYTES'] = int(os.getenv('BLOGARIZE_LOG_MAX_BYTES', 10 * 1024 ** 2))
+config['LOG_BACKUPS'] = int(os.getenv('BLOGARIZE_LOG_BACKUPS', 5))
+config['LOG_MAX_CHARS'] = int(os.getenv('BLOGARIZE_LOG_MAX_CHARS', 2000))
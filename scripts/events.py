@@ -0,0 +1,82 @@
+# Standard library imports
+import queue
+import logging
+import threading
+from typing import Dict, Iterator, List, Optional
+
+# Put on a subscriber's queue when its job is over
+_CLOSED = object()
+
+class EventBus:
+    # Pipeline stages publish here and /progress subscribers get a copy, per job
+    def __init__(self, history :int = 1000):
+        self.history = history
+        self._subscribers: Dict[str, List[queue.Queue]] = {}
+        self._last: Dict[str, dict] = {}
+        self._closed: Dict[str, bool] = {}
+        self._lock = threading.Lock()
+
+    def publish(self, job_id :str, event :dict) -> bool:
+        # Nothing is sent unless something actually changed
+        with self._lock:
+            if self._last.get(job_id) == event:
+                return False
+            self._last[job_id] = dict(event)
+            for subscriber in self._subscribers.get(job_id, []):
+                subscriber.put(event)
+        return True
+
+    def emit(self, job_id :str, event :dict) -> None:
+        # For one-off events like streamed tokens: always sent, never remembered as the job's state
+        with self._lock:
+            for subscriber in self._subscribers.get(job_id, []):
+                subscriber.put(event)
+
+    def close(self, job_id :str) -> None:
+        with self._lock:
+            self._closed[job_id] = True
+            for subscriber in self._subscribers.pop(job_id, []):
+                subscriber.put(_CLOSED)
+            # Keep the final state around for anyone who asks late, but not forever
+            while len(self._closed) > self.history:
+                oldest = next(iter(self._closed))
+                self._closed.pop(oldest)
+                self._last.pop(oldest, None)
+
+    def last(self, job_id :str) -> Optional[dict]:
+        with self._lock:
+            return self._last.get(job_id)
+
+    def listen(self, job_id :str, heartbeat :float = 15) -> Iterator[Optional[dict]]:
+        # Yields the latest state straight away, then every change until the job ends.
+        # None is yielded when nothing happened for `heartbeat` seconds so callers can ping the client.
+        subscriber = queue.Queue()
+        with self._lock:
+            last = self._last.get(job_id)
+            closed = self._closed.get(job_id, False)
+            if not closed:
+                self._subscribers.setdefault(job_id, []).append(subscriber)
+        if last is not None:
+            yield last
+        if closed:
+            return
+        try:
+            while True:
+                try:
+                    event = subscriber.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield None
+                    continue
+                if event is _CLOSED:
+                    return
+                yield event
+        finally:
+            with self._lock:
+                subscribers = self._subscribers.get(job_id, [])
+                if subscriber in subscribers:
+                    subscribers.remove(subscriber)
+            logging.debug(f"Progress listener for job {job_id} went away")
+
+    def subscribers(self) -> int:
+        with self._lock:
+            return sum(len(s) for s in self._subscribers.values())
@@ -0,0 +1,198 @@
+# A stand-in for the OpenAI API so the pipeline can run without a network or an API key.
+# Point the app at it with OPENAI_BASE_URL=http://127.0.0.1:<port>/v1
+#
+#   python -m scripts.fake_openai --port 8901 --latency 0.5 --error-rate 0.1 --rate-limit-rate 0.1
+
+# Standard library imports
+import json
+import time
+import random
+import struct
+import zlib
+import argparse
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def _png(width :int = 16, height :int = 9) -> bytes:
+    # A small grey PNG so the image download has something real to save
+    def chunk(kind :bytes, data :bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    rows = b''.join(b'\x00' + b'\x80\x80\x80' * width for _ in range(height))
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+
+PNG = _png()
+
+class FakeOpenAIServer:
+    def __init__(
+            self,
+            host :str = '127.0.0.1',
+            port :int = 0,
+            latency :float = 0.0,
+            jitter :float = 0.0,
+            error_rate :float = 0.0,
+            rate_limit_rate :float = 0.0,
+            retry_after :float = 1.0,
+            words :int = 300,
+            seed :int = None
+            ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.words = words
+        self.requests = 0
+        self.random = random.Random(seed)
+        self._scripted = []
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> 'FakeOpenAIServer':
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='fake-openai', daemon=True)
+        self._thread.start()
+        logging.info(f"Fake OpenAI API listening on {self.base_url}")
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def fail_next(self, *statuses :int) -> None:
+        # The next calls are answered with these statuses (429, 400 or a 5xx), one each, before the random rolls apply again
+        with self._lock:
+            self._scripted.extend(statuses)
+
+    def _scripted_status(self):
+        with self._lock:
+            return self._scripted.pop(0) if self._scripted else None
+
+    def _roll(self) -> float:
+        with self._lock:
+            self.requests += 1
+            return self.random.random()
+
+    def _delay(self) -> None:
+        with self._lock:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def chat_response(self, body :dict) -> dict:
+        messages = body.get('messages', [])
+        system = next((m['content'] for m in messages if m['role'] == 'system'), '')
+        prompt = ' '.join(m['content'] for m in messages if m['role'] != 'system')
+        if 'list of the sections' in system:
+            content = '\n'.join(f"- {name}" for name in ['Introduction', 'Getting Started', 'The Details', 'What We Learned', 'Conclusion'])
+        else:
+            heading = prompt.split('about ', 1)[-1].split('.', 1)[0][:60] if 'about ' in prompt else 'Summary'
+            content = f"<h2>{heading}</h2>\n<p>" + ' '.join(['lorem'] * self.words) + "</p>"
+        prompt_tokens = len(json.dumps(messages)) // 4
+        completion_tokens = len(content) // 4
+        return {
+            'id': f"chatcmpl-fake-{self.requests}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'fake'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}
+        }
+
+    def chat_stream(self, body :dict):
+        # The same answer as chat_response, a few words per chunk, the way stream=True sends it
+        response = self.chat_response(body)
+        words = response['choices'][0]['message']['content'].split(' ')
+        base = {k: response[k] for k in ('id', 'created', 'model')}
+        base['object'] = 'chat.completion.chunk'
+        for i in range(0, len(words), 5):
+            text = ' '.join(words[i:i + 5]) + (' ' if i + 5 < len(words) else '')
+            yield dict(base, choices=[{'index': 0, 'delta': {'content': text}, 'finish_reason': None}])
+        yield dict(base, choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop'}])
+        if body.get('stream_options', {}).get('include_usage'):
+            yield dict(base, choices=[], usage=response['usage'])
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                logging.debug(f"fake_openai: {format % args}")
+
+            def _send(self, status :int, payload, content_type :str = 'application/json', headers :dict = None) -> None:
+                data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path.startswith('/images/'):
+                    self._send(200, PNG, content_type='image/png')
+                else:
+                    self._send(404, {'error': {'message': f"Unknown path {self.path}"}})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length) or b'{}')
+                server._delay()
+                roll = server._roll()
+                status = server._scripted_status()
+                if status == 400:
+                    self._send(400, {'error': {'message': 'Invalid request (fake)', 'type': 'invalid_request_error'}})
+                    return
+                if status is not None and status != 429:
+                    self._send(status, {'error': {'message': 'The server had an error (fake)', 'type': 'server_error'}})
+                    return
+                if status == 429 or roll < server.rate_limit_rate:
+                    self._send(429, {'error': {'message': 'Rate limit reached (fake)', 'type': 'requests', 'code': 'rate_limit_exceeded'}}, headers={'retry-after': str(server.retry_after)})
+                    return
+                if roll < server.rate_limit_rate + server.error_rate:
+                    self._send(500, {'error': {'message': 'The server had an error (fake)', 'type': 'server_error'}})
+                    return
+                if self.path.endswith('/chat/completions') and body.get('stream'):
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/event-stream')
+                    self.send_header('Connection', 'close')
+                    self.end_headers()
+                    for chunk in server.chat_stream(body):
+                        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                        self.wfile.flush()
+                    self.wfile.write(b"data: [DONE]\n\n")
+                    self.close_connection = True
+                elif self.path.endswith('/chat/completions'):
+                    self._send(200, server.chat_response(body))
+                elif self.path.endswith('/images/generations'):
+                    host, port = server.httpd.server_address[:2]
+                    self._send(200, {'created': int(time.time()), 'data': [{'url': f"http://{host}:{port}/images/fake-{server.requests}.png"}]})
+                else:
+                    self._send(404, {'error': {'message': f"Unknown path {self.path}"}})
+
+        return Handler
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a fake OpenAI API for local testing.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8901)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many extra random seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of calls answered with a 500')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='share of calls answered with a 429')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='retry-after sent with each 429')
+    parser.add_argument('--words', type=int, default=300, help='words in each generated section')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server = FakeOpenAIServer(args.host, args.port, args.latency, args.jitter, args.error_rate, args.rate_limit_rate, args.retry_after, args.words)
+    print(f"Fake OpenAI API on {server.base_url}")
+    server.httpd.serve_forever()
@@ -0,0 +1,304 @@
+# Standard library imports
+import os
+import time
+import uuid
+import logging
+import threading
+import contextvars
+from typing import Any, Callable, Dict, Iterator, Optional
+
+# Local imports
+from scripts.events import EventBus
+from scripts.util import owner_id
+from scripts.metrics import JobProfile, profiling
+from scripts.store import Store, JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED
+
+# A context variable rather than a thread local, so stages running on other threads can carry it along
+_current = contextvars.ContextVar('current_job', default=None)
+
+# Every job's progress goes through here on its way to the /progress/<job_id> listeners
+events = EventBus()
+
+# What's kept in the store for every job, besides its id
+_FIELDS = ('task', 'params', 'label', 'dedup_key', 'status', 'progress', 'current_step', 'partial_transcript', 'result', 'error', 'warnings',
+           'profile', 'profile_filepath', 'worker', 'attempts', 'created', 'started', 'finished')
+
+class JobQueueFull(Exception):
+    pass
+
+class LeaseLost(Exception):
+    # The job's lease ran out and another worker has it now, so this one has to stop working on it
+    pass
+
+class Job:
+    def __init__(self, job_id :str, label :str = None, profile :bool = False, store :Store = None, worker :str = None):
+        self.id = job_id
+        self.label = label
+        self.task = None
+        self.params = None
+        self.dedup_key = None
+        self.profile = profile
+        self.profile_filepath = None
+        self.status = JOB_QUEUED
+        self.progress = 0
+        self.current_step = 'Waiting for a free worker.'
+        self.partial_transcript = None
+        self.result = None
+        self.error = None
+        # Things that went wrong without failing the job
+        self.warnings = []
+        self.attempts = 0
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.worker = worker
+        # Set once another worker has taken the job over
+        self.lost = False
+        self._store = store
+
+    @classmethod
+    def from_record(cls, record :dict, store :Store = None) -> 'Job':
+        job = cls(record['id'], store=store)
+        for name in _FIELDS:
+            setattr(job, name, record.get(name))
+        job.warnings = job.warnings or []
+        return job
+
+    def record(self) -> dict:
+        return dict({name: getattr(self, name) for name in _FIELDS}, id=self.id)
+
+    def state(self) -> dict:
+        # What the /progress listeners get
+        return {'status': self.status, 'progress': self.progress, 'current_step': self.current_step, 'error': self.error, 'warnings': self.warnings}
+
+    def update(self, **fields) -> None:
+        # Change the job, save it for the other workers and let anyone watching know.
+        # The partial transcript only goes out when it changes.
+        # A leased job is only saved while its worker still holds it; otherwise this raises LeaseLost.
+        if self.lost:
+            raise LeaseLost(f"Job {self.id} is no longer held by {self.worker}")
+        if self._store is not None and fields:
+            if not self._store.update_job(self.id, worker=self.worker, **fields):
+                self.lost = True
+                raise LeaseLost(f"Job {self.id} is no longer held by {self.worker}")
+        partial = fields.get('partial_transcript')
+        for name, value in fields.items():
+            setattr(self, name, value)
+        event = self.state()
+        if partial is not None:
+            event['partial_transcript'] = partial
+        events.publish(self.id, event)
+
+    def warn(self, message :str) -> None:
+        self.update(warnings=self.warnings + [message])
+
+    def emit(self, event :dict) -> None:
+        events.emit(self.id, event)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'id': self.id,
+            'label': self.label,
+            'status': self.status,
+            'progress': self.progress,
+            'current_step': self.current_step,
+            'partial_transcript': self.partial_transcript,
+            'timings': self.result.get('timings') if isinstance(self.result, dict) else None,
+            'error': self.error,
+            'warnings': self.warnings,
+            'profile': self.profile_filepath is not None,
+            'worker': self.worker,
+            'attempts': self.attempts,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished
+        }
+
+class JobManager:
+    # Jobs are kept in the store and run by whichever worker leases them first, so any gunicorn worker
+    # (or any instance sharing the store) can take a job, report on it, or pick it up again after a crash.
+    # Only data goes into the store, so what a job does is looked up by task name in every worker.
+    def __init__(
+            self,
+            store :Store,
+            max_workers :int = 2,
+            max_pending :int = 16,
+            retention :int = 3600,
+            profile_folder :str = 'logs/profiles',
+            lease_seconds :float = 60,
+            max_attempts :int = 3,
+            poll_interval :float = 1.0
+            ):
+        self.store = store
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.retention = retention
+        self.profile_folder = profile_folder
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.worker_id = owner_id()
+        self._tasks: Dict[str, Callable] = {}
+        self._running: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._threads = []
+
+    def register(self, task :str, fn :Callable) -> None:
+        self._tasks[task] = fn
+
+    def start(self) -> None:
+        # Separate from __init__ so every task is registered before anything is leased
+        if self._threads:
+            return
+        for i in range(self.max_workers):
+            thread = threading.Thread(target=self._work, name=f"blogarize-job-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        thread = threading.Thread(target=self._heartbeat, name='blogarize-job-leases', daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        logging.info(f"Job worker {self.worker_id} started with {self.max_workers} threads and room for {self.max_pending} pending jobs.")
+
+    def pending(self) -> int:
+        return self.store.count_jobs([JOB_QUEUED, JOB_RUNNING])
+
+    def submit(self, task :str, label :str = None, profile :bool = False, dedup_key :str = None, **params) -> Job:
+        # The same input asked for twice while the first is still going gets the first job back
+        if task not in self._tasks:
+            raise ValueError(f"Unknown task: {task}")
+        # Refuse new work rather than letting the backlog grow without limit
+        if self.pending() >= self.max_pending:
+            raise JobQueueFull(f"There are already {self.max_pending} jobs waiting. Please try again later.")
+        job = Job(uuid.uuid4().hex, label=label, profile=profile, store=self.store)
+        job.task = task
+        job.params = params
+        job.dedup_key = dedup_key
+        record, created = self.store.create_job(job.record())
+        if not created:
+            logging.info(f"{label} is already being worked on as job {record['id']}")
+            return Job.from_record(record, store=self.store)
+        self.store.prune_jobs(time.time() - self.retention)
+        logging.info(f"Queued job {job.id} ({label})")
+        self._wake.set()
+        return job
+
+    def get(self, job_id :str) -> Optional[Job]:
+        # Our own running jobs are the freshest copy; everything else comes from the store
+        with self._lock:
+            job = self._running.get(job_id)
+        if job is not None:
+            return job
+        record = self.store.get_job(job_id)
+        return Job.from_record(record, store=self.store) if record is not None else None
+
+    def _work(self) -> None:
+        while True:
+            try:
+                record = self.store.lease_job(self.worker_id, self.lease_seconds, self.max_attempts)
+            except Exception as e:
+                logging.error(f"Could not lease a job: {e}")
+                record = None
+            if record is None:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            job = Job.from_record(record, store=self.store)
+            with self._lock:
+                self._running[job.id] = job
+            try:
+                self._run(job)
+            finally:
+                with self._lock:
+                    self._running.pop(job.id, None)
+
+    def _heartbeat(self) -> None:
+        # Keep our leases fresh; a worker that stops doing this loses its jobs to the others
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            with self._lock:
+                running = dict(self._running)
+            try:
+                held = set(self.store.renew_leases(self.worker_id, running, self.lease_seconds))
+            except Exception as e:
+                logging.error(f"Could not renew job leases: {e}")
+                continue
+            for job_id, job in running.items():
+                if job_id not in held and not job.lost:
+                    # We stalled for longer than the lease; the job's next update stops it
+                    logging.warning(f"Lost the lease on job {job_id} to another worker")
+                    job.lost = True
+
+    @staticmethod
+    def _settle(job :Job, **fields) -> None:
+        # Bookkeeping after the task has run. A job that was taken over is the new worker's to report on.
+        try:
+            job.update(**fields)
+        except LeaseLost:
+            pass
+
+    def _run(self, job :Job) -> None:
+        token = _current.set(job)
+        logging.info(f"Running job {job.id} (attempt {job.attempts})")
+        profile = JobProfile() if job.profile else None
+        try:
+            job.update(status=JOB_RUNNING, warnings=[], current_step='Starting.' if job.attempts <= 1 else f"Starting again (attempt {job.attempts}).")
+            fn = self._tasks[job.task]
+            if profile is not None:
+                with profiling(profile):
+                    result = fn(**job.params)
+            else:
+                result = fn(**job.params)
+            job.update(result=result, status=JOB_DONE, progress=100, current_step='Completed.')
+        except LeaseLost:
+            pass
+        except Exception as e:
+            logging.error(f"Job {job.id} failed: {e}")
+            self._settle(job, status=JOB_FAILED, error=str(e), current_step='Failed.')
+        finally:
+            if profile is not None and not job.lost:
+                try:
+                    self._settle(job, profile_filepath=profile.dump(os.path.join(self.profile_folder, f"{job.id}.prof")))
+                    logging.info(f"Profile for job {job.id} written to {job.profile_filepath}")
+                except Exception as e:
+                    logging.error(f"Could not write the profile for job {job.id}: {e}")
+            self._settle(job, finished=time.time())
+            _current.reset(token)
+            if job.lost:
+                # Anyone watching here carries on from the store, following the worker that has it now
+                logging.warning(f"Stopped job {job.id}: another worker took it over after our lease ran out")
+            else:
+                events.close(job.id)
+                self.store.update_job(job.id, worker=self.worker_id, lease_until=None)
+                logging.info(f"Job {job.id} finished as {job.status} in {job.finished - job.started:.1f}s")
+
+    def watch(self, job_id :str, heartbeat :float = 15) -> Iterator[Optional[dict]]:
+        # Events straight from the bus while this worker runs the job. Otherwise (queued, or running
+        # somewhere else) the store is checked every poll_interval and changes are passed on.
+        # None is yielded when nothing happened for `heartbeat` seconds so callers can ping the client.
+        last = None
+        quiet = 0.0
+        for event in events.listen(job_id, heartbeat=self.poll_interval):
+            if event is not None:
+                if event.get('type') != 'token':
+                    last = {k: event.get(k) for k in ('status', 'progress', 'current_step', 'error', 'warnings')}
+                quiet = 0.0
+                yield event
+                continue
+            job = self.get(job_id)
+            if job is None:
+                return
+            if job.state() != last:
+                last = job.state()
+                quiet = 0.0
+                yield dict(last, partial_transcript=job.partial_transcript) if job.partial_transcript else last
+            if job.status in (JOB_DONE, JOB_FAILED):
+                return
+            quiet += self.poll_interval
+            if quiet >= heartbeat:
+                quiet = 0.0
+                yield None
+
+def current_job() -> Optional[Job]:
+    # The job being run by this worker thread, if any
+    return _current.get()
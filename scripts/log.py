@@ -0,0 +1,104 @@
+# Standard library imports
+import os
+import queue
+import atexit
+import logging
+import logging.handlers
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(lineno)d - %(funcName)s - %(message)s'
+
+# Set by setup_logging, once per process
+_listener = None
+
+class TruncatingFilter(logging.Filter):
+    # Cuts long messages short before they're queued, so a transcript or a prompt doesn't end up in the log whole
+    def __init__(self, max_chars :int = 2000):
+        super().__init__()
+        self.max_chars = max_chars
+
+    def filter(self, record :logging.LogRecord) -> bool:
+        if self.max_chars:
+            message = record.getMessage()
+            if len(message) > self.max_chars:
+                record.msg = f"{message[:self.max_chars]}... [{len(message) - self.max_chars} more characters]"
+                record.args = None
+        return True
+
+class _Forward(logging.Handler):
+    # Hands records logged by another process to this process's loggers, as if they'd been logged here
+    def emit(self, record :logging.LogRecord) -> None:
+        logging.getLogger(record.name).handle(record)
+
+def _queue_handler(log_queue, max_chars :int) -> logging.Handler:
+    handler = logging.handlers.QueueHandler(log_queue)
+    handler.addFilter(TruncatingFilter(max_chars))
+    return handler
+
+def setup_logging(
+        filepath :Optional[str] = 'logs/blogarize.log',
+        level :str = 'DEBUG',
+        console_level :str = 'INFO',
+        max_bytes :int = 10 * 1024 ** 2,
+        backups :int = 5,
+        max_chars :int = 2000
+        ) -> None:
+    # Everything that logs only puts the record on a queue; one thread writes them to the console and the
+    # (rotating) log file. Calling this again does nothing, so every entry point can call it.
+    global _listener
+    if _listener is not None:
+        return
+    formatter = logging.Formatter(FORMAT)
+    console = logging.StreamHandler()
+    console.setLevel(console_level)
+    console.setFormatter(formatter)
+    handlers = [console]
+    if filepath:
+        if os.path.dirname(filepath):
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        # Appends, so a restart (or a second process starting) doesn't wipe what's there
+        file = logging.handlers.RotatingFileHandler(filepath, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+        file.setLevel(level)
+        file.setFormatter(formatter)
+        handlers.append(file)
+    log_queue = queue.Queue(-1)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    queue_handler = _queue_handler(log_queue, max_chars)
+    root.addHandler(queue_handler)
+    # Low enough for whichever handler wants the most
+    root.setLevel(min(handler.level for handler in handlers))
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_stop, queue_handler)
+
+def _stop(queue_handler :logging.Handler) -> None:
+    # Whatever is still queued is written before the process exits. Anything logged after this (clients
+    # closing while Python shuts down) can't be queued any more and falls back to logging's last resort.
+    logging.getLogger().removeHandler(queue_handler)
+    _listener.stop()
+
+def log_to_queue(log_queue, level :int = logging.DEBUG, max_chars :int = 2000) -> None:
+    # For worker processes: everything goes back to the parent through log_queue
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    queue_handler = _queue_handler(log_queue, max_chars)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    # Same as _stop: nothing can be queued while Python shuts down
+    atexit.register(root.removeHandler, queue_handler)
+
+@contextmanager
+def child_logging(context) -> Iterator[object]:
+    # A queue for child processes to log into (see log_to_queue); their records go through this process's
+    # handlers until the block ends
+    log_queue = context.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, _Forward())
+    listener.start()
+    try:
+        yield log_queue
+    finally:
+        listener.stop()
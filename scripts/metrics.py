@@ -0,0 +1,235 @@
+# Standard library imports
+import io
+import os
+import sys
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Peak memory comes from getrusage, which isn't there on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Upper bounds in seconds. Stages range from a cache hit to a long Whisper run, OpenAI calls from a second to a few minutes.
+STAGE_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+REQUEST_BUCKETS = (0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+class Registry:
+    # Counters, gauges and histograms in the Prometheus text format. Labels are passed as keyword arguments.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help: Dict[str, Tuple[str, str]] = {}
+        self._values: Dict[str, Dict[tuple, float]] = {}
+        self._histograms: Dict[str, Dict[tuple, list]] = {}
+        self._buckets: Dict[str, tuple] = {}
+
+    def inc(self, name :str, help :str, value :float = 1, **labels) -> None:
+        with self._lock:
+            self._help.setdefault(name, ('counter', help))
+            series = self._values.setdefault(name, {})
+            key = tuple(sorted(labels.items()))
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name :str, help :str, value :float, **labels) -> None:
+        with self._lock:
+            self._help.setdefault(name, ('gauge', help))
+            self._values.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    def observe(self, name :str, help :str, value :float, buckets :tuple = STAGE_BUCKETS, **labels) -> None:
+        with self._lock:
+            self._help.setdefault(name, ('histogram', help))
+            buckets = self._buckets.setdefault(name, buckets)
+            # One count per bucket, then the sum and the total count
+            series = self._histograms.setdefault(name, {}).setdefault(tuple(sorted(labels.items())), [0] * len(buckets) + [0.0, 0])
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @staticmethod
+    def _labels(key :tuple, extra :tuple = ()) -> str:
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{str(value)}"' for name, value in pairs) + '}'
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, (kind, help) in sorted(self._help.items()):
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                if kind == 'histogram':
+                    buckets = self._buckets[name]
+                    for key, series in self._histograms[name].items():
+                        for bound, count in zip(buckets, series):
+                            lines.append(f"{name}_bucket{self._labels(key, (('le', bound),))} {count}")
+                        lines.append(f"{name}_bucket{self._labels(key, (('le', '+Inf'),))} {series[-1]}")
+                        lines.append(f"{name}_sum{self._labels(key)} {series[-2]}")
+                        lines.append(f"{name}_count{self._labels(key)} {series[-1]}")
+                else:
+                    for key, value in self._values[name].items():
+                        lines.append(f"{name}{self._labels(key)} {value}")
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+def peak_rss_bytes(children :bool = False) -> Optional[int]:
+    # High-water mark for the process (or the ffmpeg and Whisper processes it started), not the current size
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # Linux reports kilobytes, macOS bytes
+    return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+
+def file_bytes(*filepaths :str) -> int:
+    return sum(os.path.getsize(path) for path in filepaths if path and os.path.exists(path))
+
+class StageRecord:
+    # What one run of one stage cost. Tokens and bytes are added by whoever does the work, on any thread
+    # that carried the stage's context along.
+    def __init__(self, name :str):
+        self.name = name
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.peak_rss_bytes = None
+        self._lock = threading.Lock()
+
+    def add(self, **amounts) -> None:
+        with self._lock:
+            for name, amount in amounts.items():
+                setattr(self, name, getattr(self, name) + amount)
+
+    def summary(self) -> dict:
+        return {
+            'cpu_seconds': self.cpu_seconds,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'peak_rss_bytes': self.peak_rss_bytes
+        }
+
+class JobProfile:
+    # cProfile only sees the thread it was started on, so every stage thread of the job gets its own
+    # profiler and they're merged when the job is done
+    def __init__(self):
+        self._profilers: List[cProfile.Profile] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def thread(self) -> Iterator[None]:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Another profiler is already running on this thread
+            logging.warning(f"Could not profile this thread: {e}")
+            yield
+            return
+        try:
+            yield
+        finally:
+            profiler.disable()
+            with self._lock:
+                self._profilers.append(profiler)
+
+    def dump(self, filepath :str, top :int = 40) -> Optional[str]:
+        # Writes the raw stats (for snakeviz and friends) and a plain text top list next to them
+        with self._lock:
+            profilers = list(self._profilers)
+        if not profilers:
+            return None
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        stats = pstats.Stats(profilers[0])
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+        stats.dump_stats(filepath)
+        text = io.StringIO()
+        pstats.Stats(filepath, stream=text).sort_stats('cumulative').print_stats(top)
+        text_filepath = os.path.splitext(filepath)[0] + '.txt'
+        with open(text_filepath, 'w') as f:
+            f.write(text.getvalue())
+        return text_filepath
+
+_stage = contextvars.ContextVar('stage_record', default=None)
+_profile = contextvars.ContextVar('job_profile', default=None)
+
+@contextmanager
+def profiling(profile :JobProfile) -> Iterator[JobProfile]:
+    # Every stage measured inside this block (on this thread or one that copied its context) is profiled too
+    token = _profile.set(profile)
+    try:
+        with profile.thread():
+            yield profile
+    finally:
+        _profile.reset(token)
+
+@contextmanager
+def measure_stage(name :str) -> Iterator[StageRecord]:
+    # CPU time is for this thread only; work handed to the Whisper thread or to other processes shows up
+    # in their wall time here and in the process-wide numbers, not in the stage's CPU seconds
+    record = StageRecord(name)
+    token = _stage.set(record)
+    profile = _profile.get()
+    started = time.perf_counter()
+    cpu_started = time.thread_time()
+    try:
+        if profile is not None:
+            with profile.thread():
+                yield record
+        else:
+            yield record
+    except Exception:
+        registry.inc('blogarize_stage_failures_total', 'Pipeline stages that raised', stage=name)
+        raise
+    finally:
+        _stage.reset(token)
+        record.wall_seconds = time.perf_counter() - started
+        record.cpu_seconds = time.thread_time() - cpu_started
+        record.peak_rss_bytes = peak_rss_bytes()
+        registry.observe('blogarize_stage_seconds', 'Wall time of pipeline stages', record.wall_seconds, stage=name)
+        registry.inc('blogarize_stage_cpu_seconds_total', 'CPU time spent on the thread running each stage', record.cpu_seconds, stage=name)
+        registry.inc('blogarize_stage_bytes_in_total', 'Bytes read by pipeline stages', record.bytes_in, stage=name)
+        registry.inc('blogarize_stage_bytes_out_total', 'Bytes written by pipeline stages', record.bytes_out, stage=name)
+        registry.inc('blogarize_stage_tokens_total', 'OpenAI tokens used by pipeline stages', record.prompt_tokens, stage=name, kind='prompt')
+        registry.inc('blogarize_stage_tokens_total', 'OpenAI tokens used by pipeline stages', record.completion_tokens, stage=name, kind='completion')
+
+def record_bytes(read :int = 0, written :int = 0) -> None:
+    record = _stage.get()
+    if record is not None:
+        record.add(bytes_in=read, bytes_out=written)
+
+def record_tokens(prompt :int = 0, completion :int = 0) -> None:
+    record = _stage.get()
+    if record is not None:
+        record.add(prompt_tokens=prompt, completion_tokens=completion)
+
+def record_trimmed_audio(original_seconds :float, removed_seconds :float) -> None:
+    registry.inc('blogarize_audio_seconds_total', 'Seconds of audio sent for transcription, before silence was trimmed', original_seconds)
+    registry.inc('blogarize_audio_trimmed_seconds_total', 'Seconds of silence trimmed before transcription', removed_seconds)
+
+def observe_request(kind :str, seconds :float, error :bool = False) -> None:
+    registry.observe('blogarize_openai_request_seconds', 'Latency of OpenAI calls, without time spent queued for the rate limits', seconds, buckets=REQUEST_BUCKETS, kind=kind)
+    if error:
+        registry.inc('blogarize_openai_errors_total', 'OpenAI calls that failed for good', kind=kind)
+
+def render_metrics() -> str:
+    # Memory is sampled when someone asks rather than tracked as it happens
+    rss = peak_rss_bytes()
+    if rss is not None:
+        registry.set('blogarize_peak_rss_bytes', 'Peak resident memory of this process', rss)
+        registry.set('blogarize_children_peak_rss_bytes', 'Peak resident memory of the largest finished child process', peak_rss_bytes(children=True))
+    return registry.render()
@@ -0,0 +1,316 @@
+# Standard library imports
+import os
+import re
+import time
+import random
+import logging
+import threading
+from typing import Callable, Dict, List, Optional
+
+# Third-party imports for web and file handling
+import requests
+
+# Third-party imports for AI
+import openai
+from openai import OpenAI
+
+# Local imports
+from scripts.config import config
+from scripts.metrics import observe_request, record_tokens
+
+# Errors worth waiting out. Anything else (bad request, auth, ...) won't get better by retrying.
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+class RateLimiter:
+    # Two token buckets shared by every job in the process: requests per minute and tokens per minute.
+    # A 429 from the server pauses everyone, not just the caller who got it.
+    def __init__(self, requests_per_minute :int = 500, tokens_per_minute :int = 300000):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._condition = threading.Condition()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    def acquire(self, tokens :int) -> float:
+        # Blocks until there is room for one more request of this size. Returns how long we waited.
+        tokens = min(tokens, self.tokens_per_minute)
+        started = time.monotonic()
+        with self._condition:
+            while True:
+                self._refill()
+                wait = self._paused_until - time.monotonic()
+                if wait <= 0:
+                    if self._requests >= 1 and self._tokens >= tokens:
+                        self._requests -= 1
+                        self._tokens -= tokens
+                        return time.monotonic() - started
+                    missing_requests = max(0, 1 - self._requests) * 60 / self.requests_per_minute
+                    missing_tokens = max(0, tokens - self._tokens) * 60 / self.tokens_per_minute
+                    wait = max(missing_requests, missing_tokens)
+                self._condition.wait(timeout=max(wait, 0.01))
+
+    def settle(self, estimated :int, actual :int) -> None:
+        # Give back what we over-estimated, or take what we under-estimated
+        with self._condition:
+            self._tokens = min(self.tokens_per_minute, self._tokens + estimated - actual)
+            self._condition.notify_all()
+
+    def pause(self, seconds :float) -> None:
+        with self._condition:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+class OpenAIStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, float]] = {}
+
+    def record(self, kind :str, latency :float = 0.0, queued :float = 0.0, prompt_tokens :int = 0, completion_tokens :int = 0, retries :int = 0, error :bool = False) -> None:
+        with self._lock:
+            stats = self._stats.setdefault(kind, {
+                'calls': 0, 'errors': 0, 'retries': 0,
+                'latency_seconds': 0.0, 'max_latency_seconds': 0.0, 'queued_seconds': 0.0,
+                'prompt_tokens': 0, 'completion_tokens': 0
+            })
+            stats['calls'] += 1
+            stats['errors'] += int(error)
+            stats['retries'] += retries
+            stats['latency_seconds'] += latency
+            stats['max_latency_seconds'] = max(stats['max_latency_seconds'], latency)
+            stats['queued_seconds'] += queued
+            stats['prompt_tokens'] += prompt_tokens
+            stats['completion_tokens'] += completion_tokens
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            snapshot = {}
+            for kind, stats in self._stats.items():
+                snapshot[kind] = dict(stats)
+                snapshot[kind]['avg_latency_seconds'] = round(stats['latency_seconds'] / stats['calls'], 3) if stats['calls'] else None
+            return snapshot
+
+_client = None
+_session = None
+_client_lock = threading.Lock()
+
+limiter = RateLimiter(requests_per_minute=config['OPENAI_RPM'], tokens_per_minute=config['OPENAI_TPM'])
+stats = OpenAIStats()
+
+def get_client() -> OpenAI:
+    # One client per process so every call reuses the same pool of keep-alive connections.
+    # OPENAI_BASE_URL points it somewhere else, e.g. the fake server in scripts/fake_openai.py.
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = OpenAI(
+                api_key=os.getenv('OPENAI_API_KEY'),
+                base_url=os.getenv('OPENAI_BASE_URL') or None,
+                timeout=config['OPENAI_TIMEOUT'],
+                max_retries=0  # retries are ours, so they go through the shared limiter
+            )
+        return _client
+
+def get_session() -> requests.Session:
+    # For downloading generated images, same idea: keep the connections around
+    global _session
+    with _client_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+def _parse_duration(value :str) -> Optional[float]:
+    # Handles '20', '1.5', '250ms' and the '6m0s' style OpenAI uses in its x-ratelimit-reset headers
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    total = 0.0
+    found = False
+    for amount, unit in re.findall(r'([\d.]+)(ms|s|m|h)', value):
+        found = True
+        total += float(amount) * {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}[unit]
+    return total if found else None
+
+def retry_hint(error :Exception) -> Optional[float]:
+    # What the server asked us to wait. The x-ratelimit-reset headers say when a rate limit window ends,
+    # which only matters when that limit is what we hit; they come with every response, 5xx included.
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    milliseconds = _parse_duration(headers.get('retry-after-ms'))
+    if milliseconds is not None:
+        return milliseconds / 1000
+    names = ['retry-after']
+    if isinstance(error, openai.RateLimitError):
+        names += ['x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens']
+    for header in names:
+        seconds = _parse_duration(headers.get(header))
+        if seconds is not None:
+            return seconds
+    return None
+
+def call_with_retries(
+        kind :str,
+        call :Callable,
+        estimated_tokens :int = 0,
+        max_retries :int = None,
+        base_delay :float = 1.0,
+        max_delay :float = 60.0
+        ):
+    if max_retries is None:
+        max_retries = config['OPENAI_RETRIES']
+    retries = 0
+    while True:
+        queued = limiter.acquire(estimated_tokens)
+        started = time.perf_counter()
+        try:
+            response = call()
+        except RETRYABLE_ERRORS as e:
+            latency = time.perf_counter() - started
+            limiter.settle(estimated_tokens, 0)
+            if retries >= max_retries:
+                stats.record(kind, latency=latency, queued=queued, retries=retries, error=True)
+                observe_request(kind, latency, error=True)
+                raise
+            hint = retry_hint(e)
+            # Never longer than max_delay, whatever the server says; a reset of '6m0s' would hold a worker thread for six minutes
+            delay = min(max_delay, hint) if hint is not None else min(max_delay, base_delay * 2 ** retries) * (0.5 + random.random() / 2)
+            if isinstance(e, openai.RateLimitError):
+                limiter.pause(delay)
+            retries += 1
+            logging.info(f"OpenAI {kind} call failed ({type(e).__name__}), retry {retries} of {max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+        except Exception:
+            limiter.settle(estimated_tokens, 0)
+            stats.record(kind, latency=time.perf_counter() - started, queued=queued, retries=retries, error=True)
+            observe_request(kind, time.perf_counter() - started, error=True)
+            raise
+        latency = time.perf_counter() - started
+        usage = getattr(response, 'usage', None)
+        prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+        completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+        if usage is not None:
+            limiter.settle(estimated_tokens, prompt_tokens + completion_tokens)
+        stats.record(kind, latency=latency, queued=queued, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, retries=retries)
+        observe_request(kind, latency)
+        record_tokens(prompt_tokens, completion_tokens)
+        logging.info(f"OpenAI {kind} call took {latency:.2f}s (queued {queued:.2f}s, {prompt_tokens}+{completion_tokens} tokens, {retries} retries)")
+        return response
+
+def estimate_tokens(messages :List[dict], max_tokens :int) -> int:
+    # About four characters a token is close enough for budgeting
+    return sum(len(m['content']) for m in messages) // 4 + max_tokens
+
+def chat_completion(
+        messages :List[dict],
+        model :str = "gpt-4-turbo-preview",
+        temperature :float = 0.3,
+        max_tokens :int = 2500,
+        top_p :float = 1.0
+        ) -> str:
+    response = call_with_retries(
+        'chat',
+        lambda: get_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            top_p=top_p
+        ),
+        estimated_tokens=estimate_tokens(messages, max_tokens)
+    )
+    return response.choices[0].message.content
+
+def chat_completion_stream(
+        messages :List[dict],
+        on_token :Callable[[str], None],
+        model :str = "gpt-4-turbo-preview",
+        temperature :float = 0.3,
+        max_tokens :int = 2500,
+        top_p :float = 1.0
+        ) -> str:
+    # Same as chat_completion, but every piece of text is handed to on_token as soon as it arrives.
+    # Only opening the stream is retried; once tokens have gone out a failure is passed on to the caller.
+    estimated_tokens = estimate_tokens(messages, max_tokens)
+    stream = call_with_retries(
+        'chat-stream',
+        lambda: get_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            top_p=top_p,
+            stream=True,
+            stream_options={"include_usage": True}
+        ),
+        estimated_tokens=estimated_tokens
+    )
+    started = time.perf_counter()
+    first_token = None
+    pieces = []
+    usage = None
+    try:
+        for chunk in stream:
+            if getattr(chunk, 'usage', None) is not None:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            text = chunk.choices[0].delta.content
+            if text:
+                if first_token is None:
+                    first_token = time.perf_counter() - started
+                pieces.append(text)
+                on_token(text)
+    finally:
+        # The stream carries no usage when it's opened, so call_with_retries left the estimate as it was.
+        # The last chunk has the real numbers; if it never came (or the stream broke) we count what we got.
+        if usage is not None:
+            limiter.settle(estimated_tokens, (usage.prompt_tokens or 0) + (usage.completion_tokens or 0))
+        else:
+            limiter.settle(estimated_tokens, estimated_tokens - max_tokens + sum(len(piece) for piece in pieces) // 4)
+    prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+    completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+    stats.record('chat-stream-body', latency=time.perf_counter() - started, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+    record_tokens(prompt_tokens, completion_tokens)
+    if first_token is not None:
+        logging.info(f"First streamed token after {first_token:.2f}s, stream finished after {time.perf_counter() - started:.2f}s")
+    return ''.join(pieces)
+
+def generate_image(
+        prompt :str,
+        model :str = "dall-e-3",
+        size :str = "1792x1024",
+        quality :str = "standard",
+        n :int = 1
+        ) -> str:
+    response = call_with_retries(
+        'image',
+        lambda: get_client().images.generate(model=model, prompt=prompt, size=size, quality=quality, n=n)
+    )
+    return response.data[0].url
+
+def download(url :str, timeout :float = 60) -> bytes:
+    response = get_session().get(url, timeout=timeout)
+    response.raise_for_status()
+    return response.content
+
+def openai_stats() -> dict:
+    return {
+        'calls': stats.snapshot(),
+        'limits': {'requests_per_minute': limiter.requests_per_minute, 'tokens_per_minute': limiter.tokens_per_minute}
+    }
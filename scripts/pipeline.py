@@ -0,0 +1,121 @@
+# Standard library imports
+import time
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Dict, Iterable, List, Optional
+
+# Local imports
+from scripts.metrics import measure_stage
+
+class Stage:
+    # fn is called with one keyword argument per input and returns a dict with one entry per output
+    def __init__(self, name :str, fn :Callable[..., dict], inputs :Iterable[str] = (), outputs :Iterable[str] = ()):
+        self.name = name
+        self.fn = fn
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+
+class Pipeline:
+    # Starts every stage as soon as all of its inputs exist, so stages that don't depend on each other overlap.
+    # limits maps a stage name to a semaphore shared with other pipelines (even in other processes),
+    # so e.g. only so many transcriptions run at once however many videos are in flight.
+    def __init__(self, stages :List[Stage], max_workers :int = 4, limits :Optional[dict] = None):
+        self.stages = stages
+        self.max_workers = max_workers
+        self.limits = limits or {}
+        self.timings: Dict[str, Dict[str, float]] = {}
+        self._producers = {}
+        for stage in stages:
+            for output in stage.outputs:
+                if output in self._producers:
+                    raise ValueError(f"Both {self._producers[output].name} and {stage.name} produce '{output}'")
+                self._producers[output] = stage
+
+    def run(self, values :dict = None) -> dict:
+        values = dict(values or {})
+        missing = {i for s in self.stages for i in s.inputs if i not in values and i not in self._producers}
+        if missing:
+            raise ValueError(f"Nothing produces {', '.join(sorted(missing))}")
+        pending = list(self.stages)
+        running = {}
+        started = time.perf_counter()
+        error = None
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='blogarize-stage') as executor:
+            while pending or running:
+                if error is None:
+                    for stage in [s for s in pending if all(i in values for i in s.inputs)]:
+                        pending.remove(stage)
+                        self.timings[stage.name] = {'start': time.perf_counter() - started}
+                        logging.info(f"Starting stage {stage.name}")
+                        # Copy our context so the stage still knows which job it belongs to
+                        context = contextvars.copy_context()
+                        running[executor.submit(context.run, self._call, stage, {i: values[i] for i in stage.inputs})] = stage
+                if not running:
+                    if pending and error is None:
+                        raise RuntimeError(f"Stages can never start: {', '.join(s.name for s in pending)}")
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    timing = self.timings[stage.name]
+                    timing['end'] = time.perf_counter() - started
+                    timing['seconds'] = timing['end'] - timing['start']
+                    try:
+                        outputs = future.result() or {}
+                    except Exception as e:
+                        logging.error(f"Stage {stage.name} failed after {timing['seconds']:.1f}s: {e}")
+                        # Let whatever is already running finish, but don't start anything else
+                        error = error or e
+                        continue
+                    for output in stage.outputs:
+                        if output not in outputs:
+                            error = error or RuntimeError(f"Stage {stage.name} didn't produce '{output}'")
+                        values[output] = outputs.get(output)
+                    logging.info(f"Finished stage {stage.name} in {timing['seconds']:.1f}s")
+        if error is not None:
+            raise error
+        return values
+
+    def _call(self, stage :Stage, inputs :dict) -> dict:
+        limit = self.limits.get(stage.name)
+        if limit is None:
+            return self._measure(stage, inputs)
+        waiting = time.perf_counter()
+        with limit:
+            # Time spent waiting for a slot still counts towards the stage, but it's worth knowing how much
+            self.timings[stage.name]['waited'] = time.perf_counter() - waiting
+            return self._measure(stage, inputs)
+
+    def _measure(self, stage :Stage, inputs :dict) -> dict:
+        record = None
+        try:
+            with measure_stage(stage.name) as record:
+                return stage.fn(**inputs)
+        finally:
+            if record is not None:
+                self.timings[stage.name].update({k: v for k, v in record.summary().items() if v is not None})
+
+    def critical_path(self) -> List[str]:
+        # Walk back from the stage that finished last, always through the input that arrived last
+        finished = [s for s in self.stages if 'end' in self.timings.get(s.name, {})]
+        if not finished:
+            return []
+        stage = max(finished, key=lambda s: self.timings[s.name]['end'])
+        path = [stage.name]
+        while True:
+            producers = [self._producers[i] for i in stage.inputs if i in self._producers and 'end' in self.timings.get(self._producers[i].name, {})]
+            if not producers:
+                break
+            stage = max(producers, key=lambda s: self.timings[s.name]['end'])
+            path.append(stage.name)
+        return list(reversed(path))
+
+    def report(self) -> dict:
+        path = self.critical_path()
+        total = max((t.get('end', 0) for t in self.timings.values()), default=0)
+        return {
+            'total_seconds': round(total, 3),
+            'critical_path': path,
+            'stages': {name: {k: round(v, 3) for k, v in timing.items()} for name, timing in self.timings.items()}
+        }
@@ -1,53 +1,62 @@
 # Standard library imports
 import os
+import json
+import time
+import uuid
+import wave
 import shutil
 import logging
-from typing import Tuple
+import contextvars
+from typing import TYPE_CHECKING, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Third-party imports for web and file handling
-import requests
-from flask import session
 from werkzeug.utils import secure_filename
 from werkzeug.datastructures import FileStorage
 
-# Third-party imports for video and audio processing
-from pytube import YouTube
-from moviepy.editor import *
-import speech_recognition as sr
-import mutagen
-
-# Third-party imports for AI and environment variables
-from openai import OpenAI
-from dotenv import load_dotenv
-
-# Third-party imports for text processing
-import markdown as md
-from bs4 import BeautifulSoup
-
 # Local imports
-from app import app
-
-logging.basicConfig()
-fh = logging.FileHandler(f'logs/blogarize.log', mode='w')
-fh.setLevel(logging.DEBUG)  # Set the handler's level to DEBUG
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(lineno)d - %(funcName)s - %(message)s')
-fh.setFormatter(formatter)
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)  # Set the logger's level to DEBUG
-logger.addHandler(fh)
-logging.debug("processing.py: And away we go!")
-
-load_dotenv()
-
-def get_youtube_video(link: str) -> Tuple[YouTube,  str]:
+from scripts.config import config
+from scripts.jobs import current_job
+from scripts.cache import ArtifactCache, ARTIFACTS
+from scripts.pipeline import Pipeline, Stage
+from scripts.blog_manifest import BlogManifest
+from scripts.metrics import record_bytes, file_bytes, record_trimmed_audio
+from scripts.completion_cache import CompletionCache, get_completion_cache
+
+# pytube, mutagen, markdown, numpy, openai and Whisper are imported where they're used, so the web app
+# (and anything else that only needs a helper from here) starts without loading the media and ML stack
+if TYPE_CHECKING:
+    from pytube import YouTube
+
+def report_progress(step :str, message :str, partial :str = None) -> None:
+    # Progress belongs to the job running on this thread; there is no session outside a request
+    logging.info(f"{step}: {message}")
+    job = current_job()
+    if job is not None:
+        # Stages can finish out of order now, so the bar only ever moves forward
+        fields = {'progress': max(job.progress, config.get('steps')[step]), 'current_step': message}
+        if partial is not None:
+            fields['partial_transcript'] = partial
+        job.update(**fields)
+
+def report_warning(message :str) -> None:
+    # Something the job got past but the person waiting for it should know about
+    logging.warning(message)
+    job = current_job()
+    if job is not None:
+        job.warn(message)
+
+def get_youtube_video(link: str) -> Tuple['YouTube',  str]:
+    # The video ID comes straight from the link, so we can check the cache before asking YouTube for anything
+    from pytube import YouTube
     logging.info(f"We'll create an instance of the YouTube class to get some info.")
     yt = YouTube(link, on_progress_callback=on_yt_progress)
-    filename = secure_filename(f"{yt.title}.mp4")
-    logging.info(f"Complete filename is {filename}")
-    return yt, filename
+    key = ArtifactCache.key_for_youtube(yt.video_id)
+    logging.info(f"Cache key is {key}")
+    return yt, key
 
 def download_youtube_video(
-        yt: YouTube, 
+        yt: 'YouTube', 
         filename: str, 
         upload_folder: str
         ) -> str:
@@ -66,185 +75,369 @@ def on_yt_progress(stream, chunks, bytes_remaining):
     percentage_of_completion = (bytes_downloaded / total_size) * 100
     print(f"Downloaded {percentage_of_completion}%")
 
+def get_video_title(filepath :str, filename :str) -> str:
+    # Check if the MP4 file has a title. A file mutagen can't read still gets one from its name, because by
+    # now it's in the cache and the upload it came from is gone.
+    import mutagen
+    try:
+        mp4_file = mutagen.File(filepath, easy=True)
+        title = mp4_file.get('title') if mp4_file else None
+    except Exception as e:
+        logging.warning(f"Could not read the tags of {filepath}: {e}")
+        title = None
+    if title:
+        logging.info(f"Title of the uploaded file: {title[0]}")
+        return title[0]
+    # If the file doesn't have a title, use the filename (without the extension) as the title
+    title = os.path.splitext(secure_filename(filename))[0]
+    title = title.replace('_', ' ').title()
+    logging.info(f"File doesn't have a title. Using filename as title: {title}")
+    return title
+
 def save_uploaded_file(
         file: FileStorage, 
-        upload_folder: str,
-        mp4_size: int
-        ) -> str:
-    logging.info(f"Attempting to save uploaded file: {file} to {upload_folder}")
+        cache: ArtifactCache
+        ) -> Tuple[str, str]:
+    logging.info(f"Attempting to save uploaded file: {file} to {cache.root}")
     try:
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(upload_folder, filename)
-        logging.info(f"Filepath is {filepath}")
-        # If file with the same name exists and the uploaded file is a different size, overwrite it
-        if os.path.exists(filepath):
-            existing_file_size = os.path.getsize(filepath)
-            
-            # Log the sizes of the existing and uploaded files
-            logging.info(f"Existing file size: {existing_file_size}")
-            logging.info(f"Uploaded file size: {mp4_size}")
-            
-            # If uploaded file is a different size, overwrite existing file
-            if mp4_size != existing_file_size:
-                logging.info(f"Uploaded file is a different size. Overwriting existing file: {filepath}")
-                file.stream.seek(0)  # Reset stream position to beginning of file
-                shutil.copyfileobj(file.stream, open(filepath, 'wb'))
-
-                # Delete .wav, .txt, and .md files
-                base_filename, _ = os.path.splitext(filename)
-
-                # Log the files to be deleted
-                logging.info(f"Files to be deleted: {base_filename}.wav, {base_filename}.txt, {base_filename}.md")
-                
-                for ext in ['.wav', '.txt', '.md', '.png']:
-                    file_to_delete = os.path.join(upload_folder, base_filename + ext)
-                    if os.path.exists(file_to_delete):
-                        os.remove(file_to_delete)
-                        logging.info(f"Deleted file: {file_to_delete}")
-        else:
-            file.save(filepath)
-
-        session['progress'] = app.config.get('steps')['Downloaded']
-        session['completed_step'] = 'File saved. Moving on to audio conversion.'
-        # Check if the MP4 file has a title
-        mp4_file = mutagen.File(filepath, easy=True)
-        title = mp4_file.get('title')
-        if title:
-            logging.info(f"Title of the uploaded file: {title[0]}")
+        # Save it to the side first; we only know where it belongs once we've hashed it
+        temp_filepath = os.path.join(cache.root, f"incoming-{uuid.uuid4().hex}.mp4")
+        file.save(temp_filepath)
+        key = ArtifactCache.key_for_file(temp_filepath)
+        logging.info(f"Cache key is {key}")
+        if cache.lookup(key, 'video') is not None:
+            logging.info(f"We already have this video ({key}), so the upload is discarded.")
+            os.remove(temp_filepath)
         else:
-            # If the file doesn't have a title, use the filename (without the extension) as the title
-            title = os.path.splitext(filename)[0]
-            title = title.replace('_', ' ').title()
-            logging.info(f"File doesn't have a title. Using filename as title: {title}")
+            os.replace(temp_filepath, cache.path(key, 'video'))
+            cache.set_meta(key, title=get_video_title(cache.path(key, 'video'), file.filename), source=file.filename)
+            cache.record(key, 'video')
 
-        return title, filename
+        report_progress('Downloaded', 'File saved. Moving on to audio conversion.')
+        return cache.meta(key).get('title'), key
     except Exception as e:
         return str(e)
 
+def save_local_file(
+        filepath :str,
+        cache :ArtifactCache
+        ) -> Tuple[str, str]:
+    # Same as save_uploaded_file for a video that's already on disk. It's hashed where it is and only copied if it's new.
+    logging.info(f"Adding {filepath} to {cache.root}")
+    key = ArtifactCache.key_for_file(filepath)
+    logging.info(f"Cache key is {key}")
+    if cache.lookup(key, 'video') is None:
+        temp_filepath = os.path.join(cache.root, f"incoming-{uuid.uuid4().hex}.mp4")
+        shutil.copyfile(filepath, temp_filepath)
+        os.replace(temp_filepath, cache.path(key, 'video'))
+        cache.set_meta(key, title=get_video_title(cache.path(key, 'video'), os.path.basename(filepath)), source=filepath)
+        cache.record(key, 'video')
+    return cache.meta(key).get('title'), key
+
 def convert_video_to_audio(
         video_filepath :str = None, 
         audio_filepath :str = None
         ) -> str:
     
+    from scripts.audio import extract_audio
     if not os.path.exists(audio_filepath):
         logging.info(f"Attempting to convert {video_filepath} to {audio_filepath}")
         try:
-            videoclip = VideoFileClip(video_filepath)
-            audioclip = videoclip.audio
-            audioclip.write_audiofile(filename=audio_filepath, codec='pcm_s32le')
-            audioclip.close()
-            videoclip.close()
-            logging.info(f"Audio file saved as {audioclip.filename}")
-            return audioclip.filename
+            # ffmpeg pulls the audio track out directly, whether or not there's video in the file
+            extract_audio(video_filepath, audio_filepath)
+            logging.info(f"Audio file saved as {audio_filepath}")
+            report_progress('ConvertedAudio', 'Audio file created. Moving on to transcription.')
+            return audio_filepath
         except Exception as e:
-            try:
-                logging.info(f"The file {video_filepath} is not a valid video file. Audio only?")
-                audioclip = AudioFileClip(video_filepath)
-                audioclip.write_audiofile(filename=audio_filepath, codec='pcm_s32le')
-                audioclip.close()
-                logging.info(f"Audio file saved as {audioclip.filename}")
-                session['progress'] = app.config.get('steps')['ConvertedAudio']
-                session['completed_step'] = 'Audio file created. Moving on to transcription.'
-                return audioclip.filename
-            except Exception as e:
-                logging.error(f"Nope. Neither a valid video nor audio file: {e}")
             logging.error(f"An error occurred in 'convert_video_to_audio' (processing.py): {e}")
             return str(e)
     else:
-        session['progress'] = app.config.get('steps')['ConvertedAudio']
-        session['completed_step'] = 'Audio file already exists. Moving on to transcription.'
+        report_progress('ConvertedAudio', 'Audio file already exists. Moving on to transcription.')
         return audio_filepath
 
-def transcribe_audio(audio_filepath: str) -> str:
-    logging.info(f"Attempting to transcribe {audio_filepath}")
+def transcribe_audio(audio_filepath: str, mode :str = None, source_filepath :str = None) -> str:
+    # With a source_filepath the audio is piped straight out of the video and no WAV is needed
+    from scripts.audio import load_audio, SAMPLE_RATE
+    from scripts.transcription import transcribe_segmented, read_segment
+    from scripts.whisper_service import get_whisper_service
+    from scripts.vad import TimeMap, trim_silence, map_segments
+    logging.info(f"Attempting to transcribe {source_filepath or audio_filepath}")
     transcription_filepath = audio_filepath.replace('.wav', '.txt')
+    if mode is None:
+        mode = config.get('TRANSCRIBE_MODE', 'single')
     if not os.path.exists(transcription_filepath):
+        if mode == 'segmented':
+            try:
+                def on_partial(partial :str, done :int, total :int) -> None:
+                    report_progress('ConvertedAudio', f"Transcribed {done} of {total} segments.", partial=partial)
+                text = transcribe_segmented(
+                    audio_filepath,
+                    transcription_filepath,
+                    model_name=config.get('WHISPER_MODEL', 'base'),
+                    processes=config.get('TRANSCRIBE_PROCESSES'),
+                    segment_seconds=config.get('TRANSCRIBE_SEGMENT_SECONDS', 30),
+                    on_partial=on_partial,
+                    vad=vad_options()
+                )
+                report_progress('Transcribed', 'Transcription complete. Moving on to summarization.')
+                return text
+            except Exception as e:
+                logging.error(f"An error occurred with segmented transcription of {audio_filepath} (processing.py): {e}")
+                return f"Could not transcribe {audio_filepath}: {e}"
         try:
-            # transcribe audio file                                                         
-            r = sr.Recognizer()
-            with sr.AudioFile(audio_filepath) as source:
-                audio = r.record(source)
-                try:
-                    text = r.recognize_whisper(audio)
-                    # save transcription to file
-                    with open(transcription_filepath, 'w') as f:
-                        f.write(text)
-                    logging.info(f"Transcript is {text}")
-                    session['progress'] = app.config.get('steps')['Transcribed']
-                    session['completed_step'] = 'Transcription complete. Moving on to summarization.'
-                    return text
-                except Exception as e:
-                    logging.error(f"An error occurred inside transcribing {audio_filepath} (processing.py): {e}")
-                    return str(e)
+            # The model stays loaded in this worker, so only inference happens per call
+            service = get_whisper_service(config.get('WHISPER_MODEL', 'base'))
+            if source_filepath is not None:
+                samples = load_audio(source_filepath)
+            else:
+                with wave.open(audio_filepath, 'rb') as wav:
+                    n_frames = wav.getnframes()
+                samples = read_segment(audio_filepath, 0, n_frames)
+            timemap = TimeMap.identity(len(samples) / SAMPLE_RATE)
+            vad = vad_options()
+            if vad is not None:
+                # Whisper's time goes with the length of the audio, so long pauses and dead air are cut out first
+                samples, timemap = trim_silence(samples, SAMPLE_RATE, **vad)
+                record_trimmed_audio(timemap.original_seconds, timemap.removed_seconds)
+                logging.info(f"Silence trimmed before transcribing: {timemap.report()}")
+                if len(samples) == 0:
+                    raise RuntimeError(f"No speech found in {source_filepath or audio_filepath}")
+                report_progress('ConvertedAudio', f"Skipping {timemap.removed_seconds:.0f}s of silence. Transcribing {timemap.kept_seconds:.0f}s of audio.")
+            result = service.transcribe(samples)
+            text = result['text'].strip()
+            # save transcription to file
+            with open(transcription_filepath, 'w') as f:
+                f.write(text)
+            # Segment times are in the original recording, whatever was trimmed
+            with open(os.path.splitext(transcription_filepath)[0] + '.segments.json', 'w') as f:
+                json.dump(map_segments(result.get('segments', []), timemap), f)
+            logging.info(f"Transcript is {len(text)} characters")
+            logging.debug("Transcript: %s", text)
+            logging.info(f"Whisper service stats: {service.stats()}")
+            report_progress('Transcribed', 'Transcription complete. Moving on to summarization.')
+            return text
         except Exception as e:
             logging.error(f"An error occurred with transcribing {audio_filepath} (processing.py): {e}")
-            return str(e)
+            return f"Could not transcribe {audio_filepath}: {e}"
     else:
         with open(transcription_filepath, 'r') as f:
             return f.read()
         
+def vad_options() -> dict:
+    # How silence is found and trimmed before transcription, or None when it's turned off
+    if not config.get('VAD'):
+        return None
+    return {
+        'margin_db': config.get('VAD_MARGIN_DB', 12.0),
+        'min_threshold_db': config.get('VAD_MIN_THRESHOLD_DB', -55.0),
+        'max_threshold_db': config.get('VAD_MAX_THRESHOLD_DB', -35.0),
+        'min_silence_seconds': config.get('VAD_MIN_SILENCE_SECONDS', 1.0),
+        'padding_seconds': config.get('VAD_PADDING_SECONDS', 0.25)
+    }
+
 def is_file_empty(filepath :str) -> bool:
     return not os.path.exists(filepath) or os.path.getsize(filepath) == 0
 
-def count_words_in_html_file(filepath: str) -> int:
-    # if the file doesn't exist, return true
-    if not os.path.exists(filepath):
-        return 0
-    with open(filepath, 'r') as f:
-        content = f.read()
-    soup = BeautifulSoup(content, 'html.parser')
-    text = soup.get_text()
-    words = text.split()
-    return len(words)
+def create_notes(transcript :str, notes_filepath :str) -> str:
+    # Long transcripts are boiled down to notes in parallel so no later prompt has to carry the whole thing
+    from scripts.summarize import build_notes, count_tokens
+    if not is_file_empty(notes_filepath):
+        with open(notes_filepath, 'r') as f:
+            return f.read()
+    def complete(type :str, prompt :str, max_tokens :int) -> str:
+        # Notes should stick to what was said, so they're written a little cooler than the blog
+        return openai_completion(prompt, type=type, temperature=0.2, max_tokens=max_tokens)
+    try:
+        notes = build_notes(
+            transcript,
+            complete,
+            chunk_tokens=config.get('SUMMARY_CHUNK_TOKENS', 6000),
+            concurrency=config.get('SUMMARY_CONCURRENCY', 4)
+        )
+        with open(notes_filepath, 'w') as f:
+            f.write(notes)
+        logging.info(f"Notes are {count_tokens(notes)} tokens, down from {count_tokens(transcript)}")
+        return notes
+    except Exception as e:
+        logging.error(f"An error occurred inside create_notes (processing.py): {e}")
+        return f"Could not summarize the transcript: {e}"
+
+def generate_blog_section(
+        section :str,
+        words_per_section :int,
+        retries :int = 2,
+        context :str = None,
+        index :int = None
+        ) -> str:
+    # Each section is retried on its own so one bad call doesn't cost us the rest of the blog.
+    # context goes in front of every section's prompt, so it should be short (notes or the summary).
+    prompt = f"Write the section about {section}. Make sure you start with the section heading as an h2 tag. This section should be approximately {words_per_section} words minimum."
+    if context:
+        prompt = f"{context}\n\n{prompt}"
+    for attempt in range(retries + 1):
+        try:
+            response = openai_completion(prompt=prompt, type="blog-section", stream_part=f"section-{index}" if index is not None else None)
+            return format_openai_response(response, "blog-section")
+        except Exception as e:
+            logging.error(f"Attempt {attempt + 1} at section '{section}' failed: {e}")
+            if attempt < retries:
+                time.sleep(2 ** attempt)
+    raise RuntimeError(f"Could not write the section about {section}")
 
 def create_blog(
         title :str = None,
         transcript :str = None, 
         summary :str = None, 
         blog_filepath :str = None,
-        word_count :int = 2500
+        word_count :int = 2500,
+        section_concurrency :int = None,
+        section_retries :int = 2,
+        notes :str = None
         ) -> str:
+    # When there are notes they stand in for the transcript, so the raw transcript is never resent per section.
+    # A short transcript comes back from build_notes as it is, and then the sections get the summary instead.
+    # Progress is checkpointed per section in a manifest next to the blog, so a rerun only writes what's missing.
     logging.info(f"Creating a blog post from the transcript and summary.")
-    blog_content = blog_filepath
-    if is_file_empty(blog_content) and count_words_in_html_file(blog_content) < word_count-(word_count*.2): # We'll give it a 20% buffer
+    manifest = BlogManifest(blog_filepath)
+    if not manifest.sections:
+        if not is_file_empty(blog_filepath):
+            # Written in one go before there were manifests
+            with open(blog_filepath, 'r') as f:
+                return f.read()
         # We'll have the first call to openai to create an outline
-        outline_fn = blog_filepath.replace('.md', '-outline.md')
-        call_openai(prompt=f"This is the transcript: {transcript} and the summary you created {summary}.", type="blog-outline", filepath=outline_fn)
-
-        session['progress'] = app.config.get('steps')['Outlined']
-        session['completed_step'] = 'Blog outline created. Moving on to blog creation.'
+        outline_fn = os.path.splitext(blog_filepath)[0] + '-outline.md'
+        if os.path.exists(outline_fn):
+            os.remove(outline_fn)
+        if notes:
+            call_openai(prompt=f"These are my notes from the video: {notes} and the summary you created {summary}.", type="blog-outline", filepath=outline_fn)
+        else:
+            call_openai(prompt=f"This is the transcript: {transcript} and the summary you created {summary}.", type="blog-outline", filepath=outline_fn)
 
         with open(outline_fn, 'r') as f:
-            sections = [line.strip() for line in f.readlines()]
-
-        # Calculate the number of sections we can have based on the word count
-        words_per_section = word_count // len(sections)
-
-        # Create the h1 tag for the blog post
-        blog_title = f"<h1>{title}</h1>"
-        with open(blog_content, 'w') as f:
-            f.write(blog_title)
-
-        # Now we'll iterate through the sections it gave us the first time
-        for section in sections:
-            if is_file_empty(blog_filepath):
-                with open(outline_fn, 'w') as f:
-                    f.write(f"")
-            blog_section = call_openai(prompt=f"Write the section about {section}. Make sure you start with the section heading as an h2 tag. This section should be approximately {words_per_section} words minimum.", type="blog-section", filepath=blog_content)
-            logging.info(f"Blog section: {blog_section}")
-
-        # Read the blog file so we can return it
-        with open(blog_content, 'r') as f:
-            blog = f.read()
-
-        # Cleanup the blog outline and blog section files
-
-
-        # and now, we'll put it all together in a blog post
-        return blog
+            sections = [line.strip() for line in f.readlines() if line.strip()]
+        if not sections:
+            raise RuntimeError(f"Could not create a blog outline for {title}")
+        manifest.set_outline(sections)
+
+    report_progress('Outlined', 'Blog outline created. Moving on to blog creation.')
+    sections = manifest.outline
+    todo = manifest.todo()
+    if len(todo) < len(sections):
+        logging.info(f"{len(sections) - len(todo)} of {len(sections)} blog sections are already written, {len(todo)} to go")
+
+    # Calculate the number of sections we can have based on the word count
+    words_per_section = word_count // len(sections)
+
+    # Every section gets the same context, so it has to be something already boiled down
+    if notes and notes.strip() != (transcript or '').strip():
+        context = f"These are my notes from the video: {notes}"
     else:
-        with open(blog_content, 'r') as f:
-            return f.read()
+        context = f"This is the outline and summary of the video: {summary}" if summary else None
+
+    # Write the sections at the same time; the manifest puts them back in the order of the outline
+    if section_concurrency is None:
+        section_concurrency = config.get('SECTION_CONCURRENCY', 4)
+    if todo:
+        with ThreadPoolExecutor(max_workers=max(1, section_concurrency)) as executor:
+            # Each section carries the job along so it can stream its tokens to the right watchers
+            futures = {executor.submit(contextvars.copy_context().run, generate_blog_section, sections[i], words_per_section, section_retries, context, i): i for i in todo}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    manifest.section_done(i, future.result())
+                    logging.info(f"Blog section {i + 1} of {len(sections)} is done: {sections[i]}")
+                except Exception as e:
+                    logging.error(f"Giving up on blog section {i + 1} ({sections[i]}): {e}")
+                    manifest.section_failed(i, str(e))
+
+    # A post with some sections missing is still worth having, one with none isn't
+    failed = manifest.failed()
+    if failed and len(failed) == len(sections):
+        raise RuntimeError(f"Could not write any of the {len(sections)} blog sections for {title}: {failed[0]['error']}")
+    if failed:
+        report_warning(f"{len(failed)} of {len(sections)} blog sections could not be written: {', '.join(section['title'] for section in failed)}")
+
+    # Create the h1 tag for the blog post and put it all together
+    blog = manifest.assemble(title)
+    with open(blog_filepath, 'w') as f:
+        f.write(blog)
+    logging.info(f"Blog post is {manifest.words()} words across {len(sections)} sections")
+    return blog
+
+# Define a dictionary to map types to their corresponding system messages
+SYSTEM_MESSAGES = {
+    'blog-outline': "Based on this transcript, I'm going to write a blog post. I'll start with an introduction, then move on to the body which will touch on each of the topics in the transcript, and finally, I'll end with a conclusion. The tone should be conversational at an 8th grade (14 year old) reading level and should never use the word 'delve' or its variants, 'moreover', 'furthermore' or anything like that. Keep in mind, these videos are from my perspective so don't use terms like 'presenter' or 'speaker' because I'm the one speaking. We'll assume the audience is already familiar with the presenter so don't include any summaries of them. Give me a list of the sections for the blog post and return them to me as a list so I can have you iterate through them in later prompts. Do not include anything in your response other than the sections.",
+    'blog-section': "Based on the transcript and the section outline you created, let's write a blog post. Remember, the tone should be conversational at an 8th grade (14 year old) reading level and should never use the word 'delve' or its variants, 'moreover', 'furthermore' or anything like that. Don't start sections with anything like 'hey there' or hi' because we are just continuing the blog post. Keep in mind, these videos are from my perspective so don't use terms like 'presenter' or 'speaker' because I'm the one speaking. Put it in an html format starting with an h2 tag, but don't end with a closing body tag.",
+    'summary': "You are going to only answer in html format. You'll start with an 'h2' tag and continue through. Do not end with a closing body tag. The tone should be conversational at an 8th grade (14 year old) reading level and should never use the word 'delve' or its variants, 'moreover', 'furthermore' or anything like that. Keep in mind, these videos are from my perspective so don't use terms like 'presenter' or 'speaker' because I'm the one speaking. We'll assume the audience is already familiar with me as the presenter so don't include any summaries of their information during the introduction.",
+    'notes': "You are taking notes on part of a video transcript so they can be used later to write a summary and a blog post. Keep every topic, example, number and opinion that's mentioned, in the order it comes up, as short bullet points. Keep in mind, these videos are from my perspective so don't use terms like 'presenter' or 'speaker' because I'm the one speaking. Do not include anything in your response other than the notes.",
+    'combine-notes': "These are notes taken on consecutive parts of one video transcript. Merge them into a single set of bullet point notes, in order, dropping repeats but keeping every distinct topic, example, number and opinion. Keep in mind, these videos are from my perspective so don't use terms like 'presenter' or 'speaker' because I'm the one speaking. Do not include anything in your response other than the notes.",
+    # Add more types and their messages here...
+}
+
+def openai_completion(
+        prompt :str,
+        type :str = "summary",
+        model :str = "gpt-4-turbo-preview",
+        temperature :float = 0.3,
+        max_tokens :int = 2500,
+        top_p :float = 1.0,
+        stream_part :str = None,
+        use_cache :bool = True
+        ) -> str:
+    # Raises on failure. Use call_openai if you want the response saved to a file.
+    # With a stream_part the tokens also go out to the job's watchers as they're written.
+    # The same request twice is answered from the completion cache unless use_cache is False.
+    from scripts.openai_client import chat_completion, chat_completion_stream
+    # Prompts and responses can be the size of a transcript, so only their length is logged unless we're debugging
+    logging.info(f"Calling OpenAI API ({type}) with a {len(prompt)} character prompt")
+    logging.debug("Prompt: %s", prompt)
+    messages = [
+        {"role": "system", "content": SYSTEM_MESSAGES[type]},
+        {"role": "user", "content": prompt}
+    ]
+    job = current_job()
+    completions = completion_cache() if use_cache else None
+    if completions is not None:
+        key = CompletionCache.key(type, SYSTEM_MESSAGES[type], prompt, model, temperature, max_tokens, top_p)
+        response = completions.get(key)
+        if response is not None:
+            logging.info(f"Completion cache hit for {type} ({key[:12]})")
+            if stream_part and job is not None and config.get('STREAM_TOKENS'):
+                job.emit({'type': 'token', 'part': stream_part, 'reset': True})
+                job.emit({'type': 'token', 'part': stream_part, 'text': response})
+            return response
+    if stream_part and job is not None and config.get('STREAM_TOKENS'):
+        job.emit({'type': 'token', 'part': stream_part, 'reset': True})
+        response = chat_completion_stream(
+            messages,
+            lambda text: job.emit({'type': 'token', 'part': stream_part, 'text': text}),
+            model=model, temperature=temperature, max_tokens=max_tokens, top_p=top_p
+        )
+    else:
+        # The shared client queues us behind the rate limits and retries what's worth retrying
+        response = chat_completion(messages, model=model, temperature=temperature, max_tokens=max_tokens, top_p=top_p)
+    logging.info(f"Response from OpenAI ({type}) is {len(response)} characters")
+    logging.debug("Response: %s", response)
+    # Only a real answer is kept; an empty one is asked for again next time
+    if completions is not None and response:
+        completions.put(key, response, type=type, model=model)
+    return response
+
+def completion_cache():
+    if not config.get('COMPLETION_CACHE'):
+        return None
+    return get_completion_cache(
+        config['COMPLETION_CACHE_FOLDER'],
+        max_bytes=config.get('COMPLETION_CACHE_MAX_BYTES', 256 * 1024 ** 2),
+        ttl=config.get('COMPLETION_CACHE_TTL', 30 * 24 * 3600)
+    )
+
+def format_openai_response(response :str, type :str) -> str:
+    if type == 'blog-outline':
+        response = '\n'.join([line[2:] for line in response.strip().split('\n')])
+    elif type == 'blog-section':
+        response = response.replace("```html\n", "").replace("```", "")
+    return response
 
 def call_openai(
         prompt :str, 
@@ -253,77 +446,32 @@ def call_openai(
         model :str ="gpt-4-turbo-preview",
         temperature :float =0.3,
         max_tokens :int =2500,
-        top_p :float =1.0
+        top_p :float =1.0,
+        stream_part :str = None,
+        use_cache :bool = True
         ) -> str:
+    # Raises when OpenAI can't be reached or the response can't be saved, so an error never stands in for the text
     logging.info(f"Is the file we are using empty? {is_file_empty(filepath)}")
     #Check if summary file exists and is not empty but only if the type is summary. Otherwise, we'll call OpenAI:
     if (is_file_empty(filepath) and type == "summary") or type != "summary":
         logging.info(f"Our file does not exist: {filepath}")
         try:
-            logging.info(f"Calling OpenAI API with prompt: {prompt}")
-            client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-
-            # Define a dictionary to map types to their corresponding messages
-            type_messages = {
-                'blog-outline': [{
-                    "role": "system",
-                    "content": "Based on this transcript, I'm going to write a blog post. I'll start with an introduction, then move on to the body which will touch on each of the topics in the transcript, and finally, I'll end with a conclusion. The tone should be conversational at an 8th grade (14 year old) reading level and should never use the word 'delve' or its variants, 'moreover', 'furthermore' or anything like that. Keep in mind, these videos are from my perspective so don't use terms like 'presenter' or 'speaker' because I'm the one speaking. We'll assume the audience is already familiar with the presenter so don't include any summaries of them. Give me a list of the sections for the blog post and return them to me as a list so I can have you iterate through them in later prompts. Do not include anything in your response other than the sections."
-                }],
-                'blog-section': [{
-                    "role": "system",
-                    "content": "Based on the transcript and the section outline you created, let's write a blog post. Remember, the tone should be conversational at an 8th grade (14 year old) reading level and should never use the word 'delve' or its variants, 'moreover', 'furthermore' or anything like that. Don't start sections with anything like 'hey there' or hi' because we are just continuing the blog post. Keep in mind, these videos are from my perspective so don't use terms like 'presenter' or 'speaker' because I'm the one speaking. Put it in an html format starting with an h2 tag, but don't end with a closing body tag."
-                }],
-                'summary': [{
-                    "role": "system",
-                    "content": "You are going to only answer in html format. You'll start with an 'h2' tag and continue through. Do not end with a closing body tag. The tone should be conversational at an 8th grade (14 year old) reading level and should never use the word 'delve' or its variants, 'moreover', 'furthermore' or anything like that. Keep in mind, these videos are from my perspective so don't use terms like 'presenter' or 'speaker' because I'm the one speaking. We'll assume the audience is already familiar with me as the presenter so don't include any summaries of their information during the introduction."
-                }],
-                # Add more types and their messages here...
-            }
-
-            # Get the messages for the given type
-            messages = type_messages.get(type)
-
-            # Add the user's prompt to the messages
-            if messages is not None:
-                type_messages[type].append({
-                    "role": "user",
-                    "content": prompt
-                })
-
-            response = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                top_p=top_p
-            ).choices[0].message.content
-
-            # Add the response to the messages
-            type_messages[type].append({
-                "role": "assistant",
-                "content": response
-            })
-
-            logging.info(f"Response from OpenAI: {response}")
-
-            try:
-                with open(filepath, 'a') as f:
-                    if type == 'blog-outline':
-                        response = '\n'.join([line[2:] for line in response.strip().split('\n')])
-                    elif type == 'blog-section':
-                        response = response.replace("```html\n", "").replace("```", "")
-
-                    logging.info(f"Formatted response: {response}")
-                    f.write(response)
-                    return(response)
-            except Exception as e:
-                logging.error(f"An error occurred saving {filepath}")
-                return str(e)
+            response = openai_completion(prompt, type=type, model=model, temperature=temperature, max_tokens=max_tokens, top_p=top_p, stream_part=stream_part, use_cache=use_cache)
         except Exception as e:
             logging.error(f"An error occurred inside call_openai (processing.py): {e}")
-            return str(e)
+            raise RuntimeError(f"Could not get a {type} from OpenAI: {e}") from e
+        response = format_openai_response(response, type)
+        logging.debug("Formatted response: %s", response)
+        try:
+            with open(filepath, 'w') as f:
+                f.write(response)
+        except Exception as e:
+            logging.error(f"An error occurred saving {filepath}")
+            raise RuntimeError(f"Could not save the {type} to {filepath}: {e}") from e
+        return response
     else:
         logging.info(f"Summary file exists ({filepath}) and is not empty so we will use it.")
+        import markdown as md
         with open(filepath, 'r') as f:
             return md.markdown(text=f.read(), extensions=['extra'])
         
@@ -335,32 +483,153 @@ def call_dalle(
         n :int = 1,
         filename :str = "image.png"
         ) -> str:
-    # Is there already a header image?
+    # Returns the image's path or raises, like call_openai
+    from scripts.openai_client import generate_image, download
     if is_file_empty(filename):
         logging.info(f"We don't have a header image yet. Let's get one.")
         # Call DALL-E
         try:
-            logging.info(f"Calling DALL-E with prompt: {prompt}")
-            dalle = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-            response = dalle.images.generate(
-                model=model,
-                prompt=prompt,
-                size= size,
-                quality=quality,
-                n=n
-            )
-            logging.info(f"Response from DALL-E: {response}")
-            image_url = response.data[0].url
+            logging.info(f"Calling DALL-E with a {len(prompt)} character prompt")
+            logging.debug("DALL-E prompt: %s", prompt)
+            image_url = generate_image(prompt, model=model, size=size, quality=quality, n=n)
+            logging.info(f"Image URL from DALL-E: {image_url}")
             # Download the image
-            response = requests.get(image_url)
+            content = download(image_url)
             with open(filename, 'wb') as f:
-                f.write(response.content)
-                session['progress'] = 55.56
-                session['completed_step'] = 'Header image created.'
+                f.write(content)
+                report_progress('HeaderImage', 'Header image created.')
             return filename
         except Exception as e:
             logging.error(f"An error occurred inside call_dalle (processing.py): {e}")
-            return str(e)
+            raise RuntimeError(f"Could not create a header image: {e}") from e
     else:
         logging.info(f"Header image exists ({filename}) and is not empty so we will use it.")
-        return filename
\ No newline at end of file
+        return filename
+
+def process_video(
+        cache :ArtifactCache,
+        youtube_link :str = None,
+        title :str = None,
+        key :str = None,
+        stage_limits :dict = None
+        ) -> dict:
+    # Runs the whole pipeline outside of the request. Errors are raised so the job is marked as failed.
+    # Every stage is looked up in the cache first and only recorded there once it has finished.
+    if youtube_link:
+        logging.info(f"Processing YouTube Link: {youtube_link}")
+        yt, key = get_youtube_video(youtube_link)
+    if not key:
+        raise RuntimeError('An error occurred during processing. Please try again.')
+
+    # Each stage says what it needs and what it makes; the scheduler runs whatever is ready.
+    # The header image only needs the summary, so it's drawn while the blog is being written.
+    def download_stage() -> dict:
+        video_title = title
+        if youtube_link and cache.lookup(key, 'video') is None:
+            report_progress('Init Form', 'Downloading video.')
+            video_title = yt.title
+            file_name = download_youtube_video(yt, ARTIFACTS['video'], cache.entry_dir(key))
+            if not file_name.endswith('.mp4'):
+                raise RuntimeError(file_name)
+            cache.set_meta(key, title=video_title, source=youtube_link)
+            cache.record(key, 'video')
+            record_bytes(written=file_bytes(cache.path(key, 'video')))
+            report_progress('Downloaded', 'YouTube Video Downloaded. Converting to audio...')
+        video_filepath = cache.path(key, 'video')
+        logging.info(f"Video File: {video_filepath}")
+        return {'title': cache.meta(key).get('title') or video_title, 'video_filepath': video_filepath}
+
+    def transcribe_stage(video_filepath :str) -> dict:
+        audio_filepath = cache.path(key, 'audio')
+        piping = config.get('AUDIO_PIPE') and config.get('TRANSCRIBE_MODE', 'single') == 'single'
+        transcribing = cache.lookup(key, 'transcript') is None
+        if transcribing:
+            if piping:
+                # Whisper gets the audio straight from ffmpeg, so there's no WAV to write or read back
+                report_progress('ConvertedAudio', 'Streaming audio straight to transcription.')
+            elif cache.lookup(key, 'audio') is None:
+                audio = convert_video_to_audio(video_filepath, audio_filepath)
+                if not audio.endswith('.wav'):
+                    logging.error(f"Error in converting to audio: {audio}")
+                    raise RuntimeError(audio)
+                cache.record(key, 'audio')
+        # Transcribe the audio to text
+        transcript = transcribe_audio(audio_filepath, source_filepath=video_filepath if piping else None)
+        if transcript.startswith('Could not transcribe'):
+            logging.error(f"Error in transcription: {transcript}")
+            raise RuntimeError(transcript)
+        cache.record(key, 'transcript')
+        if transcribing:
+            record_bytes(read=file_bytes(video_filepath), written=file_bytes(audio_filepath, cache.path(key, 'transcript')))
+        return {'transcript': transcript}
+
+    def notes_stage(transcript :str) -> dict:
+        # Boil the transcript down to notes, then summarize those
+        notes_filepath = cache.path(key, 'notes')
+        fresh = cache.lookup(key, 'notes') is None
+        notes = create_notes(transcript, notes_filepath)
+        if notes.startswith('Could not summarize'):
+            logging.error(f"Error in taking notes: {notes}")
+            raise RuntimeError(notes)
+        cache.record(key, 'notes')
+        if fresh:
+            record_bytes(read=len(transcript.encode()), written=file_bytes(notes_filepath))
+        return {'notes': notes}
+
+    def summary_stage(notes :str) -> dict:
+        summary_filepath = cache.path(key, 'summary')
+        fresh = cache.lookup(key, 'summary') is None
+        # Raises if OpenAI fails, which fails the job before anything is built on the summary
+        summary = call_openai(f"Give me an outline and summary of this text: {notes}", summary_filepath, stream_part='summary')
+        cache.record(key, 'summary')
+        if fresh:
+            record_bytes(read=len(notes.encode()), written=file_bytes(summary_filepath))
+        report_progress('Summarized', 'Summarized. Creating a blog post and header image from the summary.')
+        return {'summary': summary}
+
+    def blog_stage(title :str, transcript :str, summary :str, notes :str) -> dict:
+        blog_filepath = cache.path(key, 'blog')
+        fresh = cache.lookup(key, 'blog') is None
+        blog = create_blog(title, transcript, summary, blog_filepath, notes=notes)
+        # With sections missing it isn't cached, so the next run tries those sections again
+        if not BlogManifest(blog_filepath).failed():
+            cache.record(key, 'blog')
+        if fresh:
+            record_bytes(read=len(summary.encode()) + len(notes.encode()), written=file_bytes(blog_filepath))
+        report_progress('Content', 'Blog post created.')
+        return {'blog': blog}
+
+    def image_stage(summary :str) -> dict:
+        dalle_filepath = cache.path(key, 'image')
+        fresh = cache.lookup(key, 'image') is None
+        call_dalle(prompt=f"Generate an image based on the blog post you created. Do not, under any circumstances, put words in this image. {summary}.", filename=dalle_filepath, model="dall-e-3", size="1792x1024", n=1, quality="hd")
+        cache.record(key, 'image')
+        if fresh:
+            record_bytes(read=len(summary.encode()), written=file_bytes(dalle_filepath))
+        return {'header_img': os.path.relpath(dalle_filepath, config['UPLOAD_FOLDER'])}
+
+    pipeline = Pipeline([
+        Stage('download', download_stage, outputs=['title', 'video_filepath']),
+        Stage('transcribe', transcribe_stage, inputs=['video_filepath'], outputs=['transcript']),
+        Stage('notes', notes_stage, inputs=['transcript'], outputs=['notes']),
+        Stage('summary', summary_stage, inputs=['notes'], outputs=['summary']),
+        Stage('blog', blog_stage, inputs=['title', 'transcript', 'summary', 'notes'], outputs=['blog']),
+        Stage('image', image_stage, inputs=['summary'], outputs=['header_img'])
+    ], max_workers=config.get('STAGE_WORKERS', 2), limits=stage_limits)
+
+    cache.pin(key)
+    try:
+        values = pipeline.run()
+    finally:
+        cache.unpin(key)
+        timings = pipeline.report()
+        logging.info(f"Stage timings for {key}: {timings}")
+
+    return {
+        'title': values['title'],
+        'transcript': values['transcript'],
+        'summary': values['summary'],
+        'blog': values['blog'],
+        'header_img': values['header_img'],
+        'timings': timings
+    }
@@ -0,0 +1,378 @@
+# Standard library imports
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+# Columns that hold JSON rather than plain values
+_JSON_FIELDS = ('params', 'result', 'warnings')
+
+class Store(ABC):
+    # Where jobs and the artifact index live, so every worker process (and every instance sharing the
+    # database and the uploads folder) sees the same state. Subclass this and implement every method to keep
+    # them somewhere else.
+
+    # Jobs
+    @abstractmethod
+    def create_job(self, job :dict) -> Tuple[dict, bool]:
+        # Returns the job and True, or, if a job with the same dedup_key is already queued or running,
+        # that job and False
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_job(self, job_id :str) -> Optional[dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_job(self, job_id :str, worker :str = None, **fields) -> bool:
+        # With a worker, only changes the job while that worker still holds it
+        raise NotImplementedError
+
+    @abstractmethod
+    def lease_job(self, worker :str, lease_seconds :float, max_attempts :int) -> Optional[dict]:
+        # Hands the oldest queued job to this worker until the lease runs out
+        raise NotImplementedError
+
+    @abstractmethod
+    def renew_leases(self, worker :str, job_ids :Iterable[str], lease_seconds :float) -> List[str]:
+        # Returns the jobs the worker still holds; any other it has lost to someone else
+        raise NotImplementedError
+
+    @abstractmethod
+    def count_jobs(self, statuses :Iterable[str]) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    def prune_jobs(self, finished_before :float) -> int:
+        raise NotImplementedError
+
+    # Artifact index, one entry per cache key
+    @abstractmethod
+    def get_artifact(self, key :str) -> Optional[dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def put_artifact(self, key :str, entry :dict) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_artifact(self, key :str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def artifacts(self) -> Dict[str, dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def evict_artifact(self, key :str) -> bool:
+        # Deletes the entry unless someone has it pinned, and says whether it did
+        raise NotImplementedError
+
+    # Pins keep an entry from being evicted while a job uses it. Each one is leased like a job, so the
+    # pins of a worker that died run out instead of keeping the entry forever.
+    @abstractmethod
+    def pin_artifact(self, key :str, owner :str, lease_seconds :float) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def unpin_artifact(self, key :str, owner :str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def renew_pins(self, owner :str, lease_seconds :float) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def pinned_artifacts(self) -> Set[str]:
+        raise NotImplementedError
+
+    # Chunked uploads, so any worker can take the next chunk of an upload another one started
+    @abstractmethod
+    def create_upload(self, upload :dict) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_upload(self, upload_id :str) -> Optional[dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def claim_upload(self, upload_id :str, writer :str, offset :int, lease_seconds :float) -> Tuple[Optional[dict], bool]:
+        # Returns the upload and True if this writer may write at offset (nobody else is writing and that's
+        # where the upload is), otherwise the upload as it is and False. Claiming again renews the claim.
+        raise NotImplementedError
+
+    @abstractmethod
+    def release_upload(self, upload_id :str, writer :str, offset :int) -> None:
+        # Records how far the writer got and lets the next one in
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_upload(self, upload_id :str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def prune_uploads(self, updated_before :float) -> List[str]:
+        # Forgets the uploads nobody has touched since updated_before and returns their IDs
+        raise NotImplementedError
+
+class SQLiteStore(Store):
+    # WAL lets readers carry on while one process writes; leases are taken inside an immediate
+    # transaction so two workers can never be handed the same job
+    def __init__(self, filepath :str, busy_timeout :float = 30):
+        self.filepath = filepath
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        if os.path.dirname(filepath):
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        self._db().executescript('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                task TEXT NOT NULL,
+                params TEXT,
+                label TEXT,
+                dedup_key TEXT,
+                status TEXT NOT NULL,
+                progress REAL DEFAULT 0,
+                current_step TEXT,
+                partial_transcript TEXT,
+                result TEXT,
+                error TEXT,
+                warnings TEXT,
+                profile INTEGER DEFAULT 0,
+                profile_filepath TEXT,
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER DEFAULT 0,
+                created REAL,
+                started REAL,
+                finished REAL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, created);
+            CREATE UNIQUE INDEX IF NOT EXISTS jobs_in_flight ON jobs (dedup_key) WHERE dedup_key IS NOT NULL AND status IN ('queued', 'running');
+            CREATE TABLE IF NOT EXISTS artifacts (
+                key TEXT PRIMARY KEY,
+                entry TEXT NOT NULL,
+                last_used REAL
+            );
+            CREATE TABLE IF NOT EXISTS pins (
+                key TEXT NOT NULL,
+                owner TEXT NOT NULL,
+                lease_until REAL,
+                PRIMARY KEY (key, owner)
+            );
+            CREATE TABLE IF NOT EXISTS uploads (
+                id TEXT PRIMARY KEY,
+                filename TEXT,
+                size INTEGER,
+                sha256 TEXT,
+                received INTEGER DEFAULT 0,
+                writer TEXT,
+                lease_until REAL,
+                created REAL,
+                updated REAL
+            );
+        ''')
+        # Databases made before jobs had warnings
+        if 'warnings' not in {row['name'] for row in self._db().execute("PRAGMA table_info(jobs)")}:
+            self._db().execute("ALTER TABLE jobs ADD COLUMN warnings TEXT")
+
+    def _db(self) -> sqlite3.Connection:
+        # One connection per thread; sqlite3 connections shouldn't be shared between threads
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.filepath, timeout=self.busy_timeout, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    @staticmethod
+    def _job(row :sqlite3.Row) -> Optional[dict]:
+        if row is None:
+            return None
+        job = dict(row)
+        for field in _JSON_FIELDS:
+            job[field] = json.loads(job[field]) if job[field] is not None else None
+        job['profile'] = bool(job['profile'])
+        return job
+
+    @staticmethod
+    def _columns(fields :dict) -> dict:
+        return {name: json.dumps(value) if name in _JSON_FIELDS and value is not None else value for name, value in fields.items()}
+
+    def create_job(self, job :dict) -> Tuple[dict, bool]:
+        columns = self._columns(job)
+        try:
+            with self._transaction() as db:
+                db.execute(f"INSERT INTO jobs ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})", list(columns.values()))
+            return self.get_job(job['id']), True
+        except sqlite3.IntegrityError:
+            # Someone already asked for the same thing and it isn't finished yet
+            row = self._db().execute("SELECT * FROM jobs WHERE dedup_key = ? AND status IN (?, ?)", (job.get('dedup_key'), JOB_QUEUED, JOB_RUNNING)).fetchone()
+            if row is None:
+                raise
+            return self._job(row), False
+
+    def get_job(self, job_id :str) -> Optional[dict]:
+        return self._job(self._db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def update_job(self, job_id :str, worker :str = None, **fields) -> bool:
+        if not fields:
+            return True
+        columns = self._columns(fields)
+        query = f"UPDATE jobs SET {', '.join(f'{name} = ?' for name in columns)} WHERE id = ?"
+        values = list(columns.values()) + [job_id]
+        if worker is not None:
+            query += " AND worker = ?"
+            values.append(worker)
+        with self._transaction() as db:
+            return db.execute(query, values).rowcount > 0
+
+    def lease_job(self, worker :str, lease_seconds :float, max_attempts :int) -> Optional[dict]:
+        now = time.time()
+        with self._transaction() as db:
+            # A running job whose lease ran out belongs to a worker that died (or hung); give it to someone else
+            for row in db.execute("SELECT id, attempts, worker FROM jobs WHERE status = ? AND lease_until < ?", (JOB_RUNNING, now)).fetchall():
+                if row['attempts'] >= max_attempts:
+                    logging.error(f"Job {row['id']} was lost by {row['worker']} and has had {row['attempts']} attempts, giving up")
+                    db.execute("UPDATE jobs SET status = ?, error = ?, current_step = ?, worker = NULL, lease_until = NULL, finished = ? WHERE id = ?",
+                               (JOB_FAILED, f"Gave up after {row['attempts']} attempts", 'Failed.', now, row['id']))
+                else:
+                    logging.warning(f"Job {row['id']} was lost by {row['worker']}, putting it back in the queue")
+                    db.execute("UPDATE jobs SET status = ?, current_step = ?, worker = NULL, lease_until = NULL WHERE id = ?",
+                               (JOB_QUEUED, 'Waiting for a free worker.', row['id']))
+            row = db.execute("SELECT id FROM jobs WHERE status = ? ORDER BY created LIMIT 1", (JOB_QUEUED,)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1, started = COALESCE(started, ?) WHERE id = ?",
+                       (JOB_RUNNING, worker, now + lease_seconds, now, row['id']))
+        return self.get_job(row['id'])
+
+    def renew_leases(self, worker :str, job_ids :Iterable[str], lease_seconds :float) -> List[str]:
+        job_ids = list(job_ids)
+        if not job_ids:
+            return []
+        placeholders = ', '.join('?' for _ in job_ids)
+        with self._transaction() as db:
+            db.execute(f"UPDATE jobs SET lease_until = ? WHERE worker = ? AND status = ? AND id IN ({placeholders})",
+                       [time.time() + lease_seconds, worker, JOB_RUNNING] + job_ids)
+            return [row['id'] for row in db.execute(f"SELECT id FROM jobs WHERE worker = ? AND id IN ({placeholders})", [worker] + job_ids)]
+
+    def count_jobs(self, statuses :Iterable[str]) -> int:
+        statuses = list(statuses)
+        return self._db().execute(f"SELECT COUNT(*) FROM jobs WHERE status IN ({', '.join('?' for _ in statuses)})", statuses).fetchone()[0]
+
+    def prune_jobs(self, finished_before :float) -> int:
+        with self._transaction() as db:
+            return db.execute("DELETE FROM jobs WHERE finished IS NOT NULL AND finished < ?", (finished_before,)).rowcount
+
+    def get_artifact(self, key :str) -> Optional[dict]:
+        row = self._db().execute("SELECT entry FROM artifacts WHERE key = ?", (key,)).fetchone()
+        return json.loads(row['entry']) if row is not None else None
+
+    def put_artifact(self, key :str, entry :dict) -> None:
+        with self._transaction() as db:
+            db.execute("INSERT INTO artifacts (key, entry, last_used) VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE SET entry = excluded.entry, last_used = excluded.last_used",
+                       (key, json.dumps(entry), entry.get('last_used')))
+
+    def delete_artifact(self, key :str) -> None:
+        with self._transaction() as db:
+            db.execute("DELETE FROM artifacts WHERE key = ?", (key,))
+
+    def artifacts(self) -> Dict[str, dict]:
+        return {row['key']: json.loads(row['entry']) for row in self._db().execute("SELECT key, entry FROM artifacts ORDER BY last_used")}
+
+    def evict_artifact(self, key :str) -> bool:
+        # Checked and deleted in one transaction, so an entry can't be pinned in between
+        with self._transaction() as db:
+            if db.execute("SELECT 1 FROM pins WHERE key = ? AND lease_until >= ?", (key, time.time())).fetchone() is not None:
+                return False
+            db.execute("DELETE FROM artifacts WHERE key = ?", (key,))
+            return True
+
+    def pin_artifact(self, key :str, owner :str, lease_seconds :float) -> None:
+        with self._transaction() as db:
+            db.execute("INSERT INTO pins (key, owner, lease_until) VALUES (?, ?, ?) ON CONFLICT (key, owner) DO UPDATE SET lease_until = excluded.lease_until",
+                       (key, owner, time.time() + lease_seconds))
+
+    def unpin_artifact(self, key :str, owner :str) -> None:
+        with self._transaction() as db:
+            db.execute("DELETE FROM pins WHERE key = ? AND owner = ?", (key, owner))
+
+    def renew_pins(self, owner :str, lease_seconds :float) -> None:
+        now = time.time()
+        with self._transaction() as db:
+            db.execute("UPDATE pins SET lease_until = ? WHERE owner = ?", (now + lease_seconds, owner))
+            # Nobody is coming back for the ones that ran out
+            db.execute("DELETE FROM pins WHERE lease_until < ?", (now,))
+
+    def pinned_artifacts(self) -> Set[str]:
+        return {row['key'] for row in self._db().execute("SELECT DISTINCT key FROM pins WHERE lease_until >= ?", (time.time(),))}
+
+    @staticmethod
+    def _upload(row :sqlite3.Row) -> Optional[dict]:
+        if row is None:
+            return None
+        upload = dict(row)
+        upload['offset'] = upload.pop('received')
+        return upload
+
+    def create_upload(self, upload :dict) -> None:
+        with self._transaction() as db:
+            db.execute("INSERT INTO uploads (id, filename, size, sha256, received, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (upload['id'], upload['filename'], upload['size'], upload.get('sha256'), upload.get('offset', 0), upload['created'], upload['created']))
+
+    def get_upload(self, upload_id :str) -> Optional[dict]:
+        return self._upload(self._db().execute("SELECT * FROM uploads WHERE id = ?", (upload_id,)).fetchone())
+
+    def claim_upload(self, upload_id :str, writer :str, offset :int, lease_seconds :float) -> Tuple[Optional[dict], bool]:
+        now = time.time()
+        with self._transaction() as db:
+            claimed = db.execute("UPDATE uploads SET writer = ?, lease_until = ?, updated = ? WHERE id = ? AND received = ? AND (writer IS NULL OR writer = ? OR lease_until < ?)",
+                                 (writer, now + lease_seconds, now, upload_id, offset, writer, now)).rowcount > 0
+            return self._upload(db.execute("SELECT * FROM uploads WHERE id = ?", (upload_id,)).fetchone()), claimed
+
+    def release_upload(self, upload_id :str, writer :str, offset :int) -> None:
+        with self._transaction() as db:
+            db.execute("UPDATE uploads SET received = ?, writer = NULL, lease_until = NULL, updated = ? WHERE id = ? AND writer = ?",
+                       (offset, time.time(), upload_id, writer))
+
+    def delete_upload(self, upload_id :str) -> None:
+        with self._transaction() as db:
+            db.execute("DELETE FROM uploads WHERE id = ?", (upload_id,))
+
+    def prune_uploads(self, updated_before :float) -> List[str]:
+        with self._transaction() as db:
+            upload_ids = [row['id'] for row in db.execute("SELECT id FROM uploads WHERE updated < ? AND (writer IS NULL OR lease_until < ?)", (updated_before, time.time()))]
+            db.executemany("DELETE FROM uploads WHERE id = ?", [(upload_id,) for upload_id in upload_ids])
+        return upload_ids
+
+def open_store(url :str) -> Store:
+    # sqlite:///path/to/file.db, or just a path
+    if url.startswith('sqlite:///'):
+        return SQLiteStore(url[len('sqlite:///'):])
+    if '://' in url:
+        raise ValueError(f"Don't know how to open a store at {url}")
+    return SQLiteStore(url)
@@ -0,0 +1,88 @@
+# Standard library imports
+import re
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+
+# tiktoken gives exact counts when it's installed; otherwise four characters a token is close enough
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding('cl100k_base')
+except ImportError:
+    _encoding = None
+
+def count_tokens(text :str) -> int:
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return len(text) // 4
+
+def split_into_chunks(text :str, max_tokens :int) -> List[str]:
+    # Break on sentence ends so no chunk starts mid-thought. A single huge sentence is split on words.
+    sentences = re.split(r'(?<=[.!?])\s+', text.strip())
+    chunks = []
+    current = []
+    current_tokens = 0
+    for sentence in sentences:
+        tokens = count_tokens(sentence)
+        if tokens > max_tokens:
+            words = sentence.split()
+            step = max(1, len(words) * max_tokens // tokens)
+            pieces = [' '.join(words[i:i + step]) for i in range(0, len(words), step)]
+        else:
+            pieces = [sentence]
+        for piece in pieces:
+            piece_tokens = count_tokens(piece) + 1  # and the space that joins it on
+            if current and current_tokens + piece_tokens > max_tokens:
+                chunks.append(' '.join(current))
+                current = []
+                current_tokens = 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append(' '.join(current))
+    return chunks
+
+def split_into_groups(notes :List[str], max_tokens :int) -> List[List[str]]:
+    groups = [[]]
+    tokens = 0
+    for note in notes:
+        note_tokens = count_tokens(note)
+        if groups[-1] and tokens + note_tokens > max_tokens:
+            groups.append([])
+            tokens = 0
+        groups[-1].append(note)
+        tokens += note_tokens
+    return groups
+
+def build_notes(
+        transcript :str,
+        complete :Callable[[str, str, int], str],
+        chunk_tokens :int = 6000,
+        notes_tokens :int = 800,
+        concurrency :int = 4
+        ) -> str:
+    # Map: notes for every chunk at the same time. Reduce: merge neighbouring notes until they fit in one chunk.
+    # complete(type, prompt, max_tokens) asks the model, with type 'notes' for a chunk and 'combine-notes' for a group.
+    if count_tokens(transcript) <= chunk_tokens:
+        logging.info(f"Transcript fits in one chunk, no notes needed")
+        return transcript
+    chunks = split_into_chunks(transcript, chunk_tokens)
+    logging.info(f"Taking notes on {len(chunks)} transcript chunks")
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        # Each call carries our context along so its tokens are counted against the stage that asked
+        futures = [executor.submit(contextvars.copy_context().run, complete, 'notes', chunk, notes_tokens) for chunk in chunks]
+        notes = [future.result() for future in futures]
+
+    level = 1
+    while len(notes) > 1 and count_tokens('\n\n'.join(notes)) > chunk_tokens:
+        # Group as many neighbouring notes as fit in a chunk and merge each group
+        groups = split_into_groups(notes, chunk_tokens)
+        if len(groups) == len(notes):
+            break
+        logging.info(f"Merging {len(notes)} sets of notes into {len(groups)} (level {level})")
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, complete, 'combine-notes', '\n\n'.join(group), notes_tokens) for group in groups]
+            notes = [future.result() for future in futures]
+        level += 1
+    return '\n\n'.join(notes)
@@ -0,0 +1,223 @@
+# Standard library imports
+import os
+import time
+import json
+import wave
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, List, Tuple
+
+# Third-party imports for audio processing
+import numpy as np
+
+# Local imports
+from scripts.metrics import record_trimmed_audio
+from scripts.vad import TimeMap, trim_silence, map_segments, speech_threshold
+
+WHISPER_SAMPLE_RATE = 16000
+
+# Each worker process keeps its own model so it's only loaded once per process
+_worker_model = None
+_worker_load_seconds = None
+
+# The pool outlives a single transcription so its workers stay warm between jobs
+_pool = None
+_pool_key = None
+_pool_lock = threading.Lock()
+
+def _read_frames(wav :wave.Wave_read, n_frames :int) -> np.ndarray:
+    # Returns mono float32 samples in [-1, 1] at the file's own sample rate
+    raw = wav.readframes(n_frames)
+    width = wav.getsampwidth()
+    if width == 1:
+        samples = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif width == 2:
+        samples = np.frombuffer(raw, dtype='<i2').astype(np.float32) / 32768
+    elif width == 4:
+        samples = np.frombuffer(raw, dtype='<i4').astype(np.float32) / 2147483648
+    else:
+        raise ValueError(f"Unsupported sample width: {width} bytes")
+    channels = wav.getnchannels()
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1)
+    return samples
+
+def _resample(samples :np.ndarray, rate :int) -> np.ndarray:
+    if rate == WHISPER_SAMPLE_RATE or len(samples) == 0:
+        return samples
+    duration = len(samples) / rate
+    target = np.linspace(0, duration, int(duration * WHISPER_SAMPLE_RATE), endpoint=False)
+    source = np.arange(len(samples)) / rate
+    return np.interp(target, source, samples).astype(np.float32)
+
+def read_segment(audio_filepath :str, start_frame :int, n_frames :int) -> np.ndarray:
+    # Only the requested slice is read, so memory is bounded by the segment length
+    with wave.open(audio_filepath, 'rb') as wav:
+        wav.setpos(start_frame)
+        samples = _read_frames(wav, n_frames)
+        return _resample(samples, wav.getframerate())
+
+def window_energy(audio_filepath :str, window_seconds :float = 0.03, block_seconds :float = 30) -> Tuple[np.ndarray, int, int]:
+    # RMS energy of every short window in the file, read a block at a time
+    with wave.open(audio_filepath, 'rb') as wav:
+        rate = wav.getframerate()
+        total_frames = wav.getnframes()
+        window = max(1, int(rate * window_seconds))
+        block = window * max(1, int(block_seconds / window_seconds))
+        energies = []
+        while True:
+            samples = _read_frames(wav, block)
+            if len(samples) == 0:
+                break
+            usable = len(samples) - len(samples) % window
+            if usable:
+                energies.append(np.sqrt(np.mean(samples[:usable].reshape(-1, window) ** 2, axis=1)))
+            if usable < len(samples):
+                energies.append(np.array([np.sqrt(np.mean(samples[usable:] ** 2))], dtype=np.float32))
+    energy = np.concatenate(energies) if energies else np.zeros(0, dtype=np.float32)
+    return energy, window, total_frames
+
+def split_on_silence(
+        audio_filepath :str,
+        segment_seconds :float = 30,
+        window_seconds :float = 0.03,
+        energy :Tuple[np.ndarray, int, int] = None
+        ) -> List[Tuple[int, int]]:
+    # Cut roughly every segment_seconds, at the quietest point within half a segment either side.
+    # Pass what window_energy returned if you already have it.
+    energy, window, total_frames = energy or window_energy(audio_filepath, window_seconds)
+    with wave.open(audio_filepath, 'rb') as wav:
+        rate = wav.getframerate()
+    windows_per_segment = max(2, int(segment_seconds * rate / window))
+    cuts = [0]
+    start = 0
+    while len(energy) - start > windows_per_segment * 1.5:
+        low = start + windows_per_segment // 2
+        high = min(len(energy), start + windows_per_segment * 3 // 2)
+        cut = low + int(np.argmin(energy[low:high]))
+        cuts.append(cut)
+        start = cut
+    bounds = [c * window for c in cuts] + [total_frames]
+    return [(bounds[i], bounds[i + 1] - bounds[i]) for i in range(len(bounds) - 1) if bounds[i + 1] > bounds[i]]
+
+def _init_worker(model_name :str) -> None:
+    global _worker_model, _worker_load_seconds
+    import whisper
+    started = time.perf_counter()
+    _worker_model = whisper.load_model(model_name)
+    _worker_load_seconds = time.perf_counter() - started
+    logging.info(f"Loaded Whisper model '{model_name}' in worker process {os.getpid()} in {_worker_load_seconds:.1f}s")
+
+def _silent_segment(offset :float, seconds :float) -> dict:
+    # What a segment with no speech in it would have come back as, without sending it anywhere
+    return {'pid': None, 'load_seconds': None, 'inference_seconds': 0.0, 'start': offset, 'end': offset + seconds, 'removed_seconds': seconds, 'text': '', 'segments': []}
+
+def _transcribe_segment(audio_filepath :str, start_frame :int, n_frames :int, offset :float, vad :dict = None) -> dict:
+    # With vad options the silences are trimmed first, here in the worker, and the timestamps mapped back
+    samples = read_segment(audio_filepath, start_frame, n_frames)
+    timemap = TimeMap.identity(len(samples) / WHISPER_SAMPLE_RATE)
+    if vad is not None:
+        samples, timemap = trim_silence(samples, WHISPER_SAMPLE_RATE, **vad)
+        if len(samples) == 0:
+            return _silent_segment(offset, timemap.original_seconds)
+    started = time.perf_counter()
+    result = _worker_model.transcribe(samples, fp16=False)
+    return {
+        'pid': os.getpid(),
+        'load_seconds': _worker_load_seconds,
+        'inference_seconds': time.perf_counter() - started,
+        'start': offset,
+        'end': offset + timemap.original_seconds,
+        'removed_seconds': timemap.removed_seconds,
+        'text': result['text'].strip(),
+        'segments': map_segments(result.get('segments', []), timemap, offset)
+    }
+
+def get_pool(model_name :str, processes :int) -> ProcessPoolExecutor:
+    global _pool, _pool_key
+    with _pool_lock:
+        if _pool is None or _pool_key != (model_name, processes):
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            # Spawn so the workers don't inherit the web app's threads and locks
+            context = multiprocessing.get_context('spawn')
+            _pool = ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=_init_worker, initargs=(model_name,))
+            _pool_key = (model_name, processes)
+        return _pool
+
+def transcribe_segmented(
+        audio_filepath :str,
+        transcription_filepath :str,
+        model_name :str = "base",
+        processes :int = None,
+        segment_seconds :float = 30,
+        on_partial :Callable[[str, int, int], None] = None,
+        vad :dict = None
+        ) -> str:
+    with wave.open(audio_filepath, 'rb') as wav:
+        rate = wav.getframerate()
+    energy = window_energy(audio_filepath)
+    segments = split_on_silence(audio_filepath, segment_seconds, energy=energy)
+    processes = processes or os.cpu_count() or 1
+    logging.info(f"Transcribing {audio_filepath} as {len(segments)} segments on {processes} processes")
+
+    results = [None] * len(segments)
+    if vad is not None:
+        # One threshold for the whole recording, so a segment that's nothing but dead air is seen as such
+        # and never sent to Whisper, and the workers all agree on what counts as speech
+        levels = 10 * np.log10(energy[0] ** 2 + 1e-10)
+        window = energy[1]
+        threshold = speech_threshold(levels, **{k: vad[k] for k in ('margin_db', 'min_threshold_db', 'max_threshold_db') if k in vad})
+        vad = dict(vad, threshold_db=threshold)
+        min_speech_windows = max(1, int(round(0.1 * rate / window)))
+        for i, (start, n_frames) in enumerate(segments):
+            if np.count_nonzero(levels[start // window:(start + n_frames) // window + 1] > threshold) < min_speech_windows:
+                results[i] = _silent_segment(start / rate, n_frames / rate)
+        skipped = sum(r is not None for r in results)
+        if skipped:
+            logging.info(f"Skipping {skipped} of {len(segments)} segments with no speech in them")
+    if all(r is not None for r in results):
+        raise RuntimeError(f"No speech found in {audio_filepath}")
+
+    base_filepath = os.path.splitext(transcription_filepath)[0]
+    partial_filepath = base_filepath + '.partial.txt'
+    done = 0
+    executor = get_pool(model_name, processes)
+    futures = {
+        executor.submit(_transcribe_segment, audio_filepath, start, n_frames, start / rate, vad): i
+        for i, (start, n_frames) in enumerate(segments) if results[i] is None
+    }
+    for future in as_completed(futures):
+        results[futures[future]] = future.result()
+        # Only the unbroken run from the start is published so the partial text always reads in order
+        previous = done
+        while done < len(results) and results[done] is not None:
+            done += 1
+        if done > previous:
+            partial = ' '.join(r['text'] for r in results[:done] if r['text'])
+            with open(partial_filepath, 'w') as f:
+                f.write(partial)
+            if on_partial is not None:
+                on_partial(partial, done, len(results))
+
+    # Model loading happens once per worker, so it's reported apart from the time spent transcribing
+    transcribed = [r for r in results if r['pid'] is not None]
+    load_seconds = sum({r['pid']: r['load_seconds'] or 0 for r in transcribed}.values())
+    inference_seconds = sum(r['inference_seconds'] for r in transcribed)
+    logging.info(f"Segmented transcription used {len({r['pid'] for r in transcribed})} workers: {load_seconds:.1f}s loading models, {inference_seconds:.1f}s transcribing")
+    if vad is not None:
+        original_seconds = sum(r['end'] - r['start'] for r in results)
+        removed_seconds = sum(r['removed_seconds'] for r in results)
+        record_trimmed_audio(original_seconds, removed_seconds)
+        logging.info(f"Trimmed {removed_seconds:.1f}s of silence from {original_seconds:.1f}s of audio before transcribing")
+
+    text = ' '.join(r['text'] for r in results if r['text'])
+    with open(base_filepath + '.segments.json', 'w') as f:
+        json.dump([s for r in results for s in r['segments']], f)
+    with open(transcription_filepath, 'w') as f:
+        f.write(text)
+    if os.path.exists(partial_filepath):
+        os.remove(partial_filepath)
+    return text
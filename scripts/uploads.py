@@ -0,0 +1,187 @@
+# Standard library imports
+import os
+import re
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from typing import BinaryIO, Dict, Optional, Tuple
+
+# Local imports
+from scripts.cache import ArtifactCache
+from scripts.store import Store
+
+# Upload IDs and hashes end up in file paths, so nothing but hex gets through
+_HEX = re.compile(r'^[0-9a-f]+$')
+
+class UploadError(Exception):
+    pass
+
+class OffsetMismatch(UploadError):
+    def __init__(self, offset :int):
+        super().__init__(f"Expected a chunk starting at byte {offset}")
+        self.offset = offset
+
+class Upload:
+    def __init__(self, upload_id :str, filename :str, size :int, sha256 :str = None, offset :int = 0, created :float = None):
+        self.id = upload_id
+        self.filename = filename
+        self.size = size
+        self.sha256 = sha256
+        self.offset = offset
+        self.created = created or time.time()
+
+    @classmethod
+    def from_record(cls, record :dict) -> 'Upload':
+        return cls(record['id'], record['filename'], record['size'], record['sha256'], record['offset'], record['created'])
+
+    def to_dict(self) -> dict:
+        return {
+            'upload_id': self.id,
+            'filename': self.filename,
+            'size': self.size,
+            'sha256': self.sha256,
+            'offset': self.offset,
+            'created': self.created
+        }
+
+class UploadManager:
+    # Parts go straight to disk under the cache folder (shared by every instance, like the cache itself) and
+    # the uploads are kept in the store, so a chunk can land on any worker. Only one request at a time gets
+    # to write to an upload: it claims it in the store for claim_seconds, and keeps renewing the claim while
+    # the chunk is still coming in.
+    def __init__(self, store :Store, cache :ArtifactCache, chunk_size :int = 8 * 1024 * 1024, expire_seconds :int = 24 * 3600, claim_seconds :float = 60):
+        self.store = store
+        self.cache = cache
+        self.chunk_size = chunk_size
+        self.expire_seconds = expire_seconds
+        self.claim_seconds = claim_seconds
+        self.folder = os.path.join(cache.root, 'incoming')
+        # Running hashes of the uploads this process wrote the last chunk of, with the offset they got to
+        self._hashers: Dict[str, Tuple[int, object]] = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+
+    def _part_path(self, upload_id :str) -> str:
+        return os.path.join(self.folder, f"{upload_id}.part")
+
+    def _remove(self, upload_id :str) -> None:
+        self.store.delete_upload(upload_id)
+        with self._lock:
+            self._hashers.pop(upload_id, None)
+        if os.path.exists(self._part_path(upload_id)):
+            os.remove(self._part_path(upload_id))
+
+    def _prune(self) -> None:
+        # Uploads nobody has come back to finish in a day are thrown away
+        for upload_id in self.store.prune_uploads(time.time() - self.expire_seconds):
+            logging.info(f"Removing abandoned upload {upload_id}")
+            self._remove(upload_id)
+
+    def get(self, upload_id :str) -> Optional[Upload]:
+        if not _HEX.match(upload_id):
+            return None
+        record = self.store.get_upload(upload_id)
+        return Upload.from_record(record) if record is not None else None
+
+    def start(self, filename :str, size :int, sha256 :str = None) -> dict:
+        self._prune()
+        size = int(size)
+        if size <= 0:
+            raise UploadError(f"Not a file size: {size}")
+        if sha256 and not (len(sha256) == 64 and _HEX.match(sha256.lower())):
+            raise UploadError(f"Not a SHA-256 hex digest: {sha256}")
+        if sha256:
+            key = f"sha256-{sha256.lower()}"
+            if self.cache.has(key, 'video'):
+                logging.info(f"Upload of {filename} skipped, we already have {key}")
+                return {'status': 'exists', 'key': key}
+        upload = Upload(uuid.uuid4().hex, os.path.basename(filename), size, sha256.lower() if sha256 else None)
+        open(self._part_path(upload.id), 'wb').close()
+        self.store.create_upload(dict(upload.to_dict(), id=upload.id))
+        with self._lock:
+            self._hashers[upload.id] = (0, hashlib.sha256())
+        logging.info(f"Started upload {upload.id} for {filename} ({size} bytes)")
+        return dict(upload.to_dict(), status='started', chunk_size=self.chunk_size)
+
+    def _claim(self, upload_id :str, writer :str, offset :int) -> Upload:
+        record, claimed = self.store.claim_upload(upload_id, writer, offset, self.claim_seconds)
+        if record is None:
+            raise UploadError(f"Unknown upload: {upload_id}")
+        if not claimed:
+            # Either the client is out of step or another request is still writing; either way it should
+            # ask where the upload is and carry on from there
+            raise OffsetMismatch(record['offset'])
+        return Upload.from_record(record)
+
+    def _hasher(self, upload :Upload):
+        # The running hash if this process has it at the right offset, otherwise caught up from the part
+        # file (the last chunk went to another worker, or this one restarted)
+        with self._lock:
+            offset, hasher = self._hashers.pop(upload.id, (None, None))
+        if offset == upload.offset:
+            return hasher
+        hasher = hashlib.sha256()
+        with open(self._part_path(upload.id), 'rb') as f:
+            remaining = upload.offset
+            while remaining > 0:
+                chunk = f.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                remaining -= len(chunk)
+        return hasher
+
+    def write_chunk(self, upload_id :str, offset :int, stream :BinaryIO) -> int:
+        writer = uuid.uuid4().hex
+        upload = self._claim(upload_id, writer, offset)
+        hasher = self._hasher(upload)
+        claimed = time.time()
+        try:
+            with open(self._part_path(upload.id), 'r+b') as f:
+                f.seek(upload.offset)
+                f.truncate()
+                while True:
+                    chunk = stream.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    if upload.offset + len(chunk) > upload.size:
+                        raise UploadError(f"Upload {upload.id} is larger than the {upload.size} bytes we were told about")
+                    f.write(chunk)
+                    hasher.update(chunk)
+                    upload.offset += len(chunk)
+                    if time.time() - claimed > self.claim_seconds / 3:
+                        # Nothing is recorded until the chunk is done, so the claim is still at the offset it started from
+                        self._claim(upload.id, writer, offset)
+                        claimed = time.time()
+        finally:
+            # Whatever made it to disk counts, even if the client dropped halfway through the chunk
+            with self._lock:
+                self._hashers[upload.id] = (upload.offset, hasher)
+            self.store.release_upload(upload.id, writer, upload.offset)
+        return upload.offset
+
+    def complete(self, upload_id :str) -> str:
+        record = self.store.get_upload(upload_id) if _HEX.match(upload_id) else None
+        if record is None:
+            raise UploadError(f"Unknown upload: {upload_id}")
+        if record['offset'] != record['size']:
+            raise OffsetMismatch(record['offset'])
+        # Claimed like a chunk, so two completes can't both move the file
+        writer = uuid.uuid4().hex
+        upload = self._claim(upload_id, writer, record['size'])
+        digest = self._hasher(upload).hexdigest()
+        if upload.sha256 and upload.sha256 != digest:
+            self._remove(upload.id)
+            raise UploadError(f"Upload {upload.id} doesn't match the hash it was started with")
+        key = f"sha256-{digest}"
+        if self.cache.lookup(key, 'video') is not None:
+            logging.info(f"Upload {upload.id} turned out to be {key}, which we already have")
+        else:
+            os.replace(self._part_path(upload.id), self.cache.path(key, 'video'))
+            self.cache.set_meta(key, source=upload.filename)
+            self.cache.record(key, 'video')
+        self._remove(upload.id)
+        logging.info(f"Finished upload {upload.id} as {key}")
+        return key
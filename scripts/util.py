@@ -0,0 +1,26 @@
+# Standard library imports
+import os
+import uuid
+import socket
+from contextlib import contextmanager
+from typing import IO, Iterator
+
+@contextmanager
+def atomic_write(filepath :str, mode :str = 'w') -> Iterator[IO]:
+    # Written to the side and swapped in when the block finishes, so readers (and a crash part way through)
+    # only ever see the old file or the whole new one. The temporary name is unique so two processes
+    # saving the same file at once don't write into each other's copy.
+    temp_filepath = f"{filepath}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        with open(temp_filepath, mode) as f:
+            yield f
+        os.replace(temp_filepath, filepath)
+    except BaseException:
+        if os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
+        raise
+
+def owner_id() -> str:
+    # Names a worker in the shared store (job leases, cache pins): which machine, which process, and a few
+    # random characters so two managers in one process, or a reused pid, are never mistaken for each other
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
@@ -0,0 +1,143 @@
+# Standard library imports
+from typing import List, Tuple
+
+# Third-party imports for audio processing
+import numpy as np
+
+# Samples come in the way Whisper takes them: 16 kHz mono float32
+SAMPLE_RATE = 16000
+
+class TimeMap:
+    # Where each stretch of kept audio came from, so times in the trimmed audio (Whisper's segment
+    # timestamps) can be turned back into times in the original recording
+    def __init__(self, trimmed_starts :np.ndarray, original_starts :np.ndarray, lengths :np.ndarray, original_seconds :float):
+        self.trimmed_starts = trimmed_starts
+        self.original_starts = original_starts
+        self.lengths = lengths
+        self.original_seconds = original_seconds
+
+    @classmethod
+    def identity(cls, seconds :float) -> 'TimeMap':
+        return cls(np.zeros(1), np.zeros(1), np.array([seconds]), seconds)
+
+    @property
+    def kept_seconds(self) -> float:
+        return float(self.lengths.sum())
+
+    @property
+    def removed_seconds(self) -> float:
+        return self.original_seconds - self.kept_seconds
+
+    def to_original(self, seconds, end :bool = False):
+        # Works on a single time or an array of them. An end time that falls exactly on a cut belongs to
+        # the stretch before it, a start time to the one after.
+        seconds = np.asarray(seconds, dtype=np.float64)
+        if len(self.trimmed_starts) == 0:
+            # Nothing was kept, so there's nothing to map
+            return float(seconds) if seconds.ndim == 0 else seconds
+        i = np.searchsorted(self.trimmed_starts, seconds, side='left' if end else 'right') - 1
+        i = np.clip(i, 0, len(self.trimmed_starts) - 1)
+        original = self.original_starts[i] + np.minimum(seconds - self.trimmed_starts[i], self.lengths[i])
+        return float(original) if original.ndim == 0 else original
+
+    def report(self) -> dict:
+        return {
+            'original_seconds': round(self.original_seconds, 3),
+            'kept_seconds': round(self.kept_seconds, 3),
+            'removed_seconds': round(self.removed_seconds, 3),
+            'removed_share': round(self.removed_seconds / self.original_seconds, 3) if self.original_seconds else 0.0,
+            'regions': len(self.lengths)
+        }
+
+def frame_levels(samples :np.ndarray, frame :int) -> np.ndarray:
+    # Loudness of every frame in dBFS, all frames at once. A short tail is left out.
+    n_frames = len(samples) // frame
+    frames = samples[:n_frames * frame].reshape(n_frames, frame).astype(np.float32)
+    return 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10)
+
+def speech_threshold(
+        levels :np.ndarray,
+        margin_db :float = 12.0,
+        min_threshold_db :float = -55.0,
+        max_threshold_db :float = -35.0
+        ) -> float:
+    # margin_db above the noise floor (the quietest tenth of the frames), kept between two absolute levels:
+    # anything under min_threshold_db is silence however quiet the recording is, and anything over
+    # max_threshold_db is speech, so a recording with no quiet in it is never cut into
+    if len(levels) == 0:
+        return min_threshold_db
+    floor = float(np.percentile(levels, 10))
+    return float(np.clip(floor + margin_db, min_threshold_db, max_threshold_db))
+
+def speech_regions(
+        samples :np.ndarray,
+        rate :int = SAMPLE_RATE,
+        frame_seconds :float = 0.03,
+        margin_db :float = 12.0,
+        min_threshold_db :float = -55.0,
+        max_threshold_db :float = -35.0,
+        threshold_db :float = None,
+        min_silence_seconds :float = 1.0,
+        padding_seconds :float = 0.25,
+        min_speech_seconds :float = 0.1
+        ) -> np.ndarray:
+    # Start and end samples of the stretches that sound like someone talking, as an (n, 2) array, empty if
+    # there are none. Frames louder than the threshold are speech; pass threshold_db when it was worked out
+    # over a whole recording and these samples are only part of it. Pauses shorter than min_silence_seconds
+    # stay in, and every stretch keeps padding_seconds either side so words aren't clipped.
+    frame = max(1, int(rate * frame_seconds))
+    if len(samples) < frame:
+        return np.array([[0, len(samples)]]) if len(samples) else np.zeros((0, 2), dtype=np.int64)
+    levels = frame_levels(samples, frame)
+    if threshold_db is None:
+        threshold_db = speech_threshold(levels, margin_db, min_threshold_db, max_threshold_db)
+    speech = levels > threshold_db
+
+    # Runs of speech frames as [start, end) frame indices
+    edges = np.diff(np.concatenate(([0], speech.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    # Clicks and bumps aren't speech
+    long_enough = (ends - starts) >= max(1, int(round(min_speech_seconds / frame_seconds)))
+    starts, ends = starts[long_enough], ends[long_enough]
+    if len(starts) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+
+    # Join the runs separated by a short pause, then pad what's left
+    pad = int(round(padding_seconds / frame_seconds))
+    min_gap = max(2 * pad, int(round(min_silence_seconds / frame_seconds)))
+    breaks = (starts[1:] - ends[:-1]) >= min_gap
+    starts = np.concatenate((starts[:1], starts[1:][breaks]))
+    ends = np.concatenate((ends[:-1][breaks], ends[-1:]))
+    regions = np.stack((np.maximum(starts - pad, 0), np.minimum(ends + pad, len(levels))), axis=1) * frame
+    # Speech running into the end of the recording takes the leftover tail with it
+    if regions[-1, 1] == len(levels) * frame:
+        regions[-1, 1] = len(samples)
+    return regions
+
+def trim_silence(samples :np.ndarray, rate :int = SAMPLE_RATE, **options) -> Tuple[np.ndarray, TimeMap]:
+    # The samples with the long silences taken out (each one shrinks to twice the padding), and the map
+    # back to the original times. If nothing sounds like speech, nothing is left.
+    original_seconds = len(samples) / rate
+    regions = speech_regions(samples, rate, **options)
+    if len(regions) == 0:
+        return samples[:0], TimeMap(np.zeros(0), np.zeros(0), np.zeros(0), original_seconds)
+    # One pass to mark every sample we keep: +1 where a region starts, -1 where it ends, then a running sum
+    delta = np.zeros(len(samples) + 1, dtype=np.int32)
+    np.add.at(delta, regions[:, 0], 1)
+    np.add.at(delta, regions[:, 1], -1)
+    keep = np.cumsum(delta[:-1]) > 0
+    lengths = (regions[:, 1] - regions[:, 0]) / rate
+    trimmed_starts = np.concatenate(([0.0], np.cumsum(lengths)[:-1]))
+    return samples[keep], TimeMap(trimmed_starts, regions[:, 0] / rate, lengths, original_seconds)
+
+def map_segments(segments :List[dict], timemap :TimeMap, offset :float = 0.0) -> List[dict]:
+    # Whisper's segments with their times moved back onto the original recording
+    if not segments:
+        return []
+    starts = timemap.to_original([s['start'] for s in segments])
+    ends = timemap.to_original([s['end'] for s in segments], end=True)
+    return [
+        {'start': round(offset + float(start), 3), 'end': round(offset + float(end), 3), 'text': s['text'].strip()}
+        for s, start, end in zip(segments, starts, ends)
+    ]
@@ -0,0 +1,92 @@
+# Standard library imports
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Dict
+
+# Third-party imports for audio processing
+import numpy as np
+
+class WhisperService:
+    # Keeps one Whisper model loaded and works through requests from a queue, one at a time, on a single
+    # thread. Whisper's transcribe decodes one recording per call, so nothing is batched: what this saves
+    # is loading the model for every job, and two jobs fighting over the CPU with a model each.
+    def __init__(self, model_name :str = "base"):
+        self.model_name = model_name
+        self.model = None
+        self.load_seconds = None
+        self.requests = 0
+        self.inference_seconds = 0.0
+        self._load_error = None
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=f"whisper-{model_name}", daemon=True)
+        self._thread.start()
+
+    def _load(self) -> None:
+        import whisper
+        started = time.perf_counter()
+        self.model = whisper.load_model(self.model_name)
+        self.load_seconds = time.perf_counter() - started
+        logging.info(f"Loaded Whisper model '{self.model_name}' in {self.load_seconds:.1f}s")
+
+    def _run(self) -> None:
+        try:
+            self._load()
+        except Exception as e:
+            logging.error(f"Could not load Whisper model '{self.model_name}': {e}")
+            self._load_error = e
+        while True:
+            samples, options, future = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            if self.model is None:
+                future.set_exception(RuntimeError(f"Whisper model '{self.model_name}' is not loaded: {self._load_error}"))
+                continue
+            started = time.perf_counter()
+            try:
+                result = self.model.transcribe(samples, fp16=False, **options)
+                future.set_result(result)
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                elapsed = time.perf_counter() - started
+                self.requests += 1
+                self.inference_seconds += elapsed
+                logging.info(f"Whisper inference took {elapsed:.1f}s for {len(samples) / 16000:.1f}s of audio")
+
+    def submit(self, samples :np.ndarray, **options) -> Future:
+        future = Future()
+        self._queue.put((samples, options, future))
+        return future
+
+    def transcribe(self, samples :np.ndarray, **options) -> dict:
+        return self.submit(samples, **options).result()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'model': self.model_name,
+            'loaded': self.model is not None,
+            'load_seconds': self.load_seconds,
+            'requests': self.requests,
+            'queued': self._queue.qsize(),
+            'inference_seconds': round(self.inference_seconds, 3),
+            'avg_inference_seconds': round(self.inference_seconds / self.requests, 3) if self.requests else None
+        }
+
+_services: Dict[str, WhisperService] = {}
+_services_lock = threading.Lock()
+
+def get_whisper_service(model_name :str = "base") -> WhisperService:
+    # One service per model per process, started the first time someone asks for it
+    with _services_lock:
+        service = _services.get(model_name)
+        if service is None:
+            service = WhisperService(model_name)
+            _services[model_name] = service
+        return service
+
+def whisper_stats() -> Dict[str, Dict[str, float]]:
+    with _services_lock:
+        return {name: service.stats() for name, service in _services.items()}
@@ -0,0 +1,102 @@
+// Hashes a file for the upload form, one slice at a time, so a file of any size can be checked against the
+// server before it's sent without ever holding all of it in memory. SubtleCrypto only hashes whole buffers.
+// Post {file: File} to it; it answers {progress: 0..1} as it goes and {sha256: hex} (or {error}) at the end.
+
+// Int32Array rather than Uint32Array: values over 2^31 would come out as doubles and slow every round down
+var K = new Int32Array([
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
+]);
+
+function Sha256() {
+    this.h = new Int32Array([0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19]);
+    this.w = new Int32Array(64);
+    this.buffer = new Uint8Array(64);
+    this.buffered = 0;
+    this.length = 0;
+}
+
+Sha256.prototype.block = function(data, offset) {
+    var w = this.w, h = this.h, i;
+    for (i = 0; i < 16; i++) {
+        var j = offset + i * 4;
+        w[i] = (data[j] << 24) | (data[j + 1] << 16) | (data[j + 2] << 8) | data[j + 3];
+    }
+    for (i = 16; i < 64; i++) {
+        var x = w[i - 15], y = w[i - 2];
+        var s0 = ((x >>> 7) | (x << 25)) ^ ((x >>> 18) | (x << 14)) ^ (x >>> 3);
+        var s1 = ((y >>> 17) | (y << 15)) ^ ((y >>> 19) | (y << 13)) ^ (y >>> 10);
+        w[i] = (w[i - 16] + s0 + w[i - 7] + s1) | 0;
+    }
+    var a = h[0], b = h[1], c = h[2], d = h[3], e = h[4], f = h[5], g = h[6], k = h[7];
+    for (i = 0; i < 64; i++) {
+        var t1 = (k + (((e >>> 6) | (e << 26)) ^ ((e >>> 11) | (e << 21)) ^ ((e >>> 25) | (e << 7))) + ((e & f) ^ (~e & g)) + K[i] + w[i]) | 0;
+        var t2 = ((((a >>> 2) | (a << 30)) ^ ((a >>> 13) | (a << 19)) ^ ((a >>> 22) | (a << 10))) + ((a & b) ^ (a & c) ^ (b & c))) | 0;
+        k = g; g = f; f = e; e = (d + t1) | 0; d = c; c = b; b = a; a = (t1 + t2) | 0;
+    }
+    // The typed array keeps only the low 32 bits, which is the addition SHA-256 wants
+    h[0] += a; h[1] += b; h[2] += c; h[3] += d; h[4] += e; h[5] += f; h[6] += g; h[7] += k;
+};
+
+Sha256.prototype.update = function(data) {
+    var i = 0;
+    this.length += data.length;
+    if (this.buffered) {
+        i = Math.min(64 - this.buffered, data.length);
+        this.buffer.set(data.subarray(0, i), this.buffered);
+        this.buffered += i;
+        if (this.buffered < 64) {
+            return;
+        }
+        this.block(this.buffer, 0);
+        this.buffered = 0;
+    }
+    for (; i + 64 <= data.length; i += 64) {
+        this.block(data, i);
+    }
+    if (i < data.length) {
+        this.buffer.set(data.subarray(i), 0);
+        this.buffered = data.length - i;
+    }
+};
+
+Sha256.prototype.hex = function() {
+    // A 1 bit, zeros up to 8 bytes short of a block, then the length in bits as a 64-bit big-endian number
+    var bits = this.length * 8;
+    var padding = new Uint8Array((this.buffered < 56 ? 56 : 120) - this.buffered + 8);
+    var n = padding.length;
+    var high = Math.floor(bits / 0x100000000), low = bits >>> 0;
+    padding[0] = 0x80;
+    for (var i = 0; i < 4; i++) {
+        padding[n - 8 + i] = (high >>> (24 - 8 * i)) & 0xff;
+        padding[n - 4 + i] = (low >>> (24 - 8 * i)) & 0xff;
+    }
+    this.update(padding);
+    return Array.from(this.h).map(function(x) { return ('0000000' + (x >>> 0).toString(16)).slice(-8); }).join('');
+};
+
+var SLICE_BYTES = 4 * 1024 * 1024;
+
+self.onmessage = async function(e) {
+    var file = e.data.file;
+    var sha = new Sha256();
+    try {
+        for (var offset = 0; offset < file.size; offset += SLICE_BYTES) {
+            sha.update(new Uint8Array(await file.slice(offset, offset + SLICE_BYTES).arrayBuffer()));
+            self.postMessage({progress: Math.min(offset + SLICE_BYTES, file.size) / file.size});
+        }
+        self.postMessage({sha256: sha.hex()});
+    } catch (err) {
+        self.postMessage({error: String(err)});
+    }
+};
+
+if (typeof module !== 'undefined') {
+    module.exports = Sha256;
+}
@@ -0,0 +1,6 @@
+# Standard library imports
+import os
+import sys
+
+# The tests import the scripts package the same way app.py does, from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,91 @@
+# Standard library imports
+import os
+import sys
+import hashlib
+import importlib
+import threading
+
+# Third-party imports
+import pytest
+
+@pytest.fixture(scope='module')
+def app_module(tmp_path_factory):
+    # The folders in scripts/config.py are relative to where the app starts, so it starts somewhere empty
+    workdir = tmp_path_factory.mktemp('app')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    os.environ['BLOGARIZE_LOG_FILE'] = ''
+    # Jobs are only queued here, nothing runs them
+    os.environ['BLOGARIZE_JOB_WORKERS'] = '0'
+    for name in ('app', 'scripts.config'):
+        sys.modules.pop(name, None)
+    try:
+        yield importlib.import_module('app')
+    finally:
+        os.chdir(cwd)
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+@pytest.mark.parametrize('setting', ['JOB_STORE', 'COMPLETION_CACHE_FOLDER'])
+def test_private_state_is_not_in_the_uploads_folder(app_module, setting):
+    config = app_module.app.config
+    assert not os.path.abspath(config[setting]).startswith(config['UPLOAD_FOLDER'] + os.sep)
+
+@pytest.mark.parametrize('filename', ['blogarize.db', 'completions/abc.json', 'instance/blogarize.db', '../instance/blogarize.db', 'cache/yt-abc/video.txt', 'cache/incoming/abc.part'])
+def test_download_only_serves_generated_artifacts(client, filename):
+    assert client.get(f'/download/{filename}').status_code == 404
+
+def test_download_serves_the_header_image(app_module, client):
+    cache = app_module.cache
+    with open(cache.path('yt-abc', 'image'), 'wb') as f:
+        f.write(b'png')
+    response = client.get('/download/cache/yt-abc/video-dalle.png')
+    assert response.status_code == 200 and response.data == b'png'
+
+def test_upload_with_unreadable_tags_is_still_queued(app_module, client, monkeypatch):
+    # mutagen gives up after the file is already in the cache
+    import mutagen
+    def broken(*args, **kwargs):
+        raise mutagen.MutagenError('cannot read tags')
+    monkeypatch.setattr(mutagen, 'File', broken)
+    data = b'not really a video'
+    upload = client.post('/uploads', json={'filename': 'my_talk.mp4', 'size': len(data)}).get_json()
+    assert client.patch(f"/uploads/{upload['upload_id']}", data=data, headers={'Upload-Offset': '0'}).status_code == 200
+    response = client.post(f"/uploads/{upload['upload_id']}/complete")
+    assert response.status_code == 200
+    job = app_module.jobs.get(response.get_json()['job_id'])
+    assert job.label == 'My Talk'
+
+def test_full_queue_answers_503(app_module, client, monkeypatch):
+    # A video we already have is queued straight away, which is refused once the queue is full
+    data = b'already here'
+    sha256 = hashlib.sha256(data).hexdigest()
+    cache = app_module.cache
+    with open(cache.path(f"sha256-{sha256}", 'video'), 'wb') as f:
+        f.write(data)
+    cache.record(f"sha256-{sha256}", 'video')
+    monkeypatch.setattr(app_module.jobs, 'max_pending', app_module.jobs.pending())
+    response = client.post('/uploads', json={'filename': 'talk.mp4', 'size': len(data), 'sha256': sha256})
+    assert response.status_code == 503 and 'try again later' in response.get_json()['error']
+
+def test_metrics_are_served_as_text(client):
+    response = client.get('/metrics')
+    assert response.status_code == 200 and response.mimetype == 'text/plain'
+    assert '# TYPE blogarize_peak_rss_bytes gauge' in response.get_data(as_text=True)
+
+def test_progress_streams_are_capped(app_module, client, monkeypatch):
+    monkeypatch.setattr(app_module, 'progress_streams', threading.BoundedSemaphore(1))
+    job = app_module.jobs.submit('process_video', title='Talk', key='yt-stream', label='Talk', dedup_key='yt-stream')
+    first = client.get(f'/progress/{job.id}')
+    assert first.status_code == 200 and first.mimetype == 'text/event-stream'
+    # The second watcher is sent to poll the job instead of tying up another thread
+    second = client.get(f'/progress/{job.id}')
+    assert second.status_code == 503 and second.get_json()['poll'] == f'/jobs/{job.id}'
+    assert client.get(second.get_json()['poll']).status_code == 200
+    # Closing a stream frees its place
+    first.close()
+    third = client.get(f'/progress/{job.id}')
+    assert third.status_code == 200
+    third.close()
@@ -0,0 +1,83 @@
+# Standard library imports
+import re
+import time
+import threading
+
+# Third-party imports
+import pytest
+
+# Local imports
+from scripts import processing
+
+OUTLINE = ['Intro', 'Caching', 'Queues', 'Wrapping up']
+
+class FakeOpenAI:
+    # Stands in for openai_completion: an outline, then one <h2> per section.
+    # Earlier sections take longer, so they finish in the opposite order to the outline.
+    def __init__(self, failing :set = ()):
+        self.failing = set(failing)
+        self.sections = []
+        self.running = 0
+        self.most_running = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, prompt :str, type :str = 'summary', **options) -> str:
+        if type == 'blog-outline':
+            return '\n'.join(f"- {title}" for title in OUTLINE)
+        title = re.search(r'Write the section about (.+?)\. Make sure', prompt).group(1)
+        with self._lock:
+            self.sections.append(title)
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        try:
+            time.sleep(0.05 * (len(OUTLINE) - OUTLINE.index(title)))
+            if title in self.failing:
+                raise RuntimeError(f"No luck with {title}")
+            return f"<h2>{title}</h2><p>Some words about {title.lower()}.</p>"
+        finally:
+            with self._lock:
+                self.running -= 1
+
+@pytest.fixture
+def blog_filepath(tmp_path):
+    return str(tmp_path / 'video-blog.html')
+
+def write_blog(blog_filepath :str, monkeypatch, failing :set = ()) -> FakeOpenAI:
+    fake = FakeOpenAI(failing)
+    monkeypatch.setattr(processing, 'openai_completion', fake)
+    processing.create_blog(title='Talk', summary='A summary.', blog_filepath=blog_filepath, section_concurrency=4, section_retries=0)
+    return fake
+
+def test_sections_are_written_together_and_kept_in_order(blog_filepath, monkeypatch):
+    fake = write_blog(blog_filepath, monkeypatch)
+    assert fake.most_running > 1
+    with open(blog_filepath) as f:
+        blog = f.read()
+    assert blog.startswith('<h1>Talk</h1>')
+    assert re.findall(r'<h2>(.+?)</h2>', blog) == OUTLINE
+
+def test_rerun_only_writes_the_failed_sections(blog_filepath, monkeypatch):
+    first = write_blog(blog_filepath, monkeypatch, failing={'Queues'})
+    assert sorted(first.sections) == sorted(OUTLINE)
+    with open(blog_filepath) as f:
+        # The one that failed is left as a comment in the post until it's written
+        assert '<!-- Could not write the section about Queues -->' in f.read()
+    manifest = processing.BlogManifest(blog_filepath)
+    assert [section['title'] for section in manifest.failed()] == ['Queues']
+    second = write_blog(blog_filepath, monkeypatch)
+    assert second.sections == ['Queues']
+    with open(blog_filepath) as f:
+        assert re.findall(r'<h2>(.+?)</h2>', f.read()) == OUTLINE
+    assert processing.BlogManifest(blog_filepath).complete()
+
+def test_damaged_section_is_written_again(blog_filepath, monkeypatch):
+    write_blog(blog_filepath, monkeypatch)
+    manifest = processing.BlogManifest(blog_filepath)
+    with open(manifest.section_filepath(1), 'w') as f:
+        f.write('<h2>Cach')
+    assert processing.BlogManifest(blog_filepath).todo() == [1]
+    assert write_blog(blog_filepath, monkeypatch).sections == ['Caching']
+
+def test_every_section_failing_is_an_error(blog_filepath, monkeypatch):
+    with pytest.raises(RuntimeError):
+        write_blog(blog_filepath, monkeypatch, failing=set(OUTLINE))
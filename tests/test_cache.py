@@ -0,0 +1,56 @@
+# Standard library imports
+import time
+
+# Third-party imports
+import pytest
+
+# Local imports
+from scripts.cache import ArtifactCache
+from scripts.store import SQLiteStore
+
+@pytest.fixture(params=['index', 'store'])
+def cache(tmp_path, request):
+    # Room for three 100 byte entries, with the old JSON index and with the shared store
+    store = SQLiteStore(str(tmp_path / 'blogarize.db')) if request.param == 'store' else None
+    return ArtifactCache(str(tmp_path / 'cache'), max_bytes=300, store=store)
+
+def add(cache :ArtifactCache, key :str) -> None:
+    with open(cache.path(key, 'transcript'), 'w') as f:
+        f.write('x' * 100)
+    cache.record(key, 'transcript')
+    # last_used has to tell the entries apart
+    time.sleep(0.01)
+
+def test_least_recently_used_goes_first(cache):
+    for key in ('yt-a', 'yt-b', 'yt-c'):
+        add(cache, key)
+    # Using a makes b the oldest
+    assert cache.lookup('yt-a', 'transcript') is not None
+    time.sleep(0.01)
+    add(cache, 'yt-d')
+    assert not cache.has('yt-b', 'transcript')
+    assert all(cache.has(key, 'transcript') for key in ('yt-a', 'yt-c', 'yt-d'))
+    assert cache.total_bytes() <= 300 and cache.evictions == 1
+
+def test_pinned_entry_is_passed_over(cache):
+    for key in ('yt-a', 'yt-b', 'yt-c'):
+        add(cache, key)
+    cache.pin('yt-a')
+    add(cache, 'yt-d')
+    assert cache.has('yt-a', 'transcript') and not cache.has('yt-b', 'transcript')
+    # Pins nest; the entry is only fair game once every pin is gone
+    cache.pin('yt-a')
+    cache.unpin('yt-a')
+    add(cache, 'yt-e')
+    assert cache.has('yt-a', 'transcript') and not cache.has('yt-c', 'transcript')
+    cache.unpin('yt-a')
+    add(cache, 'yt-f')
+    assert not cache.has('yt-a', 'transcript')
+
+def test_everything_pinned_goes_over_budget(cache):
+    # Better over budget for a while than a job losing its files
+    for key in ('yt-a', 'yt-b', 'yt-c', 'yt-d'):
+        cache.pin(key)
+        add(cache, key)
+    assert all(cache.has(key, 'transcript') for key in ('yt-a', 'yt-b', 'yt-c', 'yt-d'))
+    assert cache.total_bytes() == 400 and cache.evictions == 0
@@ -0,0 +1,27 @@
+# Standard library imports
+import os
+
+# Local imports
+from scripts.completion_cache import CompletionCache
+
+def folder_bytes(root :str) -> int:
+    return sum(os.path.getsize(os.path.join(dirpath, filename)) for dirpath, _, filenames in os.walk(root) for filename in filenames)
+
+def test_workers_sharing_a_folder_stay_near_the_budget(tmp_path):
+    # Two caches over one folder stand in for two worker processes, each only counting its own writes
+    root = str(tmp_path / 'completions')
+    first, second = CompletionCache(root, max_bytes=4000), CompletionCache(root, max_bytes=4000)
+    for i in range(100):
+        cache = first if i % 2 else second
+        cache.put(CompletionCache.key('summary', 'system', f'prompt {i}', 'model', 0.3, 100, 1.0), 'x' * 100)
+        # Each worker can get a tenth of the budget ahead of its last look at the folder
+        assert folder_bytes(root) <= 4000 * 1.2
+    assert first.evictions + second.evictions > 0
+
+def test_hit_after_put(tmp_path):
+    cache = CompletionCache(str(tmp_path / 'completions'))
+    key = CompletionCache.key('summary', 'system', 'prompt', 'model', 0.3, 100, 1.0)
+    assert cache.get(key) is None
+    cache.put(key, '<h2>Hi</h2>', type='summary')
+    assert cache.get(key) == '<h2>Hi</h2>'
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
@@ -0,0 +1,121 @@
+# Standard library imports
+import time
+import threading
+
+# Third-party imports
+import pytest
+
+# Local imports
+from scripts.jobs import Job, JobManager, JobQueueFull, LeaseLost, current_job
+from scripts.store import SQLiteStore, JOB_DONE, JOB_FAILED, JOB_QUEUED, JOB_RUNNING
+
+@pytest.fixture
+def store(tmp_path):
+    return SQLiteStore(str(tmp_path / 'blogarize.db'))
+
+def wait_for(condition, timeout :float = 5.0) -> None:
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'Timed out'
+        time.sleep(0.01)
+
+def test_submitted_job_runs_and_reports(store):
+    def task(**params):
+        current_job().update(progress=40, current_step='Halfway.')
+        return {'doubled': params['n'] * 2}
+    manager = JobManager(store, max_workers=1, poll_interval=0.05)
+    manager.register('double', task)
+    manager.start()
+    job = manager.submit('double', label='two', n=2)
+    wait_for(lambda: manager.get(job.id).status == JOB_DONE)
+    done = manager.get(job.id)
+    assert done.result == {'doubled': 4} and done.progress == 100 and done.label == 'two'
+
+def test_failed_task_is_reported(store):
+    def task(**params):
+        raise RuntimeError('no audio track')
+    manager = JobManager(store, max_workers=1, poll_interval=0.05)
+    manager.register('broken', task)
+    manager.start()
+    job = manager.submit('broken')
+    wait_for(lambda: manager.get(job.id).status == JOB_FAILED)
+    assert manager.get(job.id).error == 'no audio track'
+
+def test_same_input_twice_gets_the_first_job(store):
+    # Nothing is started, so both stay queued
+    manager = JobManager(store, max_workers=0)
+    manager.register('t', lambda **params: {})
+    first = manager.submit('t', dedup_key='yt-abc')
+    assert manager.submit('t', dedup_key='yt-abc').id == first.id
+    assert manager.submit('t', dedup_key='yt-other').id != first.id
+    assert manager.pending() == 2
+
+def test_finished_job_does_not_block_its_input(store):
+    manager = JobManager(store, max_workers=1, poll_interval=0.05)
+    manager.register('t', lambda **params: {})
+    manager.start()
+    first = manager.submit('t', dedup_key='yt-abc')
+    wait_for(lambda: manager.get(first.id).status == JOB_DONE)
+    assert manager.submit('t', dedup_key='yt-abc').id != first.id
+
+def test_full_queue_refuses_new_jobs(store):
+    manager = JobManager(store, max_workers=0, max_pending=2)
+    manager.register('t', lambda **params: {})
+    manager.submit('t', dedup_key='a')
+    manager.submit('t', dedup_key='b')
+    with pytest.raises(JobQueueFull):
+        manager.submit('t', dedup_key='c')
+    assert manager.pending() == 2 and store.count_jobs([JOB_QUEUED]) == 2
+
+def test_unknown_task_is_refused(store):
+    with pytest.raises(ValueError):
+        JobManager(store, max_workers=0).submit('nope')
+
+def test_stalled_worker_cannot_overwrite_the_new_one(store):
+    # Worker a leases the job and then stalls (no heartbeat) past its lease; worker b takes it over
+    stalled, gate = threading.Event(), threading.Event()
+    def slow(**params):
+        stalled.set()
+        gate.wait()
+        current_job().update(progress=50, current_step='Still going on a.')
+        return {'by': 'a'}
+    a = JobManager(store, lease_seconds=0.2, poll_interval=0.05)
+    a.register('t', slow)
+    b = JobManager(store, lease_seconds=5, poll_interval=0.05)
+    b.register('t', lambda **params: {'by': 'b'})
+    submitted = a.submit('t', label='contended')
+    job_a = Job.from_record(store.lease_job(a.worker_id, 0.2, 3), store=store)
+    thread = threading.Thread(target=a._run, args=(job_a,))
+    thread.start()
+    stalled.wait(5)
+    time.sleep(0.3)
+    b.start()
+    wait_for(lambda: store.get_job(submitted.id)['status'] == JOB_DONE)
+    gate.set()
+    thread.join(5)
+    record = store.get_job(submitted.id)
+    assert record['result'] == {'by': 'b'} and record['worker'] == b.worker_id
+    assert record['progress'] == 100 and record['attempts'] == 2
+    assert job_a.lost and job_a.result is None
+
+def test_lost_job_stops_at_its_next_update(store):
+    store.create_job({'id': 'abc', 'task': 't', 'status': 'queued', 'created': time.time()})
+    job = Job.from_record(store.lease_job('a', -1, 3), store=store)
+    store.lease_job('b', 60, 3)
+    with pytest.raises(LeaseLost):
+        job.update(progress=10)
+    assert store.get_job('abc')['progress'] == 0 and store.get_job('abc')['worker'] == 'b'
+    # And stays stopped
+    with pytest.raises(LeaseLost):
+        job.update(progress=20)
+
+def test_heartbeat_notices_a_lost_lease(store):
+    manager = JobManager(store, lease_seconds=0.15, poll_interval=0.05)
+    store.create_job({'id': 'abc', 'task': 't', 'status': 'queued', 'created': time.time()})
+    job = Job.from_record(store.lease_job(manager.worker_id, -1, 3), store=store)
+    manager._running[job.id] = job
+    # Someone else holds it now, e.g. after our lease ran out while the process was frozen
+    store.lease_job('other', 60, 3)
+    threading.Thread(target=manager._heartbeat, daemon=True).start()
+    wait_for(lambda: job.lost)
+    assert store.get_job(job.id)['status'] == JOB_RUNNING
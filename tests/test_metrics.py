@@ -0,0 +1,73 @@
+# Standard library imports
+import os
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+# Third-party imports
+import pytest
+
+# Local imports
+from scripts.pipeline import Pipeline, Stage
+from scripts.metrics import JobProfile, Registry, measure_stage, profiling, record_bytes, record_tokens, registry
+
+def test_histogram_is_rendered_cumulatively():
+    metrics = Registry()
+    for seconds in (0.05, 0.3, 4):
+        metrics.observe('stage_seconds', 'Wall time', seconds, buckets=(0.1, 1, 10), stage='transcribe')
+    lines = metrics.render().splitlines()
+    assert '# TYPE stage_seconds histogram' in lines
+    assert 'stage_seconds_bucket{stage="transcribe",le="0.1"} 1' in lines
+    assert 'stage_seconds_bucket{stage="transcribe",le="1"} 2' in lines
+    assert 'stage_seconds_bucket{stage="transcribe",le="+Inf"} 3' in lines
+    assert 'stage_seconds_count{stage="transcribe"} 3' in lines
+
+def test_counters_add_up_per_label():
+    metrics = Registry()
+    metrics.inc('tokens_total', 'Tokens', 10, kind='prompt')
+    metrics.inc('tokens_total', 'Tokens', 5, kind='prompt')
+    metrics.inc('tokens_total', 'Tokens', 7, kind='completion')
+    lines = metrics.render().splitlines()
+    assert 'tokens_total{kind="prompt"} 15' in lines and 'tokens_total{kind="completion"} 7' in lines
+
+def test_work_on_other_threads_counts_towards_the_stage():
+    # Like the notes and blog sections, which fan out to a pool and carry the context along
+    with measure_stage('test-fan-out') as record:
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            for _ in range(3):
+                executor.submit(contextvars.copy_context().run, record_tokens, prompt=100, completion=20)
+        record_bytes(read=1000, written=10)
+    assert (record.prompt_tokens, record.completion_tokens) == (300, 60)
+    assert (record.bytes_in, record.bytes_out) == (1000, 10)
+    assert record.wall_seconds > 0
+    assert 'blogarize_stage_tokens_total{kind="prompt",stage="test-fan-out"} 300' in registry.render().splitlines()
+
+def test_failed_stage_is_counted():
+    with pytest.raises(RuntimeError):
+        with measure_stage('test-broken'):
+            raise RuntimeError('no audio')
+    assert 'blogarize_stage_failures_total{stage="test-broken"} 1' in registry.render().splitlines()
+
+def test_pipeline_report_has_the_stage_costs():
+    def summarize(transcript):
+        record_tokens(prompt=1200, completion=300)
+        return {'summary': 'short'}
+    pipeline = Pipeline([Stage('test-summary', summarize, ['transcript'], ['summary'])])
+    pipeline.run({'transcript': 'words'})
+    report = pipeline.report()
+    assert report['critical_path'] == ['test-summary']
+    assert report['stages']['test-summary']['prompt_tokens'] == 1200
+    assert report['stages']['test-summary']['completion_tokens'] == 300
+
+def test_profile_covers_every_stage_thread(tmp_path):
+    def busy(n):
+        return {'total': sum(i * i for i in range(n))}
+    profile = JobProfile()
+    with profiling(profile):
+        Pipeline([
+            Stage('test-first', lambda: busy(20000), [], ['total']),
+            Stage('test-second', lambda total: {'again': busy(total % 1000 + 1)['total']}, ['total'], ['again'])
+        ]).run()
+    text_filepath = profile.dump(str(tmp_path / 'profiles' / 'job.prof'))
+    assert os.path.exists(tmp_path / 'profiles' / 'job.prof')
+    with open(text_filepath) as f:
+        assert 'busy' in f.read()
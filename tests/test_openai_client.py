@@ -0,0 +1,98 @@
+# Standard library imports
+import time
+
+# Third-party imports
+import openai
+import pytest
+
+# Local imports
+from scripts import openai_client
+from scripts.config import config
+from scripts.fake_openai import FakeOpenAIServer
+
+MESSAGES = [{'role': 'system', 'content': 'Write a summary.'}, {'role': 'user', 'content': 'This is a video about caching. ' * 20}]
+
+@pytest.fixture
+def server(monkeypatch):
+    server = FakeOpenAIServer(retry_after=0.05, words=50).start()
+    monkeypatch.setenv('OPENAI_BASE_URL', server.base_url)
+    monkeypatch.setenv('OPENAI_API_KEY', 'test')
+    # A client, limiter and stats of our own for every test
+    monkeypatch.setattr(openai_client, '_client', None)
+    monkeypatch.setattr(openai_client, 'limiter', openai_client.RateLimiter())
+    monkeypatch.setattr(openai_client, 'stats', openai_client.OpenAIStats())
+    yield server
+    server.stop()
+
+@pytest.fixture
+def pauses(server, monkeypatch):
+    pauses = []
+    pause = openai_client.limiter.pause
+    monkeypatch.setattr(openai_client.limiter, 'pause', lambda seconds: (pauses.append(seconds), pause(seconds)))
+    return pauses
+
+@pytest.fixture
+def frozen_bucket(server, monkeypatch):
+    # No refill, so what's gone from the bucket is exactly what the calls were charged
+    limiter = openai_client.limiter
+    monkeypatch.setattr(limiter, '_refill', lambda: None)
+    limiter._tokens = 100000
+    return limiter
+
+def create(**options):
+    return lambda: openai_client.get_client().chat.completions.create(model='gpt-4-turbo-preview', messages=MESSAGES, **options)
+
+def test_rate_limit_pauses_everyone_then_succeeds(server, pauses):
+    server.fail_next(429)
+    text = openai_client.chat_completion(MESSAGES)
+    assert text.startswith('<h2>')
+    assert pauses == [pytest.approx(0.05)]
+    assert server.requests == 2
+    assert openai_client.stats.snapshot()['chat']['retries'] == 1
+
+def test_retries_run_out(server):
+    server.fail_next(500, 500, 500)
+    with pytest.raises(openai.InternalServerError):
+        openai_client.call_with_retries('chat', create(), max_retries=2, base_delay=0.01)
+    assert server.requests == 3
+    stats = openai_client.stats.snapshot()['chat']
+    assert stats['errors'] == 1 and stats['retries'] == 2
+
+def test_bad_request_is_not_retried(server):
+    server.fail_next(400)
+    with pytest.raises(openai.BadRequestError):
+        openai_client.call_with_retries('chat', create(), max_retries=3, base_delay=0.01)
+    assert server.requests == 1
+
+def test_long_retry_hint_is_capped(server, pauses):
+    server.retry_after = 600
+    server.fail_next(429)
+    started = time.perf_counter()
+    openai_client.call_with_retries('chat', create(), max_delay=0.05)
+    assert time.perf_counter() - started < 5
+    assert pauses == [0.05]
+
+def test_retries_come_from_config(server, monkeypatch):
+    monkeypatch.setitem(config, 'OPENAI_RETRIES', 1)
+    server.fail_next(500, 500)
+    with pytest.raises(openai.InternalServerError):
+        openai_client.call_with_retries('chat', create(), base_delay=0.01)
+    assert server.requests == 2
+
+def test_call_is_charged_its_actual_usage(server, frozen_bucket):
+    openai_client.chat_completion(MESSAGES, max_tokens=2500)
+    stats = openai_client.stats.snapshot()['chat']
+    assert 100000 - frozen_bucket._tokens == stats['prompt_tokens'] + stats['completion_tokens'] > 0
+
+def test_stream_is_charged_its_actual_usage(server, frozen_bucket):
+    pieces = []
+    text = openai_client.chat_completion_stream(MESSAGES, pieces.append, max_tokens=2500)
+    assert ''.join(pieces) == text
+    stats = openai_client.stats.snapshot()['chat-stream-body']
+    assert 100000 - frozen_bucket._tokens == stats['prompt_tokens'] + stats['completion_tokens'] > 0
+
+def test_failed_call_gives_its_estimate_back(server, frozen_bucket):
+    server.fail_next(400)
+    with pytest.raises(openai.BadRequestError):
+        openai_client.chat_completion(MESSAGES, max_tokens=2500)
+    assert frozen_bucket._tokens == 100000
@@ -0,0 +1,86 @@
+# Standard library imports
+import time
+import threading
+
+# Third-party imports
+import pytest
+
+# Local imports
+from scripts.pipeline import Pipeline, Stage
+
+def stage(name :str, inputs=(), outputs=(), seconds :float = 0.0, log :list = None, fail :bool = False) -> Stage:
+    # Each output is the stage's name followed by its inputs, so the result shows what fed into what
+    def fn(**values):
+        if log is not None:
+            log.append(('start', name))
+        time.sleep(seconds)
+        if log is not None:
+            log.append(('end', name))
+        if fail:
+            raise RuntimeError(f"{name} broke")
+        return {output: f"{name}({', '.join(str(values[i]) for i in inputs)})" for output in outputs}
+    return Stage(name, fn, inputs, outputs)
+
+def test_stages_run_after_their_inputs():
+    log = []
+    pipeline = Pipeline([
+        # Listed out of order on purpose
+        stage('blog', ['transcript', 'summary'], ['blog'], log=log),
+        stage('summary', ['transcript'], ['summary'], log=log),
+        stage('transcribe', ['audio'], ['transcript'], log=log),
+        stage('audio', ['video'], ['audio'], log=log)
+    ])
+    values = pipeline.run({'video': 'talk.mp4'})
+    assert values['blog'] == 'blog(transcribe(audio(talk.mp4)), summary(transcribe(audio(talk.mp4))))'
+    finished = [name for event, name in log if event == 'end']
+    assert finished == ['audio', 'transcribe', 'summary', 'blog']
+    assert pipeline.critical_path() == ['audio', 'transcribe', 'summary', 'blog']
+
+def test_independent_stages_overlap():
+    log = []
+    pipeline = Pipeline([
+        stage('summary', ['transcript'], ['summary'], seconds=0.1, log=log),
+        stage('image', ['transcript'], ['image'], seconds=0.1, log=log)
+    ], max_workers=2)
+    pipeline.run({'transcript': 'words'})
+    # Both started before either finished
+    assert [event for event, _ in log] == ['start', 'start', 'end', 'end']
+
+def test_failure_stops_what_depends_on_it():
+    log = []
+    pipeline = Pipeline([
+        stage('summary', ['transcript'], ['summary'], log=log, fail=True),
+        stage('blog', ['summary'], ['blog'], log=log),
+        stage('image', ['transcript'], ['image'], seconds=0.1, log=log)
+    ], max_workers=2)
+    with pytest.raises(RuntimeError, match='summary broke'):
+        pipeline.run({'transcript': 'words'})
+    started = [name for event, name in log if event == 'start']
+    # What was already running is let finish; nothing new starts
+    assert 'blog' not in started and ('end', 'image') in log
+
+def test_missing_output_is_an_error():
+    pipeline = Pipeline([Stage('blog', lambda **values: {}, ['transcript'], ['blog'])])
+    with pytest.raises(RuntimeError, match="didn't produce 'blog'"):
+        pipeline.run({'transcript': 'words'})
+
+def test_bad_graphs_are_refused():
+    with pytest.raises(ValueError, match='Nothing produces audio'):
+        Pipeline([stage('transcribe', ['audio'], ['transcript'])]).run({})
+    with pytest.raises(ValueError, match='produce'):
+        Pipeline([stage('a', [], ['x']), stage('b', [], ['x'])])
+    # Each waits on the other
+    with pytest.raises(RuntimeError, match='can never start'):
+        Pipeline([stage('a', ['y'], ['x']), stage('b', ['x'], ['y'])]).run({})
+
+def test_limit_is_shared_between_pipelines():
+    limit = threading.Semaphore(1)
+    log = []
+    pipelines = [Pipeline([stage('transcribe', ['audio'], ['transcript'], seconds=0.05, log=log)], limits={'transcribe': limit}) for _ in range(3)]
+    threads = [threading.Thread(target=pipeline.run, args=({'audio': 'a.wav'},)) for pipeline in pipelines]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    # Never two at once
+    assert [event for event, _ in log] == ['start', 'end'] * 3
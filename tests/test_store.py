@@ -0,0 +1,139 @@
+# Standard library imports
+import os
+import time
+import uuid
+
+# Third-party imports
+import pytest
+
+# Local imports
+from scripts.cache import ArtifactCache
+from scripts.store import SQLiteStore, JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED
+
+@pytest.fixture
+def store(tmp_path):
+    return SQLiteStore(str(tmp_path / 'blogarize.db'))
+
+def new_job(dedup_key :str = None, created :float = None) -> dict:
+    return {'id': uuid.uuid4().hex, 'task': 'process_video', 'params': {'key': dedup_key}, 'dedup_key': dedup_key,
+            'status': JOB_QUEUED, 'created': created or time.time()}
+
+def test_same_input_in_flight_gets_the_same_job(store):
+    first, created = store.create_job(new_job('yt-abc'))
+    assert created
+    second, created = store.create_job(new_job('yt-abc'))
+    assert not created and second['id'] == first['id']
+    # Without a dedup key nothing is shared
+    assert store.create_job(new_job())[1] and store.create_job(new_job())[1]
+
+def test_finished_job_does_not_block_a_new_one(store):
+    job, _ = store.create_job(new_job('yt-abc'))
+    store.update_job(job['id'], status=JOB_DONE, finished=time.time())
+    again, created = store.create_job(new_job('yt-abc'))
+    assert created and again['id'] != job['id']
+
+def test_a_job_is_leased_once(store):
+    older, _ = store.create_job(new_job(created=1))
+    newer, _ = store.create_job(new_job(created=2))
+    assert store.lease_job('a', 60, 3)['id'] == older['id']
+    assert store.lease_job('b', 60, 3)['id'] == newer['id']
+    assert store.lease_job('c', 60, 3) is None
+    leased = store.get_job(older['id'])
+    assert leased['status'] == JOB_RUNNING and leased['worker'] == 'a' and leased['attempts'] == 1
+
+def test_updates_need_the_lease(store):
+    job, _ = store.create_job(new_job())
+    store.lease_job('a', 60, 3)
+    assert not store.update_job(job['id'], worker='b', progress=50)
+    assert store.update_job(job['id'], worker='a', progress=50)
+    assert store.get_job(job['id'])['progress'] == 50
+
+def test_lost_job_goes_back_in_the_queue(store):
+    job, _ = store.create_job(new_job())
+    store.lease_job('dead', -1, 3)
+    # The lease has already run out, so the next worker to ask takes the job over
+    leased = store.lease_job('alive', 60, 3)
+    assert leased['id'] == job['id'] and leased['worker'] == 'alive' and leased['attempts'] == 2
+
+def test_lost_job_gives_up_after_max_attempts(store):
+    job, _ = store.create_job(new_job())
+    store.lease_job('dead', -1, 1)
+    assert store.lease_job('alive', 60, 1) is None
+    failed = store.get_job(job['id'])
+    assert failed['status'] == JOB_FAILED and failed['worker'] is None
+
+def test_renewed_lease_is_not_taken(store):
+    job, _ = store.create_job(new_job())
+    store.lease_job('a', 0.05, 3)
+    store.renew_leases('a', [job['id']], 60)
+    time.sleep(0.1)
+    assert store.lease_job('b', 60, 3) is None
+    # Only the holder can renew
+    store.renew_leases('b', [job['id']], -1)
+    assert store.lease_job('b', 60, 3) is None
+
+def test_prune_only_finished_jobs(store):
+    done, _ = store.create_job(new_job())
+    store.update_job(done['id'], status=JOB_DONE, finished=time.time() - 100)
+    queued, _ = store.create_job(new_job())
+    assert store.prune_jobs(time.time()) == 1
+    assert store.get_job(done['id']) is None and store.get_job(queued['id']) is not None
+
+def test_pins_expire(store):
+    store.pin_artifact('yt-abc', 'a', 60)
+    store.pin_artifact('yt-def', 'b', -1)
+    assert store.pinned_artifacts() == {'yt-abc'}
+    store.unpin_artifact('yt-abc', 'a')
+    assert store.pinned_artifacts() == set()
+
+def test_evict_artifact_skips_pinned(store):
+    store.put_artifact('yt-abc', {'size': 1, 'last_used': 1})
+    store.pin_artifact('yt-abc', 'a', 60)
+    assert not store.evict_artifact('yt-abc')
+    assert store.get_artifact('yt-abc') is not None
+    store.unpin_artifact('yt-abc', 'a')
+    assert store.evict_artifact('yt-abc')
+    assert store.get_artifact('yt-abc') is None
+
+def fill(cache :ArtifactCache, key :str, size :int) -> None:
+    with open(cache.path(key, 'video'), 'wb') as f:
+        f.write(b'\0' * size)
+    cache.record(key, 'video')
+
+def test_pin_in_one_process_stops_eviction_in_another(tmp_path, store):
+    # Two caches over the same folder and store stand in for two worker processes
+    root = str(tmp_path / 'cache')
+    working = ArtifactCache(root, max_bytes=1000, store=store)
+    other = ArtifactCache(root, max_bytes=1000, store=store)
+    fill(working, 'yt-old', 600)
+    working.pin('yt-old')
+    # Over the budget, and the pinned entry is the least recently used, so the other one goes instead
+    fill(other, 'yt-new', 600)
+    assert store.get_artifact('yt-old') is not None and store.get_artifact('yt-new') is None
+    assert os.path.exists(os.path.join(root, 'yt-old', 'video.mp4'))
+    assert other.stats()['pinned'] == 1
+    working.unpin('yt-old')
+    fill(other, 'yt-newer', 600)
+    assert store.get_artifact('yt-old') is None and store.get_artifact('yt-newer') is not None
+    assert not os.path.exists(os.path.join(root, 'yt-old'))
+
+def test_pin_of_a_dead_process_runs_out(tmp_path, store):
+    root = str(tmp_path / 'cache')
+    dead = ArtifactCache(root, max_bytes=1000, store=store, pin_seconds=0.05)
+    other = ArtifactCache(root, max_bytes=1000, store=store)
+    fill(dead, 'yt-old', 600)
+    dead.pin('yt-old')
+    # The process is gone, so nobody renews the pin
+    dead._renewer = None
+    dead._pinned.clear()
+    time.sleep(0.1)
+    fill(other, 'yt-new', 600)
+    assert store.get_artifact('yt-old') is None
+
+def test_pins_are_renewed_while_held(tmp_path, store):
+    cache = ArtifactCache(str(tmp_path / 'cache'), store=store, pin_seconds=0.15)
+    cache.pin('yt-abc')
+    time.sleep(0.4)
+    assert store.pinned_artifacts() == {'yt-abc'}
+    cache.unpin('yt-abc')
+    assert store.pinned_artifacts() == set()
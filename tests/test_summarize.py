@@ -0,0 +1,55 @@
+# Standard library imports
+import threading
+
+# Local imports
+from scripts.summarize import build_notes, count_tokens, split_into_chunks, split_into_groups
+
+TRANSCRIPT = ' '.join(f"This is sentence number {i} of the talk." for i in range(200))
+
+class FakeModel:
+    # Notes are the start of what they were given, so it's easy to see they kept their order
+    def __init__(self, keep :int = 120):
+        self.keep = keep
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, type :str, prompt :str, max_tokens :int) -> str:
+        with self._lock:
+            self.calls.append((type, prompt))
+        return prompt[:self.keep]
+
+def test_chunks_fit_and_break_between_sentences():
+    chunks = split_into_chunks(TRANSCRIPT, 100)
+    assert len(chunks) > 1
+    assert all(count_tokens(chunk) <= 100 for chunk in chunks)
+    assert all(chunk.endswith('of the talk.') for chunk in chunks)
+    assert ' '.join(chunks) == TRANSCRIPT
+
+def test_huge_sentence_is_split_on_words():
+    sentence = ' '.join(['word'] * 1000) + '.'
+    chunks = split_into_chunks(sentence, 50)
+    assert all(count_tokens(chunk) <= 50 for chunk in chunks)
+    assert ' '.join(chunks).split() == sentence.split()
+
+def test_groups_fit_and_keep_their_order():
+    notes = [f"note {i} " * 10 for i in range(30)]
+    groups = split_into_groups(notes, 100)
+    assert [note for group in groups for note in group] == notes
+    assert all(count_tokens(''.join(group)) <= 100 for group in groups)
+
+def test_short_transcript_needs_no_notes():
+    model = FakeModel()
+    assert build_notes('A short talk.', model, chunk_tokens=100) == 'A short talk.'
+    assert model.calls == []
+
+def test_notes_on_every_chunk_then_merged_until_they_fit():
+    model = FakeModel()
+    notes = build_notes(TRANSCRIPT, model, chunk_tokens=100, concurrency=4)
+    chunks = split_into_chunks(TRANSCRIPT, 100)
+    # Map: one call per chunk, each with exactly that chunk
+    mapped = [prompt for type, prompt in model.calls if type == 'notes']
+    assert sorted(mapped) == sorted(chunks)
+    # Reduce: the notes didn't fit in one chunk, so they were merged until they did
+    assert any(type == 'combine-notes' for type, _ in model.calls)
+    assert count_tokens(notes) <= 100
+    assert notes.startswith('This is sentence number 0 of the talk.')
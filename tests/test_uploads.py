@@ -0,0 +1,126 @@
+# Standard library imports
+import io
+import os
+import hashlib
+
+# Third-party imports
+import pytest
+
+# Local imports
+from scripts.cache import ArtifactCache
+from scripts.store import SQLiteStore
+from scripts.uploads import OffsetMismatch, UploadError, UploadManager
+
+DATA = bytes(range(256)) * 40
+
+class Dropped(io.BytesIO):
+    # A request body whose client goes away after sending part of it
+    def __init__(self, data :bytes, after :int):
+        super().__init__(data)
+        self.after = after
+
+    def read(self, size :int = -1) -> bytes:
+        if self.tell() >= self.after:
+            raise ConnectionError('Client went away')
+        return super().read(min(size, self.after - self.tell()))
+
+@pytest.fixture
+def store(tmp_path):
+    return SQLiteStore(str(tmp_path / 'blogarize.db'))
+
+@pytest.fixture
+def cache(tmp_path, store):
+    return ArtifactCache(str(tmp_path / 'cache'), store=store)
+
+def manager(store, cache) -> UploadManager:
+    # A new manager over the same store and folder stands in for another worker process
+    return UploadManager(store, cache, chunk_size=1024)
+
+def test_upload_in_chunks(store, cache):
+    uploads = manager(store, cache)
+    upload = uploads.start('talk.mp4', len(DATA))
+    assert upload['status'] == 'started' and upload['offset'] == 0
+    offset = 0
+    while offset < len(DATA):
+        offset = uploads.write_chunk(upload['upload_id'], offset, io.BytesIO(DATA[offset:offset + 1024]))
+    key = uploads.complete(upload['upload_id'])
+    assert key == f"sha256-{hashlib.sha256(DATA).hexdigest()}"
+    with open(cache.lookup(key, 'video'), 'rb') as f:
+        assert f.read() == DATA
+    assert uploads.get(upload['upload_id']) is None
+
+def test_wrong_offset_is_told_where_to_go(store, cache):
+    uploads = manager(store, cache)
+    upload_id = uploads.start('talk.mp4', len(DATA))['upload_id']
+    uploads.write_chunk(upload_id, 0, io.BytesIO(DATA[:1024]))
+    with pytest.raises(OffsetMismatch) as e:
+        uploads.write_chunk(upload_id, 2048, io.BytesIO(DATA[2048:3072]))
+    assert e.value.offset == 1024
+    with pytest.raises(OffsetMismatch) as e:
+        uploads.complete(upload_id)
+    assert e.value.offset == 1024
+
+def test_dropped_chunk_keeps_what_arrived(store, cache):
+    uploads = manager(store, cache)
+    upload_id = uploads.start('talk.mp4', len(DATA))['upload_id']
+    with pytest.raises(ConnectionError):
+        uploads.write_chunk(upload_id, 0, Dropped(DATA[:4096], after=1500))
+    assert uploads.get(upload_id).offset == 1500
+    uploads.write_chunk(upload_id, 1500, io.BytesIO(DATA[1500:]))
+    assert uploads.complete(upload_id) == f"sha256-{hashlib.sha256(DATA).hexdigest()}"
+
+def test_resume_on_another_worker(store, cache):
+    first, second = manager(store, cache), manager(store, cache)
+    upload_id = first.start('talk.mp4', len(DATA))['upload_id']
+    first.write_chunk(upload_id, 0, io.BytesIO(DATA[:3000]))
+    # The second worker has no running hash for this upload and catches up from the part file
+    assert second.get(upload_id).offset == 3000
+    second.write_chunk(upload_id, 3000, io.BytesIO(DATA[3000:6000]))
+    first.write_chunk(upload_id, 6000, io.BytesIO(DATA[6000:]))
+    assert second.complete(upload_id) == f"sha256-{hashlib.sha256(DATA).hexdigest()}"
+
+def test_one_writer_at_a_time(store, cache):
+    uploads = manager(store, cache)
+    upload_id = uploads.start('talk.mp4', len(DATA))['upload_id']
+    # Another request is halfway through writing the first chunk
+    assert store.claim_upload(upload_id, 'someone-else', 0, 60)[1]
+    with pytest.raises(OffsetMismatch):
+        uploads.write_chunk(upload_id, 0, io.BytesIO(DATA[:1024]))
+    # Until its claim runs out
+    assert store.claim_upload(upload_id, 'someone-else', 0, -1)[1]
+    assert uploads.write_chunk(upload_id, 0, io.BytesIO(DATA[:1024])) == 1024
+
+def test_known_hash_skips_the_upload(store, cache):
+    uploads = manager(store, cache)
+    upload_id = uploads.start('talk.mp4', len(DATA))['upload_id']
+    uploads.write_chunk(upload_id, 0, io.BytesIO(DATA))
+    key = uploads.complete(upload_id)
+    again = uploads.start('same-talk.mp4', len(DATA), hashlib.sha256(DATA).hexdigest())
+    assert again == {'status': 'exists', 'key': key}
+
+def test_hash_mismatch_is_refused(store, cache):
+    uploads = manager(store, cache)
+    upload_id = uploads.start('talk.mp4', len(DATA), hashlib.sha256(b'something else').hexdigest())['upload_id']
+    uploads.write_chunk(upload_id, 0, io.BytesIO(DATA))
+    with pytest.raises(UploadError):
+        uploads.complete(upload_id)
+    assert uploads.get(upload_id) is None
+
+def test_too_much_data_is_refused(store, cache):
+    uploads = manager(store, cache)
+    upload_id = uploads.start('talk.mp4', 100)['upload_id']
+    with pytest.raises(UploadError):
+        uploads.write_chunk(upload_id, 0, io.BytesIO(DATA))
+    assert uploads.get(upload_id).offset == 0
+
+def test_unknown_hash_leaves_nothing_behind(store, cache):
+    uploads = manager(store, cache)
+    before = sorted(os.listdir(cache.root))
+    upload = uploads.start('talk.mp4', len(DATA), hashlib.sha256(b'never seen').hexdigest())
+    assert upload['status'] == 'started'
+    assert sorted(os.listdir(cache.root)) == before
+
+@pytest.mark.parametrize('size', [0, -1])
+def test_empty_or_negative_size_is_refused(store, cache, size):
+    with pytest.raises(UploadError):
+        manager(store, cache).start('talk.mp4', size)
@@ -0,0 +1,31 @@
+# Standard library imports
+import os
+
+# Third-party imports
+import pytest
+
+# Local imports
+from scripts.util import atomic_write, owner_id
+
+def test_atomic_write_swaps_in_the_whole_file(tmp_path):
+    filepath = str(tmp_path / 'manifest.json')
+    with atomic_write(filepath) as f:
+        f.write('new')
+    with open(filepath) as f:
+        assert f.read() == 'new'
+    assert os.listdir(tmp_path) == ['manifest.json']
+
+def test_failed_write_keeps_the_old_file(tmp_path):
+    filepath = str(tmp_path / 'manifest.json')
+    with open(filepath, 'w') as f:
+        f.write('old')
+    with pytest.raises(RuntimeError):
+        with atomic_write(filepath) as f:
+            f.write('half')
+            raise RuntimeError('crashed')
+    with open(filepath) as f:
+        assert f.read() == 'old'
+    assert os.listdir(tmp_path) == ['manifest.json']
+
+def test_owner_ids_are_unique_in_one_process():
+    assert owner_id() != owner_id()
@@ -0,0 +1,69 @@
+# Third-party imports
+import numpy as np
+import pytest
+
+# Local imports
+from scripts.vad import SAMPLE_RATE, TimeMap, map_segments, speech_regions, speech_threshold, trim_silence
+
+rng = np.random.default_rng(0)
+
+def tone(seconds :float, amplitude :float = 0.3) -> np.ndarray:
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    return (amplitude * np.sin(2 * np.pi * 220 * t)).astype(np.float32)
+
+def hiss(seconds :float, amplitude :float = 0.002) -> np.ndarray:
+    return (amplitude * rng.standard_normal(int(seconds * SAMPLE_RATE))).astype(np.float32)
+
+def test_short_speech_in_long_silence_is_trimmed():
+    # Under 5% speech: the old percentile threshold kept all of it
+    samples = np.concatenate([hiss(60), tone(5) + hiss(5), hiss(60)])
+    trimmed, timemap = trim_silence(samples)
+    assert timemap.kept_seconds == pytest.approx(5.5, abs=0.1)
+    assert timemap.removed_seconds == pytest.approx(119.5, abs=0.1)
+    assert len(trimmed) == pytest.approx(5.5 * SAMPLE_RATE, abs=0.1 * SAMPLE_RATE)
+
+@pytest.mark.parametrize('samples', [hiss(30), np.zeros(30 * SAMPLE_RATE, dtype=np.float32)])
+def test_all_silence_leaves_nothing(samples):
+    trimmed, timemap = trim_silence(samples)
+    assert len(trimmed) == 0
+    assert timemap.removed_seconds == pytest.approx(30)
+    assert len(speech_regions(samples)) == 0
+
+def test_speech_without_pauses_is_left_alone():
+    samples = tone(30) + hiss(30)
+    trimmed, timemap = trim_silence(samples)
+    assert len(trimmed) == len(samples)
+    assert timemap.removed_seconds == 0
+
+def test_short_pauses_stay_and_long_ones_shrink():
+    samples = np.concatenate([tone(2), hiss(0.5), tone(2), hiss(10), tone(2)])
+    regions = speech_regions(samples, min_silence_seconds=1.0, padding_seconds=0.25) / SAMPLE_RATE
+    assert len(regions) == 2
+    assert regions[0, 0] == 0
+    assert regions[0, 1] == pytest.approx(4.75, abs=0.05)
+    assert regions[1, 0] == pytest.approx(14.25, abs=0.05)
+
+def test_threshold_is_clamped_to_absolute_levels():
+    assert speech_threshold(np.full(100, -100.0)) == -55.0
+    assert speech_threshold(np.full(100, -10.0)) == -35.0
+    assert speech_threshold(np.full(100, -50.0)) == -38.0
+
+def test_given_threshold_wins_over_the_samples_own():
+    # A segment from a loud recording: its own floor would call the hiss speech
+    samples = hiss(10, amplitude=0.05)
+    assert len(speech_regions(samples)) == 1
+    assert len(speech_regions(samples, threshold_db=-20.0)) == 0
+
+def test_timemap_maps_trimmed_times_back():
+    samples = np.concatenate([hiss(10), tone(5) + hiss(5), hiss(20), tone(5) + hiss(5)])
+    _, timemap = trim_silence(samples, padding_seconds=0.25)
+    first = timemap.lengths[0]
+    assert timemap.to_original(0.0) == pytest.approx(9.75, abs=0.05)
+    assert timemap.to_original(first) == pytest.approx(34.75, abs=0.05)
+    assert timemap.to_original(first, end=True) == pytest.approx(15.25, abs=0.05)
+    assert list(timemap.to_original([0.0, 1.0])) == pytest.approx([9.75, 10.75], abs=0.05)
+
+def test_identity_timemap_and_segments():
+    timemap = TimeMap.identity(30)
+    segments = map_segments([{'start': 1.0, 'end': 2.5, 'text': ' hi '}], timemap, offset=60)
+    assert segments == [{'start': 61.0, 'end': 62.5, 'text': 'hi'}]